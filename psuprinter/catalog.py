@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+"""
+SQLite catalog of spooled print jobs.
+
+psuprinter adds a row for each job as it is completed, so jobs can be
+found by user, job name or date without listing and splitting the names
+of every file in the output directory.
+"""
+import os
+import sys
+import time
+import sqlite3
+import threading
+import argparse
+
+try:
+    from psuprinter.spool import spool_files, pdf_for
+except ImportError:
+    from spool import spool_files, pdf_for
+
+# Default catalog file name, relative to the output directory.
+CATALOG_NAME = 'psujobs.db'
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    ujn TEXT NOT NULL,
+    jsn TEXT NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    stamp TEXT,
+    txt_path TEXT NOT NULL,
+    pdf_path TEXT,
+    bytes INTEGER,
+    lines INTEGER,
+    pages INTEGER,
+    receive_secs REAL,
+    render_secs REAL,
+    completed REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_txt_path ON jobs(txt_path);
+CREATE INDEX IF NOT EXISTS jobs_user_stamp ON jobs(user, stamp);
+CREATE INDEX IF NOT EXISTS jobs_stamp ON jobs(stamp);
+CREATE INDEX IF NOT EXISTS jobs_jsn ON jobs(jsn);
+"""
+
+COLUMNS = ('user', 'ujn', 'jsn', 'date', 'time', 'stamp', 'txt_path', 'pdf_path',
+           'bytes', 'lines', 'pages', 'receive_secs', 'render_secs', 'completed')
+
+def banner_stamp(date, time):
+    """
+    Convert banner page date and time fields as used in file names
+    (YY_MM_DD and HH_MM_SS) to a sortable 'YYYY-MM-DD HH:MM:SS' string.
+    Return None if they cannot be converted.
+    """
+    try:
+        yy, mm, dd = [int(x) for x in date.split('_')]
+        hh, mi, ss = [int(x) for x in time.split('_')]
+    except ValueError:
+        return None
+    # NOS 2.8.7 two digit years: 70-99 are 19xx, the rest 20xx.
+    if yy < 100:
+        yy += 1900 if yy >= 70 else 2000
+    return '%04d-%02d-%02d %02d:%02d:%02d'%(yy, mm, dd, hh, mi, ss)
+
+def parse_date_arg(text):
+    """
+    Convert a command line date (YY_MM_DD, YYYY-MM-DD or YYYY-MM-DD HH:MM:SS)
+    to the form used in the stamp column.
+    """
+    if '_' in text:
+        stamp = banner_stamp(text, '00_00_00')
+        if stamp is None:
+            raise ValueError('bad date: '+text)
+        return stamp
+    if len(text) == 10:
+        text += ' 00:00:00'
+    time.strptime(text, '%Y-%m-%d %H:%M:%S')
+    return text
+
+class JobCatalog(object):
+    """
+    Indexed SQLite catalog of print jobs, one row per job.
+    """
+
+    def __init__(self, path):
+        """
+        Open (creating if need be) the catalog in file path.
+        """
+        super(JobCatalog,self).__init__()
+        self.path = path
+        # Jobs may be added from render threads (see scheduler.py), one at a time.
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        # WAL lets queries run while psuprinter is adding jobs.
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        """
+        Close the catalog.
+        """
+        with self.lock:
+            self.conn.close()
+
+    def add(self, **fields):
+        """
+        Add (or replace) the row for one job. The fields are named as the
+        columns. A stamp is made from date and time if not given.
+        """
+        row = dict.fromkeys(COLUMNS)
+        row.update(fields)
+        if row['stamp'] is None:
+            row['stamp'] = banner_stamp(row['date'], row['time'])
+        if row['completed'] is None:
+            row['completed'] = time.time()
+        sql = 'INSERT OR REPLACE INTO jobs (%s) VALUES (%s)'%(', '.join(COLUMNS), ', '.join('?'*len(COLUMNS)))
+        with self.lock, self.conn:
+            self.conn.execute(sql, [row[c] for c in COLUMNS])
+
+    def add_job(self, job):
+        """
+        Add the row for a completed Job.
+        """
+        self.add(user=job.user, ujn=job.ujn, jsn=job.jsn, date=job.date, time=job.time,
+                 txt_path=job.path_name, pdf_path=job.pdf_path or None,
+                 bytes=job.nbytes, lines=job.nlines, pages=job.npages,
+                 receive_secs=job.receive_secs, render_secs=job.render_secs,
+                 completed=job.t_close)
+
+    def move(self, old_txt_path, txt_path, pdf_path):
+        """
+        Record that a job's files have been moved.
+        """
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE jobs SET txt_path = ?, pdf_path = ? WHERE txt_path = ?',
+                              (txt_path, pdf_path, old_txt_path))
+
+    def set_pdf(self, txt_path, pdf_path, pages=None):
+        """
+        Record that a job's PDF, of pages pages if given, has been made.
+        """
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE jobs SET pdf_path = ?, pages = COALESCE(?, pages) WHERE txt_path = ?',
+                              (pdf_path, pages, txt_path))
+
+    def query(self, user=None, ujn=None, jsn=None, since=None, until=None, limit=None):
+        """
+        Return rows matching all of the given criteria, oldest first.
+        since and until are 'YYYY-MM-DD HH:MM:SS' strings; until is exclusive.
+        """
+        where = []
+        args = []
+        for column, value in (('user', user), ('ujn', ujn), ('jsn', jsn)):
+            if value is not None:
+                where.append(column+' = ?')
+                args.append(value)
+        if since is not None:
+            where.append('stamp >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('stamp < ?')
+            args.append(until)
+        sql = 'SELECT * FROM jobs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY stamp, id'
+        if limit is not None:
+            sql += ' LIMIT %d'%int(limit)
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def import_spool(self, outdir):
+        """
+        Add rows for spool files already under outdir (e.g. written before the
+        catalog was used), in whatever layout. Only what the file names and
+        sizes tell us is recorded. Return the number of files added.
+        """
+        count = 0
+        sql = 'INSERT OR IGNORE INTO jobs (%s) VALUES (%s)'%(', '.join(COLUMNS), ', '.join('?'*len(COLUMNS)))
+        with self.lock, self.conn:
+            for txt_path, fields in spool_files(outdir):
+                pdf_path = pdf_for(outdir, txt_path)
+                if not os.access(pdf_path, os.F_OK):
+                    pdf_path = None
+                st = os.stat(txt_path)
+                row = dict.fromkeys(COLUMNS)
+                row.update(fields)
+                row.update(stamp=banner_stamp(fields['date'], fields['time']),
+                           txt_path=txt_path, pdf_path=pdf_path,
+                           bytes=st.st_size, completed=st.st_mtime)
+                self.conn.execute(sql, [row[c] for c in COLUMNS])
+                count += 1
+        return count
+
+def catalog_path(path):
+    """
+    Accept either a catalog file or an output directory containing one.
+    """
+    if os.path.isdir(path):
+        return os.path.join(path, CATALOG_NAME)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the psuprinter job catalog.')
+    parser.add_argument("catalog", help="Catalog file, or output directory containing "+CATALOG_NAME+".")
+    parser.add_argument("--user", "-u", help="Jobs for this user.")
+    parser.add_argument("--ujn", help="Jobs with this user job name.")
+    parser.add_argument("--jsn", help="Jobs with this job sequence name.")
+    parser.add_argument("--since", help="Jobs on or after date (YY_MM_DD or YYYY-MM-DD).")
+    parser.add_argument("--until", help="Jobs before date (YY_MM_DD or YYYY-MM-DD).")
+    parser.add_argument("--days", help="Jobs in the last DAYS days.", type=float)
+    parser.add_argument("--limit", help="Show at most LIMIT jobs.", type=int)
+    parser.add_argument("--paths", help="Only list the text file paths.", action='store_true')
+    parser.add_argument("--import", dest='import_dir', metavar='OUTDIR',
+                        help="First add existing spool files in OUTDIR to the catalog.")
+
+    args = parser.parse_args()
+
+    path = catalog_path(args.catalog)
+    if args.import_dir is None and not os.access(path, os.F_OK):
+        print('Error: no catalog:', path)
+        sys.exit(1)
+    catalog = JobCatalog(path)
+
+    if args.import_dir is not None:
+        count = catalog.import_spool(args.import_dir)
+        print('INFO: imported', count, 'spool files from', args.import_dir, file=sys.stderr)
+
+    try:
+        since = None if args.since is None else parse_date_arg(args.since)
+        until = None if args.until is None else parse_date_arg(args.until)
+    except ValueError as e:
+        print('Error:', e)
+        sys.exit(1)
+    if args.days is not None:
+        since = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - args.days*86400))
+
+    rows = catalog.query(user=args.user, ujn=args.ujn, jsn=args.jsn,
+                         since=since, until=until, limit=args.limit)
+    for row in rows:
+        if args.paths:
+            print(row['txt_path'])
+        else:
+            pages = '' if row['pages'] is None else row['pages']
+            print('%-19s %-7s %-7s %-7s %6s %10s  %s'%(row['stamp'] or '', row['user'], row['ujn'], row['jsn'],
+                                                      pages, row['bytes'], row['txt_path']))
+    catalog.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Checkpoints of the job being received.
+
+While a job is being received, psuprinter records from time to time where
+it has got to: the fields parsed from the banner page, the spool file and
+how much has been written to it, and any part line not yet written. The
+checkpoint is a small JSON file in the output directory. It is replaced
+atomically, and written to disk before it replaces the previous one, so
+even after a power cut it holds either the previous checkpoint or the new
+one, never a mixture. It is removed when the job is finished.
+
+If psuprinter dies in the middle of a job, the checkpoint is found when it
+is next started and the job is finished off from it: its spool file is
+completed and the job rendered to PDF and cataloged like any other.
+"""
+import os
+import json
+import time
+import zlib
+import lzma
+
+# Checkpoint file name, relative to the output directory.
+CHECKPOINT_NAME = 'psucheckpoint.json'
+
+# Version of the checkpoint contents.
+CHECKPOINT_VERSION = 1
+
+class Checkpoint(object):
+    """
+    The checkpoint file of a psuprinter.
+    """
+
+    def __init__(self, path, interval=5.0, say=print):
+        """
+        Checkpoint to file path, no more often than every interval seconds
+        unless forced. Problems are reported with say, called like print().
+        """
+        super(Checkpoint,self).__init__()
+        self.path = path
+        self.say = say
+        self.interval = interval
+        self.t_saved = 0.0
+
+    def due(self):
+        """
+        Is it time for another checkpoint?
+        """
+        return time.time() - self.t_saved >= self.interval
+
+    def save(self, fields):
+        """
+        Replace the checkpoint with the dict fields.
+        """
+        fields = dict(fields, version=CHECKPOINT_VERSION, saved=time.time())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(fields, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        _sync_dir(os.path.dirname(self.path) or '.')
+        self.t_saved = fields['saved']
+
+    def load(self):
+        """
+        Return the fields of the checkpoint, or None if there is none (or it
+        cannot be used).
+        """
+        try:
+            with open(self.path) as f:
+                fields = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.say('WARNING: ignoring unreadable checkpoint:', self.path, 'Reason:', e)
+            return None
+        if not isinstance(fields, dict) or fields.get('version') != CHECKPOINT_VERSION:
+            self.say('WARNING: ignoring checkpoint of another version:', self.path)
+            return None
+        return fields
+
+    def clear(self):
+        """
+        Remove the checkpoint: no job is being received.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.t_saved = 0.0
+
+def _sync_dir(path):
+    """
+    Make sure the directory path, and so a file just renamed into it, is on
+    disk. Does nothing where directories cannot be opened (Windows).
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_partial(path, compress):
+    """
+    Return as much text as can be decompressed from a spool file compressed
+    with method compress ('gzip' or 'xz') that may not have been finished.
+    The file may hold several gzip members or xz streams.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    data = []
+    while raw:
+        if compress == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = lzma.LZMADecompressor()
+        try:
+            data.append(decompressor.decompress(raw))
+        except (zlib.error, lzma.LZMAError):
+            break
+        if not decompressor.eof:
+            break
+        raw = decompressor.unused_data
+    return b''.join(data).decode('utf-8', 'replace')
@@ -0,0 +1,65 @@
+"""
+NOS 6/12 display code.
+
+NOS text files hold 6 bit display code characters: upper case letters,
+digits and some punctuation. In 6/12 display code, the other ASCII
+characters take two: an escape, 74 or 76 (octal), and another character.
+74 01, 74 02, 74 04 and 74 07 are @, ^, : and `; 76 01 to 76 32 are the
+lower case letters, 76 33 to 76 37 are {, |, }, ~ and DEL, and 76 40 to
+76 77 are the control characters NUL to US.
+
+A 6/12 file sent to PSU without first being converted to 8 bit ASCII (as
+FCOPY with PC=ASCII64,NC=ASCII8 does) arrives with each escape shown as the
+display code character for it: 74 is @ and 76 is ^. So "Hello" arrives as
+"H^E^L^L^O". decode() turns such text back into ASCII.
+"""
+# Display code characters (64 character set), in code order.
+DISPLAY_CODE = ':ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+-*/()$= ,.#[]%"_!&\'?<>@\\^;'
+
+def _escapes():
+    """
+    Return a dict mapping each escape pair, as received, to the ASCII
+    character it stands for.
+    """
+    table = {'@A': '@', '@B': '^', '@D': ':', '@G': '`'}
+    for code in range(1, 64):
+        if code <= 26:
+            ascii = chr(ord('a') + code - 1)
+        elif code <= 31:
+            ascii = '{|}~\x7f'[code - 27]
+        else:
+            ascii = chr(code - 32)
+        table['^' + DISPLAY_CODE[code]] = ascii
+    return table
+
+# Escape pairs and what they stand for.
+ESCAPES = _escapes()
+
+# The character after a 76 escape, as received, and what the pair stands
+# for, except for the pairs whose second character is itself an escape.
+_CARET = dict((pair[1], ascii) for pair, ascii in ESCAPES.items() if pair[0] == '^' and pair[1] not in '^@')
+
+# 74 escape pairs, in the order to replace them: 74 01 last, as it stands
+# for @, which could otherwise make a pair with the next character.
+_AT = [(pair, ESCAPES[pair]) for pair in ('@B', '@D', '@G', '@A')]
+
+def decode(text):
+    """
+    Return 6/12 display code text (as received from PSU) as ASCII.
+
+    Any amount of text can be decoded at once, in a few passes over it.
+    Pairs are taken from the left, so ^^A is ^^ then A. An escape
+    character not followed by one that makes a pair with it is left as
+    it is.
+    """
+    if '^' in text:
+        # Runs of escapes first, so that every ^ left starts a pair or is
+        # left as it is. Nothing decodes to ^ or @.
+        text = text.replace('^^', ESCAPES['^^']).replace('^@', ESCAPES['^@'])
+        parts = text.split('^')
+        text = parts[0] + ''.join([_CARET[part[0]] + part[1:] if part[:1] in _CARET else '^' + part
+                                   for part in parts[1:]])
+    if '@' in text:
+        for pair, ascii in _AT:
+            text = text.replace(pair, ascii)
+    return text
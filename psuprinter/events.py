@@ -0,0 +1,200 @@
+"""
+Job event log and console view.
+
+psuprinter reports what it does as events: start and stop, connecting to
+PSU (connect, connected, disconnected), each job's banner fields when it
+starts (job_start), its byte and line counts when it has been received
+(job_received) and its page count and timings when it has been rendered
+(job_end), and every message shown on the console (message, or psu for
+what PSU said). An EventLog writes each event as a line of JSON (a "JSON lines"
+file), so other programs can follow what psuprinter is doing without
+scraping its console output, e.g.:
+
+    {"t": 1729779071.52, "event": "job_start", "ok": true, "display_code": false,
+     "name": "NICK.AAJ0.AAG0.24_10_01.14_11_00", "user": "NICK", ...}
+
+Messages for the terminal go through a Console rather than straight to
+print(). It shows no more than rate lines a second; the rest are counted
+and the count shown instead.
+
+Both are written by a thread of their own from a bounded queue, so a slow
+disk or pipe, or a terminal that has been paused (e.g. with ^S), never
+holds up receiving from PSU. If a queue fills up, what does not fit is
+dropped and counted rather than waited for; the event log then has a
+dropped event with the count.
+"""
+import abc
+import sys
+import json
+import time
+import queue
+import threading
+
+# Events and console lines that can be waiting to be written.
+EVENT_QUEUE = 10000
+CONSOLE_QUEUE = 1000
+
+# Seconds to wait on exit for what is queued to be written.
+CLOSE_TIMEOUT = 5.0
+
+class _Writer(abc.ABC):
+    """
+    A queue of items written out by a thread of its own. Subclasses say
+    how to write an item.
+    """
+
+    def __init__(self, stream, size, name):
+        """
+        Write items put on a queue of size to stream in a thread called name.
+        """
+        super(_Writer,self).__init__()
+        self.stream = stream
+        self.queue = queue.Queue(size)
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.work, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        """
+        Queue item to be written. Never waits: if the queue is full, item is
+        dropped.
+        """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def take_dropped(self):
+        """
+        Return the number of items dropped since last called.
+        """
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    def work(self):
+        """
+        Writer thread: write items until closed.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.write(item)
+                if self.queue.empty():
+                    self.stream.flush()
+            except (OSError, ValueError):
+                # Nowhere to write to any more. Keep emptying the queue.
+                pass
+        self.finish()
+
+    @abc.abstractmethod
+    def write(self, item):
+        """
+        Write item to the stream. Called in the writer thread.
+        """
+
+    def finish(self):
+        """
+        Called in the writer thread when closed.
+        """
+        try:
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """
+        Write what is queued, waiting up to timeout seconds for it to be.
+        """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+class EventLog(_Writer):
+    """
+    Events written to a file as JSON lines.
+    """
+
+    def __init__(self, path):
+        """
+        Append events to file path.
+        """
+        super(EventLog,self).__init__(open(path, 'a', encoding='utf-8'), EVENT_QUEUE, 'events')
+
+    def emit(self, event, **fields):
+        """
+        Log an event of kind event with fields. The time is added.
+        """
+        self.put(dict(t=round(time.time(), 3), event=event, **fields))
+
+    def write(self, fields):
+        dropped = self.take_dropped()
+        if dropped:
+            self.stream.write(json.dumps({'t': fields['t'], 'event': 'dropped', 'count': dropped}) + '\n')
+        self.stream.write(json.dumps(fields, default=str) + '\n')
+
+    def finish(self):
+        dropped = self.take_dropped()
+        try:
+            if dropped:
+                self.stream.write(json.dumps({'t': round(time.time(), 3), 'event': 'dropped', 'count': dropped}) + '\n')
+        except (OSError, ValueError):
+            pass
+        super(EventLog,self).finish()
+        self.stream.close()
+
+class Console(_Writer):
+    """
+    Console messages, written at no more than rate lines a second.
+    """
+
+    def __init__(self, stream=None, rate=20):
+        """
+        Write lines to stream (default standard output), at most rate a
+        second (0: no limit).
+        """
+        super(Console,self).__init__(stream or sys.stdout, CONSOLE_QUEUE, 'console')
+        self.rate = rate
+        self.t_second = 0.0
+        self.nsecond = 0
+        self.suppressed = 0
+
+    def say(self, *args):
+        """
+        Show args on the console, separated by spaces like print().
+        """
+        self.put(' '.join(str(arg) for arg in args))
+
+    def write(self, line):
+        now = time.monotonic()
+        if now - self.t_second >= 1.0:
+            self.report()
+            self.t_second = now
+            self.nsecond = 0
+        if self.rate > 0 and self.nsecond >= self.rate:
+            self.suppressed += 1
+            return
+        self.nsecond += 1
+        self.stream.write(line + '\n')
+
+    def report(self):
+        """
+        Show how many lines were not shown, if any.
+        """
+        self.suppressed += self.take_dropped()
+        if self.suppressed:
+            self.stream.write('WARNING: %d console lines not shown.\n'%self.suppressed)
+            self.suppressed = 0
+
+    def finish(self):
+        try:
+            self.report()
+        except (OSError, ValueError):
+            pass
+        super(Console,self).finish()
@@ -0,0 +1,176 @@
+"""
+Post-job hooks.
+
+After a job has been received and its PDF made, each hook is run for it in
+a small thread pool, so hooks never hold up receiving or rendering. A hook
+is either a shell command or a Python function:
+
+    cp {pdf} /mnt/share/          Command. {txt}, {pdf}, {name}, {user}, {ujn},
+                                  {jsn}, {date} and {time} are replaced by
+                                  the job's (shell quoted) values. Other
+                                  braces are left as they are.
+    py:mymodule:myfunction        Function, called with the Job.
+
+A hook that runs for longer than the timeout is reported. Commands are
+killed. A Python function cannot be, so it keeps its place in the pool
+until it returns, or until the runner is closed, and hung functions
+cannot pile up threads.
+"""
+import re
+import time
+import shlex
+import threading
+import importlib
+import subprocess
+import concurrent.futures
+
+# Job fields that can be put in a command.
+COMMAND_FIELD = re.compile(r'\{(txt|pdf|name|user|ujn|jsn|date|time)\}')
+
+# Seconds between checks for the end of a Python hook that timed out.
+STRAGGLER_WAIT = 1.0
+
+class Hook(object):
+    """
+    One hook, with counts and timings of its runs.
+    """
+
+    def __init__(self, spec):
+        """
+        Make a hook from its specification. Raises ValueError or ImportError
+        if a Python function cannot be found.
+        """
+        super(Hook,self).__init__()
+        self.spec = spec
+        self.func = None
+        if spec.startswith('py:'):
+            modname, sep, funcname = spec[3:].rpartition(':')
+            if not modname or not funcname:
+                raise ValueError('bad hook (use py:MODULE:FUNCTION): '+spec)
+            self.func = getattr(importlib.import_module(modname), funcname)
+            if not callable(self.func):
+                raise ValueError('hook is not callable: '+spec)
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.max_delay = 0.0
+
+    def command(self, job):
+        """
+        Return the shell command to run for job.
+        """
+        fields = dict(txt=job.path_name, pdf=job.pdf_path, name=job.name(), user=job.user,
+                      ujn=job.ujn, jsn=job.jsn, date=job.date, time=job.time)
+        return COMMAND_FIELD.sub(lambda m: shlex.quote(fields[m.group(1)] or ''), self.spec)
+
+    def run(self, job, timeout):
+        """
+        Run the hook for job. Return (error, thread): an error message, or
+        None if it worked, and the thread of a Python function still running
+        after timing out, or None.
+        """
+        if self.func is None:
+            try:
+                result = subprocess.run(self.command(job), shell=True, timeout=timeout,
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+            except subprocess.TimeoutExpired:
+                return 'timed out', None
+            if result.returncode != 0:
+                return 'exit status %d: %s'%(result.returncode, result.stdout.decode('utf-8', 'replace').strip()), None
+            return None, None
+
+        # Run the function in its own thread so that it can be abandoned.
+        error = []
+        def call():
+            try:
+                self.func(job)
+            except Exception as e:
+                error.append(repr(e))
+        thread = threading.Thread(target=call, name='hook', daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            return 'timed out', thread
+        return (error[0] if error else None), None
+
+    def record(self, seconds, delay, error):
+        """
+        Count a run that took seconds, started delay seconds after the job
+        was ready and failed with error (or None).
+        """
+        with self.lock:
+            self.runs += 1
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self.max_delay = max(self.max_delay, delay)
+            if error == 'timed out':
+                self.timeouts += 1
+            elif error is not None:
+                self.failures += 1
+
+class HookRunner(object):
+    """
+    Runs hooks for finished jobs in a pool of worker threads.
+    """
+
+    def __init__(self, specs, workers=2, timeout=60.0, say=print):
+        """
+        Make hooks from their specifications (see Hook). Failures are
+        reported with say, called like print().
+        """
+        super(HookRunner,self).__init__()
+        self.say = say
+        self.hooks = [Hook(spec) for spec in specs]
+        self.timeout = timeout
+        # Set when closed, to stop waiting for Python hooks that timed out.
+        self.closing = threading.Event()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hooks')
+
+    def submit(self, job):
+        """
+        Queue every hook to run for job. Returns at once.
+        """
+        t_ready = time.perf_counter()
+        for hook in self.hooks:
+            self.pool.submit(self.run, hook, job, t_ready)
+
+    def run(self, hook, job, t_ready):
+        """
+        Run one hook for one job, in a worker thread.
+        """
+        t0 = time.perf_counter()
+        try:
+            error, thread = hook.run(job, self.timeout)
+        except Exception as e:
+            error, thread = repr(e), None
+        t1 = time.perf_counter()
+        hook.record(t1 - t0, t0 - t_ready, error)
+        if error is not None:
+            self.say('ERROR: hook', hook.spec, 'failed for', job.name(), 'Reason:', error)
+        # Keep this worker until a Python function that timed out returns.
+        while thread is not None and thread.is_alive() and not self.closing.is_set():
+            thread.join(STRAGGLER_WAIT)
+
+    def close(self, wait=True):
+        """
+        Stop taking jobs, by default waiting for queued hooks to finish.
+        Python hooks that timed out are no longer waited for.
+        """
+        self.closing.set()
+        self.pool.shutdown(wait=wait)
+
+    def report(self):
+        """
+        Return a table of each hook's runs and timings.
+        """
+        lines = ['%6s %6s %6s %10s %10s %10s  %s'%('Runs', 'Failed', 'Timed', 'Mean s', 'Max s', 'Max wait', 'Hook')]
+        for hook in self.hooks:
+            with hook.lock:
+                mean = hook.seconds / hook.runs if hook.runs else 0.0
+                lines.append('%6d %6d %6d %10.3f %10.3f %10.3f  %s'%(hook.runs, hook.failures, hook.timeouts,
+                                                                    mean, hook.max_seconds, hook.max_delay, hook.spec))
+        return '\n'.join(lines)
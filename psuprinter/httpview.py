@@ -0,0 +1,306 @@
+"""
+Local HTTP server for watching psuprinter jobs.
+
+    /               Active and recent jobs.
+    /tail/NAME      Text of job NAME, streamed as it is received.
+    /pdf/NAME       PDF of finished job NAME, made now if there is a PDF
+                    cache (see pdfcache.py) and it has not been.
+    /pdf/NAME.partNN.pdf
+                    Volume NN of the PDF of job NAME, if it was split.
+    /search?q=...   Search the text of all jobs, if there is a search index.
+    /archive/ID     PDF of job ID in the search index.
+
+NAME is the output file name without its extension. Text is sent from each
+job's ring of recent lines (see job.py), never by reading the spool files,
+except for the lines of search hits.
+"""
+import os
+import re
+import html
+import shutil
+import threading
+import collections
+import urllib.parse
+import http.server
+
+try:
+    from psuprinter.search import search, hit_lines, job_pdf, job_txt
+except ImportError:
+    from search import search, hit_lines, job_pdf, job_txt
+
+# Number of finished jobs listed.
+RECENT_JOBS = 50
+
+# Seconds between keep-alive checks while a viewer waits for more output.
+FOLLOW_WAIT = 15
+
+# Name of a volume of a job's PDF, as linked to from its index.
+VOLUME_NAME = re.compile(r'(.*)\.part\d+\.pdf$')
+
+# Number of search hits shown.
+SEARCH_HITS = 200
+
+class JobServer(object):
+    """
+    HTTP server in a background thread, showing the jobs it is told about.
+    """
+
+    def __init__(self, address, port):
+        """
+        Start serving on address:port.
+        """
+        super(JobServer,self).__init__()
+        self.lock = threading.Lock()
+        self.active = None
+        self.recent = collections.deque(maxlen=RECENT_JOBS)
+        # Search index file (see search.py), if any.
+        self.search_path = None
+        # PDF cache (a PdfCache) to make PDFs of jobs that have none, if any.
+        self.pdfcache = None
+        handler = type('JobRequestHandler', (JobRequestHandler,), {'jobserver': self})
+        self.httpd = http.server.ThreadingHTTPServer((address, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='httpview', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Stop serving.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def start_job(self, job):
+        """
+        Note the job now being received.
+        """
+        with self.lock:
+            if self.active is not None:
+                self.recent.appendleft(self.active)
+            self.active = job
+
+    def end_job(self, job):
+        """
+        Note that a job has been received and rendered.
+        """
+        with self.lock:
+            if self.active is job:
+                self.active = None
+                self.recent.appendleft(job)
+
+    def jobs(self):
+        """
+        Return the active job, if any, then recent jobs, newest first.
+        """
+        with self.lock:
+            if self.active is None:
+                return list(self.recent)
+            return [self.active] + list(self.recent)
+
+    def find(self, name):
+        """
+        Return the active or recent job called name, or None.
+        """
+        for job in self.jobs():
+            if job.name() == name:
+                return job
+        return None
+
+class JobRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Request handler. jobserver is set in a subclass made by JobServer.
+    """
+    jobserver = None
+    protocol_version = 'HTTP/1.1'
+    server_version = 'psuprinter'
+
+    def log_message(self, format, *args):
+        """
+        Keep quiet: psuprinter's output is for the printer.
+        """
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        if path == '/':
+            self.send_index()
+            return
+        if self.jobserver.search_path is not None:
+            if path == '/search':
+                self.send_search(urllib.parse.parse_qs(url.query).get('q', [''])[0])
+                return
+            if path.startswith('/archive/'):
+                self.send_archive(path[len('/archive/'):])
+                return
+        parts = path.strip('/').split('/')
+        job = None
+        if len(parts) == 2:
+            job = self.jobserver.find(parts[1])
+            volume = VOLUME_NAME.match(parts[1])
+            if job is None and parts[0] == 'pdf' and volume is not None:
+                job = self.jobserver.find(volume.group(1))
+                if job is not None:
+                    self.send_pdf(job, parts[1])
+                    return
+        if job is None:
+            self.send_error(404, 'No such job')
+        elif parts[0] == 'tail':
+            self.send_tail(job)
+        elif parts[0] == 'pdf':
+            self.send_pdf(job)
+        else:
+            self.send_error(404)
+
+    def send_body(self, ctype, body):
+        """
+        Send a complete response.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_index(self):
+        """
+        List active and recent jobs.
+        """
+        rows = []
+        for job in self.jobserver.jobs():
+            name = html.escape(job.name())
+            quoted = urllib.parse.quote(job.name())
+            if not job.done:
+                state = 'receiving'
+            elif job.pdf_path or self.jobserver.pdfcache is not None:
+                state = '<a href="/pdf/%s">PDF</a>'%quoted
+            else:
+                state = 'received'
+            rows.append('<tr><td><a href="/tail/%s">%s</a></td><td>%d</td><td>%d</td><td>%s</td></tr>'%(
+                quoted, name, job.nlines, job.nbytes, state))
+        body = ('<!DOCTYPE html>\n<html><head><title>psuprinter</title></head><body>\n' + self.search_form('') +
+                '<table>\n<tr><th>Job</th><th>Lines</th><th>Bytes</th><th></th></tr>\n' +
+                '\n'.join(rows) + '\n</table>\n</body></html>\n')
+        self.send_body('text/html; charset=utf-8', body.encode('utf-8'))
+
+    def search_form(self, query):
+        """
+        Return the HTML of a search box, if there is a search index.
+        """
+        if self.jobserver.search_path is None:
+            return ''
+        return ('<form action="/search"><input name="q" size="60" value="%s"> '
+                '<input type="submit" value="Search"></form>\n'%html.escape(query))
+
+    def send_search(self, query):
+        """
+        Show the lines matching query, newest job first.
+        """
+        rows = []
+        message = ''
+        if query:
+            try:
+                hits = hit_lines(search(self.jobserver.search_path, query, limit=SEARCH_HITS))
+            except Exception as e:
+                hits = []
+                message = '<p>%s</p>\n'%html.escape(str(e))
+            for hit in hits:
+                name = html.escape(hit['name'])
+                if hit['pdf_path'] or self.jobserver.pdfcache is not None:
+                    name = '<a href="/archive/%d#page=%d">%s</a>'%(hit['id'], hit['page'], name)
+                rows.append('<tr><td>%s</td><td>%d</td><td>%d</td><td><pre>%s</pre></td></tr>'%(
+                    name, hit['page'], hit['line'], html.escape(hit['text'] or '')))
+            if not hits and not message:
+                message = '<p>Not found.</p>\n'
+        body = ('<!DOCTYPE html>\n<html><head><title>psuprinter search</title></head><body>\n' +
+                '<p><a href="/">Jobs</a></p>\n' + self.search_form(query) + message +
+                '<table>\n<tr><th>Job</th><th>Page</th><th>Line</th><th></th></tr>\n' +
+                '\n'.join(rows) + '\n</table>\n</body></html>\n')
+        self.send_body('text/html; charset=utf-8', body.encode('utf-8'))
+
+    def send_archive(self, job_id):
+        """
+        Send the PDF of a job in the search index.
+        """
+        pdfcache = self.jobserver.pdfcache
+        try:
+            if pdfcache is not None:
+                txt_path = job_txt(self.jobserver.search_path, int(job_id))
+                if txt_path is None:
+                    raise ValueError(job_id)
+                f = pdfcache.open_pdf(txt_path)
+            else:
+                pdf_path = job_pdf(self.jobserver.search_path, int(job_id))
+                if not pdf_path:
+                    raise ValueError(job_id)
+                f = open(pdf_path, 'rb')
+        except (ValueError, OSError):
+            self.send_error(404, 'No PDF')
+            return
+        self.send_file('application/pdf', f)
+
+    def send_file(self, ctype, f):
+        """
+        Send the whole of open file f, and close it. The file is copied to
+        the client a block at a time, as a PDF may be very large.
+        """
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def send_chunk(self, data):
+        """
+        Send one chunk of a chunked response.
+        """
+        self.wfile.write(b'%x\r\n%s\r\n'%(len(data), data))
+        self.wfile.flush()
+
+    def send_tail(self, job):
+        """
+        Stream the text of job: the lines still in its ring, then new
+        lines as they arrive, until it has all been received.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        count = 0
+        try:
+            while True:
+                lines, newcount, done = job.follow(count, FOLLOW_WAIT)
+                if newcount - len(lines) > count:
+                    self.send_chunk(b'[... %d lines not shown ...]\n'%(newcount - len(lines) - count))
+                if lines:
+                    self.send_chunk(''.join(lines).encode('utf-8'))
+                count = newcount
+                if done:
+                    break
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_pdf(self, job, volume=None):
+        """
+        Send the PDF of a finished job, or the volume of it called volume.
+        """
+        pdfcache = self.jobserver.pdfcache
+        if not job.done or not (job.pdf_path or pdfcache is not None):
+            self.send_error(404, 'No PDF (yet)')
+            return
+        try:
+            if pdfcache is not None:
+                f = pdfcache.open_pdf(job.path_name, volume)
+            elif volume is not None:
+                f = open(os.path.join(os.path.dirname(job.pdf_path), volume), 'rb')
+            else:
+                f = open(job.pdf_path, 'rb')
+        except FileNotFoundError:
+            self.send_error(404, 'No PDF')
+            return
+        except OSError as e:
+            self.send_error(500, str(e))
+            return
+        self.send_file('application/pdf', f)
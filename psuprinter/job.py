@@ -0,0 +1,124 @@
+"""
+Print job records.
+"""
+import io
+import os
+import time as _time
+import threading
+import collections
+import itertools
+
+try:
+    from psuprinter.spool import spool_stem, read_spool
+except ImportError:
+    from spool import spool_stem, read_spool
+
+# Number of recent lines of output kept in memory for live viewers.
+RING_LINES = 2000
+
+class Job(object):
+    """
+    One print job received from PSU: the fields parsed from its banner
+    page, the output file paths and the counts and timings gathered
+    while it was received and rendered.
+    """
+
+    def __init__(self, user, ujn, jsn, date, time, path_name, subdir='', ring=False):
+        """
+        Start a job record when the output file is opened. subdir is the
+        directory of the output file relative to the output directory.
+        Recent lines are only kept for live viewers if ring is true.
+        """
+        super(Job,self).__init__()
+
+        # Banner page fields.
+        self.user = user
+        self.ujn = ujn
+        self.jsn = jsn
+        self.date = date
+        self.time = time
+
+        # Output files.
+        self.path_name = path_name
+        self.file_name = os.path.basename(path_name)
+        self.subdir = subdir
+        self.pdf_path = ''
+        # Text of the job (UTF-8) if it was kept in memory rather than in
+        # the output file (see receiver.py).
+        self.body = None
+
+        # Counts.
+        self.nbytes = 0
+        self.nlines = 0
+        self.nforms = 0
+        self.npages = 0
+
+        # Timings (seconds).
+        self.t_open = _time.time()
+        self.t_close = None
+        self.receive_secs = 0.0
+        self.render_secs = 0.0
+
+        # Ring of recent output lines for live viewers (None if there are
+        # none), and the number of lines ever added to it. Readers wait on
+        # the condition.
+        self.ring = collections.deque(maxlen=RING_LINES) if ring else None
+        self.nring = 0
+        self.done = False
+        self.changed = threading.Condition()
+
+    def add_output(self, text):
+        """
+        Count text (one or more lines) written to the output file.
+        """
+        self.nbytes += len(text)
+        self.nlines += text.count('\n')
+        self.nforms += text.count('\f')
+        if self.ring is None:
+            return
+        lines = text.splitlines(True)
+        with self.changed:
+            self.ring.extend(lines)
+            self.nring += len(lines)
+            self.changed.notify_all()
+
+    def received(self):
+        """
+        Note that all of the job has been received.
+        """
+        self.t_close = _time.time()
+        self.receive_secs = self.t_close - self.t_open
+        with self.changed:
+            self.done = True
+            self.changed.notify_all()
+
+    def follow(self, since, timeout=None):
+        """
+        Return (lines, count, done): the lines added after the first since
+        (as many of them as are still in the ring), the number of lines
+        added so far and whether the job has been received. Wait up to
+        timeout seconds for something new if there is nothing yet.
+        """
+        with self.changed:
+            if self.nring <= since and not self.done:
+                self.changed.wait(timeout)
+            if self.ring is None:
+                return [], self.nring, self.done
+            first = self.nring - len(self.ring)
+            lines = list(itertools.islice(self.ring, max(0, since - first), None))
+            return lines, self.nring, self.done
+
+    def open_body(self):
+        """
+        Open the text of the job for reading as bytes: from memory if it was
+        kept there, otherwise from the output file.
+        """
+        if self.body is not None:
+            return io.BytesIO(self.body)
+        return read_spool(self.path_name)
+
+    def name(self):
+        """
+        Job name: the output file name without its extensions.
+        """
+        return spool_stem(self.file_name)
@@ -0,0 +1,287 @@
+#! /usr/bin/env python3
+"""
+PDF files made on demand.
+
+With --lazy-pdf, psuprinter writes only the text file of each job. Its PDF
+is made the first time someone asks for it, through the live view
+(/pdf/NAME) or with psupdf, and put where psuprinter would have put it.
+Most listings are never looked at as PDF, so this saves the time spent
+making them.
+
+PDF files are then a cache: a PDF not asked for in max_age seconds is
+removed, as are the least recently asked for when they come to more than
+max_bytes, whenever a PDF is made (or with psupdf --evict). Only PDF files
+whose text file is still there, so that they can be made again, are ever
+removed, and never one being made or opened. When a PDF was last asked for
+is kept as its modification time.
+
+When a PDF is made, its path is recorded in the catalog and search index,
+if there are any (psupdf looks for them under their usual names in the
+output directory), so that psujobs and the live view's search find it.
+
+The text2pdf options psuprinter uses are saved in the output directory
+(psupdf.json), so that psupdf makes the same PDF files.
+
+Run as a program, this makes (if need be) and prints the path of the PDF
+of each job named, e.g.:
+
+    psupdf spool NICK.AAJA.AAGC.24_10_06.14_11_18
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+
+try:
+    from psuprinter.text2pdf import PyText2Pdf
+    from psuprinter.spool import spool_files, spool_stem, pdf_for, pdf_volumes, parse_spool_name
+    from psuprinter.catalog import JobCatalog, CATALOG_NAME
+    from psuprinter.search import SEARCH_NAME, record_pdf
+except ImportError:
+    from text2pdf import PyText2Pdf
+    from spool import spool_files, spool_stem, pdf_for, pdf_volumes, parse_spool_name
+    from catalog import JobCatalog, CATALOG_NAME
+    from search import SEARCH_NAME, record_pdf
+
+# Settings file name, relative to the output directory.
+SETTINGS_NAME = 'psupdf.json'
+
+# Default limits: a week and a gigabyte.
+MAX_AGE = 7 * 24 * 3600.0
+MAX_BYTES = 1024 * 1024 * 1024
+
+class PdfCache(object):
+    """
+    PDF files of the jobs in a spool, made when first asked for.
+    """
+
+    def __init__(self, outdir, args=None, max_age=MAX_AGE, max_bytes=MAX_BYTES, say=print, made=None):
+        """
+        Cache PDFs of jobs in output directory outdir, made with text2pdf
+        options args, and save those settings. If args is None, use the
+        settings saved by psuprinter instead. Problems are reported with
+        say, called like print(). made(txt_path, pdf_path, pages), if
+        given, is called when a PDF has been made. Raises OSError or
+        ValueError if the settings cannot be saved or read.
+        """
+        super(PdfCache,self).__init__()
+        self.outdir = outdir
+        self.say = say
+        self.made = made
+        self.settings_path = os.path.join(outdir, SETTINGS_NAME)
+        if args is None:
+            with open(self.settings_path) as f:
+                settings = json.load(f)
+            if not isinstance(settings, dict) or not isinstance(settings.get('args'), list):
+                raise ValueError('bad settings file: '+self.settings_path)
+            args = settings['args']
+            max_age = settings.get('max_age', max_age)
+            max_bytes = settings.get('max_bytes', max_bytes)
+        else:
+            tmp = self.settings_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'args': args, 'max_age': max_age, 'max_bytes': max_bytes}, f)
+            os.replace(tmp, self.settings_path)
+        self.args = args
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        # One lock per PDF, so that it is only made once when asked for
+        # twice, kept until the PDF is evicted. Then the number of callers
+        # making or opening each PDF, which is not evicted while they are.
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.busy = {}
+
+    def pdf_path(self, txt_path):
+        """
+        Where the PDF of text file txt_path goes.
+        """
+        return pdf_for(self.outdir, txt_path)
+
+    def get(self, txt_path):
+        """
+        Return the PDF file of text file txt_path, making it if need be.
+        Raises OSError if it cannot be made. The file may be evicted once
+        this returns: use open_pdf() to read it.
+        """
+        with self.using(txt_path) as pdf_path:
+            return pdf_path
+
+    def open_pdf(self, txt_path, volume=None):
+        """
+        Open the PDF file of text file txt_path for reading, making it if
+        need be, or its volume file called volume. Raises OSError if it
+        cannot be made, FileNotFoundError if there is no such volume.
+        """
+        with self.using(txt_path) as pdf_path:
+            if volume is not None:
+                pdf_path = os.path.join(os.path.dirname(pdf_path), volume)
+            return open(pdf_path, 'rb')
+
+    @contextlib.contextmanager
+    def using(self, txt_path):
+        """
+        Context manager: make the PDF file of text file txt_path if need be
+        and give its path. It is not evicted until the block ends.
+        """
+        pdf_path = self.pdf_path(txt_path)
+        with self.lock:
+            lock = self.locks.setdefault(pdf_path, threading.Lock())
+            self.busy[pdf_path] = self.busy.get(pdf_path, 0) + 1
+        try:
+            with lock:
+                if os.access(pdf_path, os.F_OK):
+                    # Note when it was last asked for.
+                    now = time.time()
+                    os.utime(pdf_path, (now, now))
+                    converter = None
+                else:
+                    converter = self.render(txt_path, pdf_path)
+            if converter is not None:
+                if self.made is not None:
+                    self.made(txt_path, pdf_path, converter._pagesDone or converter._pageNo)
+                self.evict()
+            yield pdf_path
+        finally:
+            with self.lock:
+                self.busy[pdf_path] -= 1
+                if not self.busy[pdf_path]:
+                    del self.busy[pdf_path]
+
+    def render(self, txt_path, pdf_path):
+        """
+        Make the PDF file pdf_path of text file txt_path. Return the converter.
+        """
+        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+        # text2pdf exits on errors, so catch that as well as exceptions.
+        try:
+            converter = PyText2Pdf()
+            converter.parse_args([txt_path] + self.args + ['-o', pdf_path])
+            converter.convert()
+        except (Exception, SystemExit) as e:
+            # Do not leave part of a PDF to be found next time.
+            for path in pdf_volumes(pdf_path) + [pdf_path]:
+                if os.access(path, os.F_OK):
+                    os.remove(path)
+            raise OSError('cannot make PDF of %s: %s'%(txt_path, e))
+        return converter
+
+    def entries(self):
+        """
+        Return (last used, bytes, PDF path) of each PDF file that can be
+        made again, least recently used first.
+        """
+        pdfdir = os.path.join(self.outdir, 'PDF')
+        result = []
+        for dirpath, dirnames, filenames in os.walk(pdfdir):
+            reldir = os.path.relpath(dirpath, pdfdir)
+            for name in filenames:
+                stem, ext = os.path.splitext(name)
+                if ext != '.pdf' or parse_spool_name(stem + '.txt') is None:
+                    continue
+                txt_stem = os.path.normpath(os.path.join(self.outdir, reldir, stem + '.txt'))
+                if not any(os.access(txt_stem + suffix, os.F_OK) for suffix in ('', '.gz', '.xz')):
+                    continue
+                pdf_path = os.path.join(dirpath, name)
+                try:
+                    used = os.path.getmtime(pdf_path)
+                    size = sum(os.path.getsize(path) for path in [pdf_path] + pdf_volumes(pdf_path))
+                except OSError:
+                    continue
+                result.append((used, size, pdf_path))
+        result.sort()
+        return result
+
+    def evict(self):
+        """
+        Remove PDF files (other than any being made or opened) not used for
+        max_age seconds, then the least recently used until there are no
+        more than max_bytes of them. Return the number removed.
+        """
+        entries = self.entries()
+        total = sum(size for used, size, pdf_path in entries)
+        now = time.time()
+        removed = 0
+        for used, size, pdf_path in entries:
+            if now - used < self.max_age and total <= self.max_bytes:
+                break
+            # Remove it with the lock held, so that no one can start using
+            # it in the meantime.
+            with self.lock:
+                if pdf_path in self.busy:
+                    continue
+                try:
+                    for path in pdf_volumes(pdf_path) + [pdf_path]:
+                        os.remove(path)
+                except OSError as e:
+                    self.say('WARNING: cannot remove', pdf_path, 'Reason:', e)
+                    continue
+                self.locks.pop(pdf_path, None)
+            total -= size
+            removed += 1
+        return removed
+
+def spool_recorder(outdir):
+    """
+    Return a function recording a PDF that has been made (see PdfCache) in
+    the catalog and search index in outdir, if there are any.
+    """
+    catalog_path = os.path.join(outdir, CATALOG_NAME)
+    search_path = os.path.join(outdir, SEARCH_NAME)
+    def made(txt_path, pdf_path, pages):
+        try:
+            if os.access(catalog_path, os.F_OK):
+                catalog = JobCatalog(catalog_path)
+                catalog.set_pdf(txt_path, pdf_path, pages)
+                catalog.close()
+            if os.access(search_path, os.F_OK):
+                record_pdf(search_path, txt_path, pdf_path)
+        except Exception as e:
+            print('WARNING: cannot record', pdf_path, 'Reason:', e)
+    return made
+
+def find_job(outdir, name):
+    """
+    Return the text file of job name (USER.UJN.JSN.DATE.TIME) in the spool
+    in outdir, whatever its layout, or None.
+    """
+    for txt_path, fields in spool_files(outdir):
+        if spool_stem(os.path.basename(txt_path)) == name:
+            return txt_path
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Make PDF files of psuprinter jobs spooled with --lazy-pdf.')
+    parser.add_argument("outdir", help="Output (spool) directory.")
+    parser.add_argument("name", nargs='*', help="Job name (USER.UJN.JSN.DATE.TIME), or text file.")
+    parser.add_argument("--evict", help="Remove PDF files no longer wanted by the cache limits.", action='store_true')
+
+    args = parser.parse_args()
+
+    try:
+        cache = PdfCache(args.outdir, made=spool_recorder(args.outdir))
+    except (OSError, ValueError) as e:
+        print('Error: no psuprinter settings in', args.outdir, 'Reason:', e)
+        sys.exit(1)
+
+    status = 0
+    for name in args.name:
+        txt_path = name if os.access(name, os.F_OK) else find_job(args.outdir, name)
+        if txt_path is None:
+            print('Error: no such job:', name)
+            status = 1
+            continue
+        try:
+            print(cache.get(txt_path))
+        except OSError as e:
+            print('Error:', e)
+            status = 1
+    if args.evict:
+        print('INFO: removed', cache.evict(), 'PDF files.', file=sys.stderr)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Per-job profiling for psuprinter and text2pdf.
+
+A Profiler records named timing spans. Spans nest: the time reported for a
+span is its own ("self") time, not counting spans inside it, so the spans of
+a job add up to the time spent in them. Each job can also be run under
+cProfile or tracemalloc.
+"""
+import io
+import os
+import time
+import cProfile
+import pstats
+import tracemalloc
+
+# Python profilers a job can be run under.
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+
+# Number of functions or allocation sites listed in a job's report.
+REPORT_LINES = 30
+
+# Cross-job summary file name, relative to the output directory.
+SUMMARY_NAME = 'psuprofile.txt'
+
+class _Span(object):
+    """
+    Context manager timing one span of a Profiler.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.children = 0.0
+        self.profiler.stack.append(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.t0
+        stack = self.profiler.stack
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        self.profiler.add(self.name, elapsed - self.children)
+        return False
+
+class Profiler(object):
+    """
+    Timing spans for the current job, totals over all jobs and, if mode
+    is one of PROFILE_MODES, a Python profile of each job.
+    """
+
+    def __init__(self, mode=None):
+        super(Profiler,self).__init__()
+        if mode is not None and mode not in PROFILE_MODES:
+            raise ValueError('unknown profile mode: '+mode)
+        self.mode = mode
+        self.stack = []
+        # Span name: [count, seconds] for the current job.
+        self.spans = {}
+        # Span name: [jobs, seconds, most seconds in a job] over all jobs.
+        self.totals = {}
+        self.njobs = 0
+        self.t_job = None
+        self.cprofile = None
+
+    def span(self, name):
+        """
+        Return a context manager timing span name.
+        """
+        return _Span(self, name)
+
+    def add(self, name, seconds):
+        """
+        Add time to span name.
+        """
+        entry = self.spans.get(name)
+        if entry is None:
+            self.spans[name] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def begin_job(self):
+        """
+        Start profiling a job. Spans recorded since the last job ended
+        (e.g. finding the banner page) count towards this one.
+        """
+        self.t_job = time.perf_counter()
+        if self.mode == 'cprofile':
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        elif self.mode == 'tracemalloc':
+            tracemalloc.start()
+
+    def end_job(self, stem):
+        """
+        Finish profiling a job. Write its report to stem.prof.txt (and
+        its cProfile data to stem.pstats) and add its spans to the totals.
+        Return the report file name.
+        """
+        elapsed = time.perf_counter() - self.t_job
+        lines = ['Job: ' + os.path.basename(stem), 'Elapsed: %.3f s'%elapsed, '',
+                 self.table(((name, count, secs) for name, (count, secs) in self.spans.items()),
+                            ('Span', 'Count', 'Seconds'), elapsed)]
+
+        if self.mode == 'cprofile' and self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(stem + '.pstats')
+            out = io.StringIO()
+            pstats.Stats(self.cprofile, stream=out).sort_stats('cumulative').print_stats(REPORT_LINES)
+            lines.extend(('', out.getvalue()))
+            self.cprofile = None
+        elif self.mode == 'tracemalloc' and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines.extend(('', 'Memory: %d bytes at end, %d bytes peak'%(current, peak), ''))
+            for stat in snapshot.statistics('lineno')[:REPORT_LINES]:
+                lines.append(str(stat))
+
+        self.njobs += 1
+        for name, (count, secs) in self.spans.items():
+            entry = self.totals.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += secs
+            entry[2] = max(entry[2], secs)
+        self.spans = {}
+
+        report = stem + '.prof.txt'
+        with open(report, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return report
+
+    def table(self, rows, headings, total=None):
+        """
+        Format (name, count, seconds) rows, slowest first.
+        """
+        rows = sorted(rows, key=lambda row: -row[2])
+        out = ['%-16s %8s %10s'%headings]
+        for name, count, secs in rows:
+            pct = '' if not total else ' %5.1f%%'%(100.0*secs/total)
+            out.append('%-16s %8d %10.4f%s'%(name, count, secs, pct))
+        return '\n'.join(out)
+
+    def summary(self):
+        """
+        Return a report of the spans over all jobs.
+        """
+        lines = ['Jobs: %d'%self.njobs, '',
+                 '%-16s %6s %10s %10s %10s'%('Span', 'Jobs', 'Seconds', 'Mean', 'Max')]
+        for name, (jobs, secs, most) in sorted(self.totals.items(), key=lambda item: -item[1][1]):
+            lines.append('%-16s %6d %10.4f %10.4f %10.4f'%(name, jobs, secs, secs/jobs, most))
+        return '\n'.join(lines) + '\n'
+
+    def write_summary(self, outdir):
+        """
+        Write the summary over all jobs to the output directory.
+        """
+        with open(os.path.join(outdir, SUMMARY_NAME), 'w') as f:
+            f.write(self.summary())
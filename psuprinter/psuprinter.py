@@ -4,14 +4,52 @@
 import socket
 import errno
 import select
+import selectors
 import time
 import re
 import sys
 import os
-import subprocess
 import argparse
 import unicodedata
 import re
+import contextlib
+import threading
+import collections
+
+try:
+    from psuprinter.text2pdf import PyText2Pdf
+    from psuprinter.catalog import JobCatalog, CATALOG_NAME
+    from psuprinter.job import Job
+    from psuprinter.spool import DirCache, check_layout, shard_dir, spool_stem, open_spool, COMPRESSORS
+    from psuprinter.httpview import JobServer
+    from psuprinter.profiling import Profiler, PROFILE_MODES
+    from psuprinter.hooks import HookRunner
+    from psuprinter.ttfont import load_font
+    from psuprinter.checkpoint import Checkpoint, CHECKPOINT_NAME, read_partial
+    from psuprinter.scheduler import RenderScheduler
+    from psuprinter.search import SearchIndex, SEARCH_NAME
+    from psuprinter.displaycode import decode as decode_display_code
+    from psuprinter.events import EventLog, Console
+    from psuprinter.pdfcache import PdfCache
+except ImportError:
+    # Run as a script from the package directory.
+    from text2pdf import PyText2Pdf
+    from catalog import JobCatalog, CATALOG_NAME
+    from job import Job
+    from spool import DirCache, check_layout, shard_dir, spool_stem, open_spool, COMPRESSORS
+    from httpview import JobServer
+    from profiling import Profiler, PROFILE_MODES
+    from hooks import HookRunner
+    from ttfont import load_font
+    from checkpoint import Checkpoint, CHECKPOINT_NAME, read_partial
+    from scheduler import RenderScheduler
+    from search import SearchIndex, SEARCH_NAME
+    from displaycode import decode as decode_display_code
+    from events import EventLog, Console
+    from pdfcache import PdfCache
+
+# Span used when not profiling.
+_NOSPAN = contextlib.nullcontext()
 
 def remove_control_characters(s):
     """
@@ -73,6 +111,82 @@ class psu_printer( object ):
         self.landscape = True
         self.greenbar = False
         self.economy = False
+        self.effectors = False
+        self.xrefstream = False
+        self.linearize = False
+        self.jobs = 1
+        self.volume_pages = 0
+
+        # TrueType font file to embed in PDF files instead of Courier-Bold, if any.
+        self.font_file = None
+
+        # Whether to make PDF files of jobs. With a PDF cache (a PdfCache),
+        # they are only made when asked for.
+        self.pdf = True
+        self.pdfcache = None
+
+        # Where the text of each job goes: None for a spool file in outdir,
+        # or a callable taking the Job and returning a file-like object to
+        # write it to, or None if it cannot (see receiver.py).
+        self.sink = None
+
+        # Job catalog (a JobCatalog), if any.
+        self.catalog = None
+
+        # Spool text compression method (see spool.py) and level, if any.
+        self.compress = None
+        self.compress_level = None
+
+        # HTTP server for watching jobs (a JobServer), if any.
+        self.server = None
+
+        # Profiler (see profiling.py), if any.
+        self.profiler = None
+
+        # Post-job hooks (a HookRunner), if any.
+        self.hooks = None
+
+        # Checkpoint (a Checkpoint), if any, the last snapshot of the job being
+        # received for it, and a lock for writing it from render threads.
+        self.checkpoint = None
+        self.receiving = None
+        self.checkpoint_lock = threading.Lock()
+
+        # Render scheduler (a RenderScheduler), if jobs are rendered in the background.
+        self.scheduler = None
+
+        # Full-text search index (a SearchIndex), if any.
+        self.index = None
+
+        # Jobs whose names match this compiled regular expression are 6/12
+        # display code, to be decoded to ASCII (see displaycode.py). None for none.
+        self.display_code = None
+        # Whether the job being received is.
+        self.display_job = False
+
+        # Console view (a Console) messages go through, if any, else they are
+        # printed. Event log (an EventLog), if any.
+        self.console = None
+        self.events = None
+        # Whether to show messages at all. They are still logged as events.
+        self.messages = True
+
+        # Seconds without input during a job before looking for a held back
+        # end of listing line (0: never), and before giving up on the job
+        # and closing it anyway (0: never).
+        self.idle_timeout = 5.0
+        self.quiet_timeout = 0.0
+        self.t_last_data = time.time()
+        self.selector = None
+
+        # Spool directory layout (see spool.py) and directories known to exist.
+        self.layout = ''
+        self.dirs = DirCache()
+
+        # Connection to PSU, once made, and jobs received not yet passed on
+        # by receive().
+        self.psu = None
+        self.finished = collections.deque()
 
         # Initial state.
         self.old_state = 0
@@ -83,9 +197,21 @@ class psu_printer( object ):
     def process_print_jobs(self):
         """
         Loop, maintaining and responding to state.
-        Parse the PSU output, creating files in outdir.
+        Parse the PSU output, creating files in outdir, until PSU closes
+        the connection.
+        """
+        for job in self.receive():
+            pass
+
+    def receive(self):
+        """
+        Generator: connect to PSU and parse its output, yielding each Job
+        once it has been received (and, unless rendered in the background,
+        rendered). Returns when PSU closes the connection.
         """
         while True:
+            while self.finished:
+                yield self.finished.popleft()
             self.print_state()
 
             # If not connected, connect.
@@ -94,21 +220,35 @@ class psu_printer( object ):
                 
                 # Connect to PSU.
                 while self.state == self.UNCONNECTED:
-                    print('INFO: Attempting to connect to host.')
+                    self.say('INFO: Attempting to connect to host.')
+                    self.event('connect', host=self.hostname, port=self.port)
                     self.psu = self.connect_to_psu()
                     if self.psu is None:
-                        print('INFO: Waiting', self.twait, 'seconds before trying to connect again.')
+                        self.say('INFO: Waiting', self.twait, 'seconds before trying to connect again.')
                         time.sleep(self.twait)
                         self.twait = min(2*self.twait, 200)
                     else:
+                        self.event('connected', host=self.hostname, port=self.port)
                         self.state = self.CONNECTED
+                        self.selector = selectors.DefaultSelector()
+                        self.selector.register(self.psu, selectors.EVENT_READ)
                         
             elif self.state == self.CONNECTED:
                 # On connection, process PSU output. Read all available data.
 
                 while True:
                     self.print_state()
-                    bytedata = self.psu.recv(2048)
+                    # Only time waits in the middle of a job, not for the next one.
+                    with self.span('socket wait' if self.state == self.BANNER_PARSED else None):
+                        ready = self.selector.select(self.select_timeout())
+                        if ready:
+                            bytedata = self.psu.recv(2048)
+                    if not ready:
+                        self.idle()
+                        while self.finished:
+                            yield self.finished.popleft()
+                        continue
+                    self.t_last_data = time.time()
 
                     # If we didn't get any bytes, the connection has closed. Exit.
                     if len(bytedata) == 0:
@@ -116,9 +256,13 @@ class psu_printer( object ):
                         try:
                             self.psu.close()
                         except Exception as e:
-                            print('ERROR: psu.close(): failed, reason:', e)
-                        print('INFO: Host has closed the connection. Exiting.')
-                        sys.exit(0)
+                            self.say('ERROR: psu.close(): failed, reason:', e)
+                        self.psu = None
+                        self.say('INFO: Host has closed the connection. Exiting.')
+                        self.event('disconnected', host=self.hostname, port=self.port)
+                        while self.finished:
+                            yield self.finished.popleft()
+                        return
 
                     # Process the received data according to the current state.
                     # Each "state processor" should eat as much of the input data as possible.
@@ -126,26 +270,68 @@ class psu_printer( object ):
                     else:
                         stringdata = _bytestostr(bytedata)
                         
-                        # If CONNECTED, locate marker of login, transition to LOGGING_IN.
-                        if self.state == self.CONNECTED:
-                            self.find_login_marker(stringdata)
+                        with self.span('parse'):
+                            # If CONNECTED, locate marker of login, transition to LOGGING_IN.
+                            if self.state == self.CONNECTED:
+                                self.find_login_marker(stringdata)
 
-                        # If LOGGING_IN, locate end of login page, transition to LOGGED_IN.
-                        elif self.state == self.LOGGING_IN:
-                            self.find_login_end(stringdata)
+                            # If LOGGING_IN, locate end of login page, transition to LOGGED_IN.
+                            elif self.state == self.LOGGING_IN:
+                                self.find_login_end(stringdata)
 
-                        # If LOGGED_IN, parse the banner page, open output file, transition to BANNER_PARSED.
-                        elif self.state == self.LOGGED_IN:
-                            self.banner_parse(stringdata)
+                            # If LOGGED_IN, parse the banner page, open output file, transition to BANNER_PARSED.
+                            elif self.state == self.LOGGED_IN:
+                                with self.span('banner'):
+                                    self.banner_parse(stringdata)
 
-                        # If BANNER_PARSED, locate end of user output, transition to FILE_DONE.
-                        elif self.state == self.BANNER_PARSED:
-                            self.process_pages(stringdata)         
+                            # If BANNER_PARSED, locate end of user output, transition to FILE_DONE.
+                            elif self.state == self.BANNER_PARSED:
+                                self.process_pages(stringdata)         
+
+                            # If FILE_DONE, close the output file, transition to LOGGED_IN.
+                            elif self.state == self.FILE_DONE:
+                                self.close_output_file()
+
+                    while self.finished:
+                        yield self.finished.popleft()
+
+    def shutdown(self):
+        """
+        Finish off on exit: let queued renders and hooks run and report on
+        them, then stop the HTTP server and close the catalog and any
+        connection to PSU.
+        """
+        if self.psu is not None:
+            try:
+                self.psu.close()
+            except Exception as e:
+                self.say('ERROR: psu.close(): failed, reason:', e)
+            self.psu = None
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        if self.scheduler is not None:
+            if self.scheduler.pending():
+                self.say('INFO: waiting for', len(self.scheduler.pending()), 'jobs to be rendered.')
+            self.scheduler.close()
+            self.say('INFO: render queue:', self.scheduler.report())
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        if self.index is not None:
+            self.index.close()
+        if self.hooks is not None:
+            self.hooks.close()
+            self.say('INFO: hooks:')
+            self.say(self.hooks.report())
+        if self.catalog is not None:
+            self.catalog.close()
+        self.event('stop')
+        if self.events is not None:
+            self.events.close()
+        if self.console is not None:
+            self.console.close()
 
-                        # If FILE_DONE, close the output file, transition to LOGGED_IN.
-                        elif self.state == self.FILE_DONE:
-                            self.close_output_file()
-                
     def connect_to_psu(self):
         """
         Open a connection to PSU on hostname.
@@ -156,9 +342,35 @@ class psu_printer( object ):
             sock.connect((self.hostname, self.port))
             return sock
         except Exception as e:
-            print('ERROR: connect_to_psu(): failed, reason:', e)
+            self.say('ERROR: connect_to_psu(): failed, reason:', e)
             return None
 
+    def say(self, *args, event='message'):
+        """
+        Show a message on the console, like print(args), and log it as an
+        event (by default a 'message' event).
+        """
+        if self.messages:
+            if self.console is not None:
+                self.console.say(*args)
+            else:
+                print(*args, flush=True)
+        self.event(event, text=' '.join(str(arg) for arg in args).strip())
+
+    def event(self, event, **fields):
+        """
+        Log an event with fields, if there is an event log.
+        """
+        if self.events is not None:
+            self.events.emit(event, **fields)
+
+    def job_fields(self, job):
+        """
+        Event fields for job: its name, banner fields and spool file.
+        """
+        return dict(name=job.name(), user=job.user, ujn=job.ujn, jsn=job.jsn,
+                    date=job.date, time=job.time, path=job.path_name)
+
     def print_state(self):
         """
         Debug: display state name.
@@ -170,7 +382,7 @@ class psu_printer( object ):
                      self.BANNER_PARSED : 'BANNER_PARSED',
                      self.FILE_DONE     : 'FILE_DONE'}
         if self.debug and (self.state != self.old_state):
-            print('New state:',statedict[self.state])
+            self.say('New state:',statedict[self.state])
             self.old_state = self.state
 
     def clear_parsed_items(self):
@@ -184,40 +396,299 @@ class psu_printer( object ):
         self.user = ''
         self.file_name = ''
         self.path_name = ''
+        self.subdir = ''
         self.parsed_items = 0
         self.banner_buffer = ''
         self.fout = None
+        self.job = None
 
     def close_output_file(self):
         """
-        Close any open output file. Clear parsed items.
+        Close any open output file, convert it to PDF and catalog the job
+        (or queue it for that with a scheduler). Clear parsed items.
         """
         if self.fout is not None:
             self.fout.close()
-            self.make_pdf()
-            print('INFO: output completed.')
+            self.job.received()
+            self.finished.append(self.job)
+            self.event('job_received', name=self.job.name(), bytes=self.job.nbytes, lines=self.job.nlines,
+                       forms=self.job.nforms, receive_secs=round(self.job.receive_secs, 3))
+            if self.index is not None:
+                self.index.end_job()
+            if self.scheduler is not None:
+                self.scheduler.submit(self.job)
+                # Only receiving the job is profiled.
+                if self.profiler is not None:
+                    self.end_profile()
+                self.say('INFO: output received, queued for rendering.')
+            else:
+                self.finish_job(self.job)
+                if self.profiler is not None:
+                    self.end_profile()
+                self.say('INFO: output completed.')
+            self.receiving = None
+            self.write_checkpoint()
         self.clear_parsed_items()
         self.state = self.LOGGED_IN
 
-    def make_pdf(self):
+    def finish_job(self, job):
         """
-        Convert the output file to PDF format.
+        Convert a received job to PDF, catalog it and run its hooks. With a
+        scheduler, this is called in a render thread.
         """
-        outpdfdir = os.path.join(self.outdir, 'PDF')
-        if not os.access(outpdfdir, os.F_OK):
+        t0 = time.time()
+        if self.pdfcache is not None or not self.pdf:
+            # Made when first asked for, or not at all.
+            ok = False
+        else:
+            with self.span('pdf'):
+                ok = self.make_pdf(job)
+        if ok:
+            job.render_secs = time.time() - t0
+            if self.index is not None:
+                self.index.set_pdf(job.path_name, job.pdf_path)
+        if self.catalog is not None:
             try:
-                os.makedirs(outpdfdir)
+                with self.span('catalog'):
+                    self.catalog.add_job(job)
             except Exception as e:
-                print('Cannot create:', outpdfdir, 'Reason:', e)
-                return False
-        filen,ext = os.path.splitext(self.file_name)
-        outpdffile = filen + '.pdf'
-        outpdfpath = os.path.join(outpdfdir, outpdffile)
-        topdfpgm = os.path.join(os.path.dirname(__file__),'text2pdf.py')
-        cmd = [ 'python',
-                topdfpgm,             # Conversion program file name.
-                self.path_name,       # Input ASCII text file name.
-                '-c', '137',          # Characters per line before wrapping.
+                self.say('ERROR: cannot add job to catalog. Reason:', e)
+        if self.server is not None:
+            self.server.end_job(job)
+        self.event('job_end', ok=ok, pdf=job.pdf_path, pages=job.npages, bytes=job.nbytes, lines=job.nlines,
+                   forms=job.nforms, receive_secs=round(job.receive_secs, 3),
+                   render_secs=round(job.render_secs, 3), **self.job_fields(job))
+        if self.hooks is not None:
+            self.hooks.submit(job)
+
+    def rendered(self, job):
+        """
+        Called in a render thread when a job has been finished.
+        """
+        self.say('INFO: output completed:', job.name())
+        self.write_checkpoint()
+
+    def pdf_made(self, txt_path, pdf_path, pages):
+        """
+        Called by the PDF cache when it has made the PDF of a job: record
+        it in the search index and catalog.
+        """
+        self.say('INFO: created PDF output file:', pdf_path)
+        if self.index is not None:
+            self.index.set_pdf(txt_path, pdf_path)
+        if self.catalog is not None:
+            try:
+                self.catalog.set_pdf(txt_path, pdf_path, pages)
+            except Exception as e:
+                self.say('ERROR: cannot update catalog. Reason:', e)
+
+    def page_lines(self):
+        """
+        Lines per PDF page with the current options.
+        """
+        if self.landscape:
+            return 89 if self.economy else 67
+        return 117 if self.economy else 88
+
+    def span(self, name):
+        """
+        Return a context manager timing span name if profiling and name is not None.
+        Only the main thread is profiled.
+        """
+        if self.profiler is None or name is None or threading.current_thread() is not threading.main_thread():
+            return _NOSPAN
+        return self.profiler.span(name)
+
+    def save_checkpoint(self, force=False):
+        """
+        Checkpoint the job being received, if checkpointing and it is time to
+        (or force).
+        """
+        if self.checkpoint is None or self.fout is None or self.sink is not None:
+            return
+        if not force and not self.checkpoint.due():
+            return
+        with self.span('checkpoint'):
+            try:
+                # What the checkpoint says has been written must be in the file.
+                # An xz stream cannot be flushed part way, so start another.
+                if self.compress == 'xz':
+                    self.fout.close()
+                    self.fout = open_spool(self.path_name, self.compress, self.compress_level, append=True)
+                else:
+                    self.fout.flush()
+                self.receiving = {
+                    'state': self.state,
+                    'user': self.user, 'ujn': self.ujn, 'jsn': self.jsn,
+                    'date': self.date, 'time': self.time,
+                    'file_name': self.file_name, 'path_name': self.path_name, 'subdir': self.subdir,
+                    'compress': self.compress,
+                    'offset': os.path.getsize(self.path_name),
+                    'nbytes': self.job.nbytes,
+                    'text': self.text,
+                    't_open': self.job.t_open}
+            except Exception as e:
+                self.say('ERROR: cannot write checkpoint. Reason:', e)
+                return
+            self.write_checkpoint()
+
+    def write_checkpoint(self):
+        """
+        Write the checkpoint: the last snapshot of the job being received and
+        the jobs waiting to be rendered. Remove it if there are neither.
+        """
+        if self.checkpoint is None:
+            return
+        with self.checkpoint_lock:
+            pending = []
+            if self.scheduler is not None:
+                for job in self.scheduler.pending():
+                    pending.append({'user': job.user, 'ujn': job.ujn, 'jsn': job.jsn,
+                                    'date': job.date, 'time': job.time,
+                                    'path_name': job.path_name, 'subdir': job.subdir,
+                                    't_open': job.t_open, 't_close': job.t_close})
+            try:
+                if self.receiving is None and not pending:
+                    self.checkpoint.clear()
+                else:
+                    self.checkpoint.save(dict(self.receiving or {'state': self.LOGGED_IN}, pending=pending))
+            except Exception as e:
+                self.say('ERROR: cannot write checkpoint. Reason:', e)
+
+    def recover(self):
+        """
+        Finish off jobs an earlier run had not finished when it died, from its
+        checkpoint: render those it had received, and complete the spool file
+        of the one it was part way through receiving, then make the PDF,
+        catalog it etc. as for any other job. PSU does not resend the rest of
+        a job on a new connection, so that cannot be continued.
+        """
+        if self.checkpoint is None:
+            return
+        fields = self.checkpoint.load()
+        if fields is None:
+            return
+
+        for pending in fields.get('pending', []):
+            self.recover_pending(pending)
+
+        if fields.get('state') == self.BANNER_PARSED:
+            self.recover_receiving(fields)
+        self.write_checkpoint()
+        self.state = self.UNCONNECTED
+
+    def recover_pending(self, fields):
+        """
+        Render a job that had been received but not rendered.
+        """
+        path_name = fields['path_name']
+        if not os.access(path_name, os.F_OK):
+            self.say('WARNING: checkpointed job has no spool file, ignoring:', path_name)
+            return
+        self.say('INFO: rendering job received in an earlier run:', path_name)
+        job = Job(fields['user'], fields['ujn'], fields['jsn'], fields['date'], fields['time'],
+                  path_name, fields['subdir'])
+        job.t_open = fields['t_open']
+        job.t_close = fields['t_close']
+        job.receive_secs = job.t_close - job.t_open
+        try:
+            if path_name.endswith('.txt'):
+                with open(path_name, 'rb') as f:
+                    text = f.read().decode('utf-8', 'replace')
+            else:
+                text = read_partial(path_name, 'gzip' if path_name.endswith(COMPRESSORS['gzip']) else 'xz')
+            job.nbytes = len(text)
+            job.nlines = text.count('\n')
+            job.nforms = text.count('\f')
+        except Exception as e:
+            self.say('ERROR: cannot read spool file:', path_name, 'Reason:', e)
+        if self.scheduler is not None:
+            self.scheduler.submit(job)
+        else:
+            self.finish_job(job)
+            self.say('INFO: output completed.')
+
+    def recover_receiving(self, fields):
+        """
+        Complete the spool file of a job that was part way through being
+        received and finish the job.
+        """
+        if not os.access(fields['path_name'], os.F_OK):
+            self.say('WARNING: checkpointed job has no spool file, ignoring:', fields['path_name'])
+            return
+        self.say('INFO: finishing job interrupted in an earlier run:', fields['path_name'])
+
+        for name in ('user', 'ujn', 'jsn', 'date', 'time', 'file_name', 'path_name', 'subdir'):
+            setattr(self, name, fields[name])
+        self.job = Job(self.user, self.ujn, self.jsn, self.date, self.time, self.path_name, self.subdir,
+                       ring=self.server is not None)
+        self.job.t_open = fields['t_open']
+        self.display_job = self.is_display_code(self.job)
+
+        # A part line not yet written when the checkpoint was made is added,
+        # unless more was written after the checkpoint (which completed it)
+        # or some of what was written then has been lost. A part end of
+        # listing line is left out as usual.
+        compress = fields['compress']
+        try:
+            if compress:
+                # The end of the compressed data is likely to be missing. Write
+                # out again whatever can be read.
+                text = read_partial(self.path_name, compress)
+                if len(text) < fields['nbytes']:
+                    self.say('WARNING: lost the end of', self.path_name)
+                elif len(text) == fields['nbytes'] and not self.is_trailer(fields['text']):
+                    text += self.decoded(fields['text'])
+                self.fout = open_spool(self.path_name, compress, self.compress_level)
+                self.fout.write(text)
+                self.job.nbytes = len(text)
+                self.job.nlines = text.count('\n')
+                self.job.nforms = text.count('\f')
+            else:
+                with open(self.path_name, 'rb') as f:
+                    data = f.read()
+                self.fout = open(self.path_name, 'a')
+                self.job.nbytes = len(data)
+                self.job.nlines = data.count(b'\n')
+                self.job.nforms = data.count(b'\f')
+                if len(data) < fields['offset']:
+                    self.say('WARNING: lost the end of', self.path_name)
+                elif len(data) == fields['offset'] and not self.is_trailer(fields['text']):
+                    part = self.decoded(fields['text'])
+                    self.fout.write(part)
+                    self.job.add_output(part)
+        except Exception as e:
+            self.say('ERROR: cannot recover spool file:', self.path_name, 'Reason:', e)
+            self.fout = None
+
+        if self.profiler is not None:
+            self.profiler.begin_job()
+        if self.server is not None:
+            self.server.start_job(self.job)
+        if self.fout is not None:
+            self.close_output_file()
+        else:
+            self.clear_parsed_items()
+            self.receiving = None
+
+    def end_profile(self):
+        """
+        Write the profile of the job just finished and the summary over all jobs.
+        """
+        stem = os.path.join(os.path.dirname(self.path_name), self.job.name())
+        try:
+            report = self.profiler.end_job(stem)
+            self.profiler.write_summary(self.outdir)
+            self.say('INFO: wrote profile:', report)
+        except Exception as e:
+            self.say('ERROR: cannot write profile. Reason:', e)
+
+    def pdf_options(self):
+        """
+        Return the text2pdf options for the PDF files, other than the input
+        and output files.
+        """
+        cmd = [ '-c', '137',          # Characters per line before wrapping.
                 '-T', '137',          # Characters per line before truncation.
                 '-l', '67',           # Lines per page.
                 '-F',                 # Use ^L to signal a page break.
@@ -226,8 +697,7 @@ class psu_printer( object ):
                 '-q',                 # Quiet mode.
                 '-A', 'CDC Printer Support Utility',
                 '-S', 'CDC NOS 2 Output',
-                '-f', 'Courier-Bold', # Font to use. Non-bold looks a bit "thin".
-                '-o', outpdfpath]     # Output PDF file name.
+                '-f', 'Courier-Bold'] # Font to use. Non-bold looks a bit "thin".
         if self.economy:
             cmd.append( '-v' )        # In economy mode, space lines by 6 units.
             cmd.append( '6' )
@@ -245,17 +715,57 @@ class psu_printer( object ):
             cmd.append( '102' )       # ... still use -c characters for line movement logic.
         if self.greenbar:
             cmd.append( '-G' )        # Greenbar paper mode.
+        if self.effectors:
+            cmd.append( '-E' )        # CDC column 1 format effectors.
+        if self.xrefstream:
+            cmd.append( '-X' )        # Object and cross-reference streams.
+        if self.linearize:
+            cmd.append( '--linearize' ) # Linearized ("fast web view") PDF.
+        if self.jobs != 1:
+            cmd.append( '-j' )        # Render big jobs in this many processes.
+            cmd.append( str(self.jobs) )
+        if self.font_file:
+            cmd.append( '--ttf' )     # Embed this TrueType font.
+            cmd.append( self.font_file )
+        if self.volume_pages:
+            cmd.append( '--volume' )  # Split into volumes of this many pages.
+            cmd.append( str(self.volume_pages) )
+        return cmd
+
+    def make_pdf(self, job):
+        """
+        Convert the output file of job to PDF format.
+        """
+        outpdfdir = os.path.join(self.outdir, 'PDF', job.subdir)
         try:
-            retstring = subprocess.check_output(cmd, universal_newlines=True)
-            print('INFO: created PDF output file:',outpdfpath)
-            print(retstring)
-            return True
+            self.dirs.ensure(outpdfdir)
         except Exception as e:
-            print('lp2pdf run failed. Reason:', e)
-            print(' cmd was:',cmd)
+            self.say('Cannot create:', outpdfdir, 'Reason:', e)
+            self.dirs.forget()
+            return False
+        outpdffile = spool_stem(job.file_name) + '.pdf'
+        outpdfpath = os.path.join(outpdfdir, outpdffile)
+        cmd = [job.path_name] + self.pdf_options() + ['-o', outpdfpath]
+
+        # Run the converter in-process with the same arguments as its command line.
+        # It exits on I/O errors, so catch that as well as exceptions.
+        try:
+            converter = PyText2Pdf()
+            converter.parse_args(cmd)
+            if threading.current_thread() is threading.main_thread():
+                converter._profiler = self.profiler
+            converter.convert()
+            job.pdf_path = outpdfpath
+            job.npages = converter._pagesDone or converter._pageNo
+            if converter._volumes:
+                self.say('INFO: created PDF output file:',outpdfpath,'indexing',len(converter._volumes),'volumes')
+            else:
+                self.say('INFO: created PDF output file:',outpdfpath)
+            return True
+        except (Exception, SystemExit) as e:
+            self.say('text2pdf run failed. Reason:', e)
+            self.say(' args were:',cmd)
             return False
-        
-        return True
 
     def find_login_marker(self, stringdata):
         """
@@ -267,7 +777,7 @@ class psu_printer( object ):
             line = self.text[0:match.end()]
             printline = remove_control_characters(line.strip())
             if len(printline.strip()) > 0:
-                print(printline)
+                self.say(printline, event='psu')
             self.text = self.text[match.end():]
             if line.startswith('PRINTER SUPPORT UTILITY'):
                 self.state = self.LOGGING_IN
@@ -286,7 +796,8 @@ class psu_printer( object ):
             self.state = self.LOGGED_IN
             self.print_state()
             self.text = self.text[match.end():]
-            self.banner_parse('')
+            with self.span('banner'):
+                self.banner_parse('')
             return
 
     def trim_leading_ff(self, banner_buffer):
@@ -339,24 +850,55 @@ class psu_printer( object ):
             # If all required information has been found, try to create an output file.
             if self.parsed_items == 5:
                 self.file_name = self.user+'.'+self.ujn+'.'+self.jsn+'.'+self.date+'.'+self.time+'.txt'
-                self.path_name = os.path.join(self.outdir, self.file_name)
-                self.fout = open(self.path_name, 'w')
+                if self.compress:
+                    self.file_name += COMPRESSORS[self.compress]
+                self.subdir = shard_dir(self.layout, self.user, self.ujn, self.jsn, self.date, self.time)
+                outdir = os.path.join(self.outdir, self.subdir)
+                self.path_name = os.path.join(outdir, self.file_name)
+                self.job = Job(self.user, self.ujn, self.jsn, self.date, self.time, self.path_name, self.subdir,
+                               ring=self.server is not None)
+                if self.sink is None:
+                    try:
+                        self.dirs.ensure(outdir)
+                    except Exception as e:
+                        # Maybe a directory was removed behind our back. Check them all again next time.
+                        self.say('ERROR: cannot create:', outdir, 'Reason:', e)
+                        self.dirs.forget()
+                    self.fout = open_spool(self.path_name, self.compress, self.compress_level)
+                else:
+                    self.fout = self.sink(self.job)
+                self.display_job = self.is_display_code(self.job)
+                if self.index is not None:
+                    self.index.begin_job(self.path_name, self.job.name())
+                if self.profiler is not None:
+                    self.profiler.begin_job()
+                if self.server is not None:
+                    self.server.start_job(self.job)
+                self.event('job_start', ok=self.fout is not None, display_code=self.display_job,
+                           **self.job_fields(self.job))
                 if self.fout is not None:
-                    print('\nINFO: created output file:',self.path_name,flush=True)
+                    self.say('\nINFO: created output file:',self.path_name)
+                    if self.display_job:
+                        self.say('INFO: decoding 6/12 display code.')
                 else:
-                    print('ERROR: failed to create output file:',self.path_name,flush=True)
+                    self.say('ERROR: failed to create output file:',self.path_name)
 
                 # If pre-open banner page lines have been accumulated, write them out first.
                 if len(self.banner_buffer) > 0:
                     if self.fout is not None:
-                        self.fout.write(self.trim_leading_ff(self.banner_buffer))
-                        self.fout.flush()
+                        banner_text = self.trim_leading_ff(self.banner_buffer)
+                        with self.span('spool write'):
+                            self.fout.write(banner_text)
+                            if not self.compress:
+                                self.fout.flush()
+                        self.record_output(banner_text)
                     self.banner_buffer = ''
 
                 # Reset for next banner page and start reading/writing all remaining input lines.
                 self.parsed_items = 0
                 self.state = self.BANNER_PARSED
                 self.print_state()
+                self.save_checkpoint(force=True)
                 self.process_pages('')
                 return
             match = re.search('[\f\r\n]', self.text)
@@ -373,25 +915,115 @@ class psu_printer( object ):
         match = re.search('\x1b\\\\', self.text)
         return match
 
+    def is_trailer(self, line):
+        """
+        Is line the end of listing line that ends a job?
+        """
+        return (line.find('** END OF LISTING **') >= 0) and (line.find('UCLP') >= 0)
+
+    def is_display_code(self, job):
+        """
+        Is job in 6/12 display code?
+        """
+        return self.display_code is not None and self.display_code.search(job.name()) is not None
+
+    def decoded(self, text):
+        """
+        Return job text as it is to be written to the output file: decoded
+        to ASCII if the job is in 6/12 display code.
+        """
+        if not self.display_job:
+            return text
+        with self.span('display code'):
+            return decode_display_code(text)
+
+    def record_output(self, text):
+        """
+        Account for text written to the output file: in the job and the search index.
+        """
+        self.job.add_output(text)
+        if self.index is not None:
+            self.index.add(text)
+
+    def select_timeout(self):
+        """
+        How long to wait for input before calling idle(). None to wait for ever.
+        """
+        if self.state != self.BANNER_PARSED:
+            return None
+        timeouts = [t for t in (self.idle_timeout, self.quiet_timeout) if t > 0]
+        if not timeouts:
+            return None
+        return min(timeouts)
+
+    def idle(self):
+        """
+        Nothing has been received for a while in the middle of a job.
+        The end of listing line may have arrived without its line terminator,
+        which PSU can hold back until the next job: if so, finish the job now
+        rather than when the next one starts. If the job has been quiet for
+        quiet_timeout seconds, finish it anyway. Otherwise make sure what has
+        been received so far is in the spool file.
+        """
+        if self.state != self.BANNER_PARSED:
+            return
+        if self.is_trailer(self.text):
+            if self.debug:
+                self.say('INFO: idle: end of listing seen, finishing job.')
+            # The terminator, if it comes later, is taken as the start of the next banner page.
+            self.text = ''
+            self.state = self.FILE_DONE
+            self.print_state()
+            self.close_output_file()
+        elif self.quiet_timeout > 0 and time.time() - self.t_last_data >= self.quiet_timeout:
+            self.say('WARNING: no end of listing after', self.quiet_timeout, 'seconds without input, finishing job.')
+            if self.fout is not None and self.text:
+                text = self.decoded(self.text)
+                self.fout.write(text)
+                self.record_output(text)
+            self.text = ''
+            self.state = self.FILE_DONE
+            self.print_state()
+            self.close_output_file()
+        elif self.fout is not None:
+            self.fout.flush()
+            self.save_checkpoint()
+
     def process_pages(self, stringdata):
         """
         Process output pages, writing output lines until end of file marker is found.
         """
         self.text += stringdata
+        lines = []
         match = self.match_process_pages()
         while match:
             line = self.text[0:match.end()]
             self.text = self.text[match.end():]
-            if (line.find('** END OF LISTING **') >= 0) and (line.find('UCLP') >= 0):
+            if self.is_trailer(line):
+                self.write_lines(lines)
                 self.state = self.FILE_DONE
                 self.print_state()
                 self.close_output_file()
                 return
-            else:
-                if self.fout is not None:
-                    self.fout.write(line)
-                    self.fout.flush()
+            lines.append(line)
             match = self.match_process_pages()
+        self.write_lines(lines)
+        self.save_checkpoint()
+
+    def write_lines(self, lines):
+        """
+        Write whole lines of job text to the output file, decoding them
+        together.
+        """
+        if self.fout is None or not lines:
+            return
+        text = self.decoded(''.join(lines))
+        with self.span('spool write'):
+            self.fout.write(text)
+            # Flushing a compressed stream every time would spoil the compression.
+            if not self.compress:
+                self.fout.flush()
+        self.record_output(text)
 
 def main_core():
     print("\nPSUprinter: CDC PSU client")
@@ -405,7 +1037,52 @@ def main_core():
     parser.add_argument("--portrait", help="Portrait mode printing (def:landscape).", action='store_true')
     parser.add_argument("--greenbar", help="Greenbar paper background (def:plain).", action='store_true')
     parser.add_argument("--economy", help="Reduce space between lines to save paper.", action='store_true')
-    
+    parser.add_argument("--effectors", help="Interpret CDC column 1 format effectors in the PDF output.", action='store_true')
+    parser.add_argument("--xrefstream", help="Compact PDF output using object and cross-reference streams.", action='store_true')
+    parser.add_argument("--linearize", help="Linearized (fast web view) PDF output.", action='store_true')
+    parser.add_argument("--jobs", "-j", help="Render large PDFs in JOBS processes, 0 for one per CPU (def:1).", type=int, default=1)
+    parser.add_argument("--display-code", help="Decode jobs in 6/12 display code to ASCII: all jobs, or those whose names match REGEX.",
+                        nargs='?', const='', metavar='REGEX')
+    parser.add_argument("--volume-pages", help="Split PDFs of more than VOLUME_PAGES pages into volumes (def:0, never).",
+                        type=int, default=0)
+    parser.add_argument("--font-file", help="Embed TrueType font FONT_FILE in PDF files (def: Courier-Bold, not embedded).")
+    parser.add_argument("--compress", help="Compress spool text files (def: not compressed).", choices=sorted(COMPRESSORS))
+    parser.add_argument("--compress-level", help="Compression level, 1-9 for gzip (def:9), 0-9 for xz (def:6).", type=int)
+    parser.add_argument("--layout", help='Spool directory layout, e.g. "{date}/{user}" (def: flat).', default='')
+    parser.add_argument("--catalog", help="Record jobs in an SQLite catalog (def: outdir/"+CATALOG_NAME+").",
+                        nargs='?', const='', metavar='FILE')
+    parser.add_argument("--search", help="Index the text of jobs for psusearch (def: outdir/"+SEARCH_NAME+").",
+                        nargs='?', const='', metavar='FILE')
+    parser.add_argument("--profile", help="Time the phases of each job; write a report next to its output.", action='store_true')
+    parser.add_argument("--profile-mode", help="Also run each job under a Python profiler.", choices=PROFILE_MODES)
+    parser.add_argument("--idle-timeout", help="Seconds without input before finishing a job whose end of listing line "
+                        "has been seen (def:5, 0:never).", type=float, default=5.0)
+    parser.add_argument("--quiet-timeout", help="Seconds without input before finishing a job without an end of listing "
+                        "line (def:0, never).", type=float, default=0.0)
+    parser.add_argument("--checkpoint-interval", help="Seconds between checkpoints of the job being received, "
+                        "used to finish it off if psuprinter dies (def:5, 0:no checkpoints).", type=float, default=5.0)
+    parser.add_argument("--render-threads", help="Render jobs in the background in this many threads, shortest "
+                        "job first (def:0, render each job as it is received).", type=int, default=0)
+    parser.add_argument("--aging", help="With --render-threads, treat a waiting job as this many KB smaller for "
+                        "each second it waits (def:100).", type=float, default=100.0)
+    parser.add_argument("--fast-pages", help="With --render-threads, render jobs of fewer than this many pages in "
+                        "a fast lane of their own (def:0, no fast lane).", type=int, default=0)
+    parser.add_argument("--hook", help="Run HOOK after each job: a shell command, or py:MODULE:FUNCTION. "
+                        "May be repeated.", action='append', default=[])
+    parser.add_argument("--hook-workers", help="Number of hooks run at once (def:2).", type=int, default=2)
+    parser.add_argument("--hook-timeout", help="Seconds a hook may run for (def:60).", type=float, default=60.0)
+    parser.add_argument("--http", help="Serve a live view of jobs over HTTP on [ADDRESS:]PORT (def address: 127.0.0.1).",
+                        metavar='[ADDRESS:]PORT')
+    parser.add_argument("--lazy-pdf", help="Only make the PDF of a job when it is asked for, "
+                        "through --http or psupdf.", action='store_true')
+    parser.add_argument("--pdf-cache-hours", help="With --lazy-pdf, remove PDFs not asked for in this many hours "
+                        "(def:168).", type=float, default=168.0)
+    parser.add_argument("--pdf-cache-mb", help="With --lazy-pdf, keep no more than this many MB of PDFs (def:1024).",
+                        type=float, default=1024.0)
+    parser.add_argument("--events", help="Log job events to FILE as JSON lines.", metavar='FILE')
+    parser.add_argument("--console-rate", help="Show at most this many console messages a second (def:20, 0:no limit).",
+                        type=int, default=20)
+
     args = parser.parse_args()
 
     if args.port is None:
@@ -413,6 +1090,21 @@ def main_core():
     else:
         port = args.port
 
+    try:
+        check_layout(args.layout)
+    except ValueError as e:
+        print('Error:', e)
+        sys.exit(1)
+
+    # Parse the font once now, to report problems before any job. Jobs
+    # then use the cached font.
+    if args.font_file:
+        try:
+            load_font(args.font_file)
+        except (IOError, ValueError) as e:
+            print('Error: cannot use TrueType font:', e)
+            sys.exit(1)
+
     if not os.access(args.outdir, os.F_OK):
         try:
             os.makedirs(args.outdir)
@@ -425,8 +1117,95 @@ def main_core():
     printer.landscape = not args.portrait
     printer.greenbar = args.greenbar
     printer.economy = args.economy
-    
-    printer.process_print_jobs()
+    printer.effectors = args.effectors
+    printer.xrefstream = args.xrefstream
+    printer.linearize = args.linearize
+    printer.jobs = args.jobs
+    printer.font_file = args.font_file
+    printer.volume_pages = max(0, args.volume_pages)
+    if args.display_code is not None:
+        try:
+            printer.display_code = re.compile(args.display_code)
+        except re.error as e:
+            print('Bad --display-code pattern:', args.display_code, 'Reason:', e)
+            sys.exit(1)
+    printer.layout = args.layout
+    printer.compress = args.compress
+    printer.compress_level = args.compress_level
+    printer.idle_timeout = args.idle_timeout
+    printer.quiet_timeout = args.quiet_timeout
+    if args.profile or args.profile_mode:
+        printer.profiler = Profiler(args.profile_mode)
+
+    if args.catalog is not None:
+        catalog_path = args.catalog or os.path.join(args.outdir, CATALOG_NAME)
+        try:
+            printer.catalog = JobCatalog(catalog_path)
+        except Exception as e:
+            print('Cannot open catalog:', catalog_path, 'Reason:', e)
+            sys.exit(1)
+
+    if args.lazy_pdf:
+        try:
+            printer.pdfcache = PdfCache(args.outdir, printer.pdf_options(), max_age=args.pdf_cache_hours*3600,
+                                        max_bytes=int(args.pdf_cache_mb*1024*1024), say=printer.say,
+                                        made=printer.pdf_made)
+        except Exception as e:
+            print('Cannot set up PDF cache in:', args.outdir, 'Reason:', e)
+            sys.exit(1)
+
+    if args.http is not None:
+        address, sep, http_port = args.http.rpartition(':')
+        try:
+            printer.server = JobServer(address or '127.0.0.1', int(http_port))
+        except Exception as e:
+            print('Cannot start HTTP server:', args.http, 'Reason:', e)
+            sys.exit(1)
+        printer.server.pdfcache = printer.pdfcache
+        print('INFO: watch jobs at http://%s:%d/'%printer.server.httpd.server_address[:2])
+
+    if args.search is not None:
+        search_path = args.search or os.path.join(args.outdir, SEARCH_NAME)
+        try:
+            printer.index = SearchIndex(search_path, page_lines=printer.page_lines(), say=printer.say)
+        except Exception as e:
+            print('Cannot open search index:', search_path, 'Reason:', e)
+            sys.exit(1)
+        if printer.server is not None:
+            printer.server.search_path = search_path
+
+    if args.hook:
+        try:
+            printer.hooks = HookRunner(args.hook, workers=args.hook_workers, timeout=args.hook_timeout,
+                                       say=printer.say)
+        except Exception as e:
+            print('Cannot set up hooks. Reason:', e)
+            sys.exit(1)
+
+    if args.events is not None:
+        try:
+            printer.events = EventLog(args.events)
+        except Exception as e:
+            print('Cannot open event log:', args.events, 'Reason:', e)
+            sys.exit(1)
+    printer.console = Console(sys.stdout, max(0, args.console_rate))
+    printer.event('start', host=args.host, port=port, outdir=args.outdir)
+
+    if args.checkpoint_interval > 0:
+        printer.checkpoint = Checkpoint(os.path.join(args.outdir, CHECKPOINT_NAME), args.checkpoint_interval,
+                                        say=printer.say)
+
+    if args.render_threads > 0:
+        printer.scheduler = RenderScheduler(printer.finish_job, workers=args.render_threads,
+                                            aging=args.aging*1024, fast_pages=args.fast_pages,
+                                            page_lines=printer.page_lines(), done=printer.rendered,
+                                            say=printer.say)
+
+    try:
+        printer.recover()
+        printer.process_print_jobs()
+    finally:
+        printer.shutdown()
 
 def main():
     try:
@@ -0,0 +1,110 @@
+"""
+Receiving jobs from PSU in another program.
+
+psuprinter is normally run as a program that writes each job it receives
+to the spool directory. receive_jobs() instead connects to PSU and hands
+each job to the caller as a Job (see job.py) once it has been received,
+parsed by the same state machine as the program uses, e.g.:
+
+    from psuprinter.receiver import receive_jobs, memory_sink
+
+    for job in receive_jobs('nos.example.com', sink=memory_sink):
+        store(job.name(), job.user, job.receive_secs, job.open_body().read())
+
+A Job has the banner page fields (user, ujn, jsn, date, time), the byte,
+line and form feed counts and the receive (and render) times, and its text
+can be read as bytes with open_body().
+
+The caller chooses where the text goes, with a sink: a callable taking the
+Job, when its banner page has been read, and returning a file-like object
+to write its text (str) to, or None if it cannot. Without a sink the text
+goes to a spool file in outdir, compressed if compress is given, as with
+the program. memory_sink keeps it in the Job (as body) instead. PDF files
+are only made (as the program does) with pdf=True, which needs the spool
+file.
+
+Other psu_printer settings can be given by name, e.g. compress='gzip',
+layout='{date}', display_code=re.compile('') or landscape=False.
+Messages are not shown unless messages=True. Checkpoints and background
+rendering are only set up by the program.
+
+areceive_jobs() is the same for asyncio: the connection is read in a thread
+of the default executor. The generator is closed in that thread too, once
+any job being read has been received.
+"""
+import io
+import asyncio
+import threading
+
+try:
+    from psuprinter.psuprinter import psu_printer
+except ImportError:
+    from psuprinter import psu_printer
+
+class _MemoryText(io.StringIO):
+    """
+    Text of a job kept in memory, put in the job (as UTF-8) when closed.
+    """
+
+    def __init__(self, job):
+        super(_MemoryText,self).__init__()
+        self.job = job
+
+    def close(self):
+        self.job.body = self.getvalue().encode('utf-8')
+        super(_MemoryText,self).close()
+
+def memory_sink(job):
+    """
+    Sink keeping the text of job in memory, as job.body.
+    """
+    return _MemoryText(job)
+
+def receive_jobs(hostname, port=2552, outdir='.', sink=None, pdf=False, **settings):
+    """
+    Generator: connect to PSU on hostname:port and yield each Job received,
+    until PSU closes the connection. Jobs go to sink, or spool files in
+    outdir if None. settings are other psu_printer attributes to set.
+    Raises TypeError for a setting psu_printer does not have.
+    """
+    printer = psu_printer(outdir, hostname, port=port)
+    printer.sink = sink
+    printer.pdf = pdf
+    printer.messages = False
+    for name in settings:
+        if not hasattr(printer, name):
+            raise TypeError('no such psu_printer setting: '+name)
+        setattr(printer, name, settings[name])
+    try:
+        for job in printer.receive():
+            yield job
+    finally:
+        printer.shutdown()
+
+async def areceive_jobs(hostname, port=2552, outdir='.', sink=None, pdf=False, **settings):
+    """
+    Asynchronous generator: receive_jobs() for asyncio.
+    """
+    jobs = receive_jobs(hostname, port, outdir, sink, pdf, **settings)
+    loop = asyncio.get_running_loop()
+    end = object()
+    # A cancelled await leaves next() running in the executor, and a
+    # generator cannot be closed while it runs.
+    lock = threading.Lock()
+
+    def receive():
+        with lock:
+            return next(jobs, end)
+
+    def close():
+        with lock:
+            jobs.close()
+
+    try:
+        while True:
+            job = await loop.run_in_executor(None, receive)
+            if job is end:
+                break
+            yield job
+    finally:
+        await loop.run_in_executor(None, close)
@@ -0,0 +1,142 @@
+"""
+Render scheduling for psuprinter.
+
+Without a scheduler, each job is rendered to PDF in psuprinter's main loop
+as soon as it has been received, so one huge listing holds up everything
+behind it. A RenderScheduler renders jobs in background threads instead,
+shortest job first: of the jobs waiting, the one with the fewest bytes goes
+next. So that a big job is not put off for ever by a stream of small ones,
+waiting counts in its favour ("aging"): each second it waits, it is
+treated as aging bytes smaller.
+
+Jobs estimated to be under fast_pages pages can also have a fast lane: a
+thread of their own that never takes a bigger job, so they need not wait
+for a big one being rendered.
+"""
+import time
+import heapq
+import threading
+import itertools
+import collections
+
+# Number of recent jobs whose turnaround is kept for report().
+REPORT_JOBS = 1000
+
+class RenderScheduler(object):
+    """
+    Queue of received jobs, rendered shortest first by worker threads.
+    """
+
+    def __init__(self, render, workers=1, aging=100*1024, fast_pages=0, page_lines=67, done=None, say=print):
+        """
+        Start workers threads calling render(job) for each job submitted,
+        then done(job) if given. page_lines is the number of lines per page,
+        to estimate the pages of a job for the fast lane. Errors are
+        reported with say, called like print().
+        """
+        super(RenderScheduler,self).__init__()
+        self.render = render
+        self.say = say
+        self.done = done
+        self.aging = aging
+        self.fast_pages = fast_pages
+        self.page_lines = page_lines
+        self.cond = threading.Condition()
+        # Heap of (key, sequence number, job), and jobs being rendered.
+        self.queue = []
+        self.running = []
+        self.seq = itertools.count()
+        self.closed = False
+        # Seconds from being received to being rendered, of recent jobs.
+        self.turnarounds = collections.deque(maxlen=REPORT_JOBS)
+        self.threads = [threading.Thread(target=self.work, args=(False,), name='render%d'%i)
+                        for i in range(workers)]
+        if fast_pages > 0:
+            self.threads.append(threading.Thread(target=self.work, args=(True,), name='render-fast'))
+        for thread in self.threads:
+            thread.start()
+
+    def pages(self, job):
+        """
+        Estimated number of pages of job.
+        """
+        return max(job.nforms, job.nlines // self.page_lines) + 1
+
+    def submit(self, job):
+        """
+        Queue job for rendering. Returns at once.
+        """
+        # Aging: a job's priority is its size less aging bytes for each second it
+        # has waited. That is size + aging * time submitted, less the same for all.
+        key = job.nbytes + self.aging * time.time()
+        with self.cond:
+            heapq.heappush(self.queue, (key, next(self.seq), job))
+            self.cond.notify_all()
+
+    def pending(self):
+        """
+        Return the jobs being rendered and waiting to be, in that order.
+        """
+        with self.cond:
+            return self.running + [job for key, seq, job in sorted(self.queue)]
+
+    def take(self, fast):
+        """
+        Remove and return the next job for a worker, or None. The fast lane
+        only takes small jobs. Call with the condition held.
+        """
+        if not fast:
+            if self.queue:
+                return heapq.heappop(self.queue)[2]
+            return None
+        small = [entry for entry in self.queue if self.pages(entry[2]) < self.fast_pages]
+        if not small:
+            return None
+        entry = min(small)
+        self.queue.remove(entry)
+        heapq.heapify(self.queue)
+        return entry[2]
+
+    def work(self, fast):
+        """
+        Worker thread: render jobs until closed and none are left.
+        """
+        while True:
+            with self.cond:
+                job = self.take(fast)
+                while job is None and not self.closed:
+                    self.cond.wait()
+                    job = self.take(fast)
+                if job is None:
+                    return
+                self.running.append(job)
+            try:
+                self.render(job)
+            except Exception as e:
+                self.say('ERROR: rendering', job.name(), 'failed. Reason:', e)
+            with self.cond:
+                self.running.remove(job)
+                if job.t_close is not None:
+                    self.turnarounds.append(time.time() - job.t_close)
+            if self.done is not None:
+                self.done(job)
+
+    def close(self):
+        """
+        Stop taking jobs and wait for those queued to be rendered.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def report(self):
+        """
+        Return a line on the turnaround of recent jobs.
+        """
+        with self.cond:
+            times = sorted(self.turnarounds)
+        if not times:
+            return 'no jobs rendered'
+        return '%d jobs, turnaround median %.2f s, max %.2f s'%(len(times), times[len(times) // 2], times[-1])
@@ -0,0 +1,440 @@
+#! /usr/bin/env python3
+"""
+Full-text search of spooled print jobs.
+
+psuprinter can index the text of each job as it is written, in an SQLite
+FTS5 table next to the spool. The index only holds the words: each line is
+identified by its job and line number, and the text shown for a hit is read
+back from the spool file. Page numbers are worked out as the lines are
+indexed, the same way text2pdf breaks pages (at form feeds and when a page
+is full), so they match the PDF unless format effectors were used.
+
+Indexing is done by a background thread, so receiving jobs is not slowed
+down by it.
+"""
+import os
+import re
+import sys
+import queue
+import sqlite3
+import argparse
+import threading
+import urllib.parse
+
+try:
+    from psuprinter.spool import spool_files, spool_stem
+    from psuprinter.text2pdf import open_input
+except ImportError:
+    from spool import spool_files, spool_stem
+    from text2pdf import open_input
+
+# Default index file name, relative to the output directory.
+SEARCH_NAME = 'psusearch.db'
+
+# Lines queued for the index thread at a time.
+BATCH_LINES = 500
+
+# Line numbers are the low bits of an indexed line's rowid, the job id the rest.
+LINE_BITS = 32
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    txt_path TEXT NOT NULL UNIQUE,
+    pdf_path TEXT,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    job INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    first_line INTEGER NOT NULL,
+    PRIMARY KEY (job, page)
+) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS lines USING fts5(text, content='');
+"""
+
+# Line terminators, as text2pdf sees them.
+LINE_END = re.compile('[\n\f]')
+
+def clean_line(line):
+    """
+    Text of a line for indexing and display: overprinted parts (after
+    carriage returns) are joined with spaces, as are parts of a line split
+    by form feeds.
+    """
+    return ' '.join(part.rstrip() for part in re.split('[\r\f]', line)).strip()
+
+class Paginator(object):
+    """
+    Follows text2pdf's page breaks: at a form feed, or after page_lines
+    printed lines, where a line is wrapped after cols characters (counting
+    from any carriage return, with tabs every tab columns). A form feed
+    straight after a page has filled up is skipped.
+    """
+
+    def __init__(self, page_lines=67, cols=137, tab=8):
+        super(Paginator,self).__init__()
+        self.page_lines = page_lines
+        self.cols = cols
+        self.tab = tab
+        self.page = 1
+        self.count = 0
+        self.swallow = False
+
+    def feed(self, line, end):
+        """
+        Account for line, ended by end (a line feed or form feed). Return
+        the page it starts on, or None if it is a skipped form feed.
+        """
+        if end == '\f' and line == '' and self.swallow:
+            self.swallow = False
+            return None
+        page = self.page
+        rows, column = 1, 0
+        for ch in line:
+            if column >= self.cols:
+                rows += 1
+                column = 0
+            column += 1
+            if ch == '\t':
+                column += self.tab - 1 - (column - 1) % self.tab
+            elif ch == '\r':
+                column = 0
+        if column >= self.cols:
+            # The line end is read at the start of another printed line.
+            rows += 1
+        self.count += rows
+        # A line that does not fit carries on on the next page.
+        self.page += self.count // self.page_lines
+        self.count %= self.page_lines
+        self.swallow = self.page > page and self.count == 0
+        if end == '\f' and self.count > 0:
+            self.page += 1
+            self.count = 0
+        return page
+
+class SearchIndex(object):
+    """
+    Full-text index of jobs, written by a background thread.
+    """
+
+    def __init__(self, path, page_lines=67, cols=137, say=print):
+        """
+        Open (creating if need be) the index in file path. page_lines and
+        cols are text2pdf's lines per page and characters per line.
+        Errors in the writer thread are reported with say, called like
+        print(). Raises sqlite3.Error if SQLite has no FTS5.
+        """
+        super(SearchIndex,self).__init__()
+        self.path = path
+        self.say = say
+        self.page_lines = page_lines
+        self.cols = cols
+        conn = open_index(path)
+        conn.close()
+
+        # State of the job being indexed, in the caller's thread.
+        self.buffer = ''
+        self.lineno = 0
+        self.paginator = None
+        self.batch = []
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write, name='search', daemon=True)
+        self.thread.start()
+
+    def begin_job(self, txt_path, name):
+        """
+        Start indexing the job with text file txt_path, replacing any index
+        of it there was.
+        """
+        self.buffer = ''
+        self.lineno = 0
+        self.paginator = Paginator(self.page_lines, self.cols)
+        self.batch = []
+        self.queue.put(('begin', txt_path, name))
+
+    def add(self, text):
+        """
+        Index text written to the job's file.
+        """
+        self.buffer += text
+        start = 0
+        for match in LINE_END.finditer(self.buffer):
+            self.add_line(self.buffer[start:match.start()], match.group())
+            start = match.end()
+        self.buffer = self.buffer[start:]
+        # Keep the start of a line split by a form feed until the rest is seen.
+        if len(self.batch) >= BATCH_LINES and self.batch[-1][0] <= self.lineno:
+            self.flush()
+
+    def add_line(self, line, end):
+        """
+        Index one whole line.
+        """
+        page = self.paginator.feed(line, end)
+        if page is not None:
+            text = clean_line(line)
+            if self.batch and self.batch[-1][0] == self.lineno + 1:
+                # More of a line split by a form feed.
+                lineno, page, before = self.batch.pop()
+                text = (before + ' ' + text).strip()
+            if text:
+                self.batch.append((self.lineno + 1, page, text))
+        if end == '\n':
+            self.lineno += 1
+
+    def flush(self):
+        """
+        Pass lines indexed so far to the index thread.
+        """
+        if self.batch:
+            self.queue.put(('lines', self.batch))
+            self.batch = []
+
+    def end_job(self):
+        """
+        Finish indexing the job.
+        """
+        if self.buffer:
+            self.add_line(self.buffer, '\n')
+            self.buffer = ''
+        self.flush()
+        self.queue.put(('end',))
+
+    def set_pdf(self, txt_path, pdf_path):
+        """
+        Record the PDF of an indexed job. May be called from any thread.
+        """
+        self.queue.put(('pdf', txt_path, pdf_path))
+
+    def index_file(self, txt_path):
+        """
+        Index an existing spool text file (which may be compressed).
+        """
+        ifs, compressed = open_input(txt_path)
+        with ifs:
+            self.begin_job(txt_path, spool_stem(os.path.basename(txt_path)))
+            while True:
+                data = ifs.read(1024*1024)
+                if not data:
+                    break
+                self.add(data.decode('utf-8', 'replace'))
+            self.end_job()
+
+    def close(self):
+        """
+        Finish writing the index.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def write(self):
+        """
+        Index thread: apply queued updates, committing each batch.
+        """
+        conn = open_index(self.path)
+        job = None
+        lastpage = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                with conn:
+                    if item[0] == 'begin':
+                        # A new job id leaves any old index of the file behind. Hits
+                        # on that are dropped as their job no longer exists.
+                        conn.execute('DELETE FROM pages WHERE job IN (SELECT id FROM jobs WHERE txt_path = ?)', (item[1],))
+                        conn.execute('DELETE FROM jobs WHERE txt_path = ?', (item[1],))
+                        job = conn.execute('INSERT INTO jobs (txt_path, name) VALUES (?, ?)', item[1:]).lastrowid
+                        lastpage = 0
+                    elif item[0] == 'lines' and job is not None:
+                        base = job << LINE_BITS
+                        conn.executemany('INSERT INTO lines (rowid, text) VALUES (?, ?)',
+                                         [(base + lineno, text) for lineno, page, text in item[1]])
+                        pages = []
+                        for lineno, page, text in item[1]:
+                            if page > lastpage:
+                                pages.append((job, page, lineno))
+                                lastpage = page
+                        conn.executemany('INSERT OR REPLACE INTO pages (job, page, first_line) VALUES (?, ?, ?)', pages)
+                    elif item[0] == 'end':
+                        job = None
+                    elif item[0] == 'pdf':
+                        conn.execute('UPDATE jobs SET pdf_path = ? WHERE txt_path = ?', (item[2], item[1]))
+            except sqlite3.Error as e:
+                self.say('ERROR: cannot update search index. Reason:', e)
+        conn.close()
+
+def open_index(path, readonly=False):
+    """
+    Open the index in file path, creating it unless readonly.
+    """
+    if readonly:
+        conn = sqlite3.connect('file:%s?mode=ro'%urllib.parse.quote(os.path.abspath(path)), uri=True)
+    else:
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def move(path, old_txt_path, txt_path, pdf_path):
+    """
+    Record in the index in file path that a job's files have been moved.
+    """
+    conn = open_index(path)
+    with conn:
+        conn.execute('UPDATE jobs SET txt_path = ?, pdf_path = ? WHERE txt_path = ?',
+                     (txt_path, pdf_path, old_txt_path))
+    conn.close()
+
+def record_pdf(path, txt_path, pdf_path):
+    """
+    Record in the index in file path that a job's PDF is pdf_path.
+    """
+    conn = open_index(path)
+    with conn:
+        conn.execute('UPDATE jobs SET pdf_path = ? WHERE txt_path = ?', (pdf_path, txt_path))
+    conn.close()
+
+def search(path, query, limit=100, user=None):
+    """
+    Search the index in file path. query is an FTS5 query: words (all must
+    be on the line), "a phrase", prefix*, OR, NOT etc. Return up to limit
+    hits, newest job first, as dicts with the job's id, name, txt_path and
+    pdf_path, the page and the line number, but not the text (see
+    hit_lines()). Raises sqlite3.Error on a bad query.
+    """
+    conn = open_index(path, readonly=True)
+    try:
+        sql = ('SELECT lines.rowid AS rowid, jobs.* FROM lines JOIN jobs ON jobs.id = (lines.rowid >> %d) '
+               'WHERE lines MATCH ?'%LINE_BITS)
+        args = [query]
+        if user is not None:
+            sql += ' AND jobs.name LIKE ?'
+            args.append(user + '.%')
+        sql += ' ORDER BY lines.rowid DESC LIMIT ?'
+        args.append(limit)
+        hits = []
+        for row in conn.execute(sql, args).fetchall():
+            lineno = row['rowid'] & ((1 << LINE_BITS) - 1)
+            page = conn.execute('SELECT max(page) FROM pages WHERE job = ? AND first_line <= ?',
+                                (row['id'], lineno)).fetchone()[0]
+            hits.append({'id': row['id'], 'name': row['name'], 'txt_path': row['txt_path'],
+                         'pdf_path': row['pdf_path'], 'page': page or 1, 'line': lineno})
+        return hits
+    finally:
+        conn.close()
+
+def job_pdf(path, job_id):
+    """
+    Return the PDF file of job job_id in the index in file path, or None.
+    """
+    conn = open_index(path, readonly=True)
+    try:
+        row = conn.execute('SELECT pdf_path FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return None if row is None else row['pdf_path']
+    finally:
+        conn.close()
+
+def job_txt(path, job_id):
+    """
+    Return the text file of job job_id in the index in file path, or None.
+    """
+    conn = open_index(path, readonly=True)
+    try:
+        row = conn.execute('SELECT txt_path FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return None if row is None else row['txt_path']
+    finally:
+        conn.close()
+
+def hit_lines(hits):
+    """
+    Add the text of each hit (from search()) to it, as 'text', reading each
+    spool file once. Hits whose file cannot be read get None.
+    """
+    byfile = {}
+    for hit in hits:
+        byfile.setdefault(hit['txt_path'], []).append(hit)
+    for txt_path, filehits in byfile.items():
+        wanted = dict((hit['line'], hit) for hit in filehits)
+        last = max(wanted)
+        try:
+            ifs, compressed = open_input(txt_path)
+            with ifs:
+                for lineno, line in enumerate(ifs, 1):
+                    if lineno in wanted:
+                        wanted[lineno]['text'] = clean_line(line.decode('utf-8', 'replace').rstrip('\n'))
+                    if lineno >= last:
+                        break
+        except OSError:
+            pass
+        for hit in filehits:
+            hit.setdefault('text', None)
+    return hits
+
+def search_path(path):
+    """
+    Accept either an index file or an output directory containing one.
+    """
+    if os.path.isdir(path):
+        return os.path.join(path, SEARCH_NAME)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the text of spooled psuprinter jobs.')
+    parser.add_argument("index", help="Index file, or output directory containing "+SEARCH_NAME+".")
+    parser.add_argument("query", nargs='?', help='What to look for: words, "a phrase", prefix*, OR, NOT ...')
+    parser.add_argument("--user", "-u", help="Only jobs for this user.")
+    parser.add_argument("--limit", help="Show at most LIMIT hits (def:100).", type=int, default=100)
+    parser.add_argument("--files", help="Only list the text files with hits.", action='store_true')
+    parser.add_argument("--import", dest='import_dir', metavar='OUTDIR',
+                        help="First index spool files in OUTDIR that are not in the index.")
+    parser.add_argument("--lines", help="Lines per PDF page of imported files (def:67, as landscape).",
+                        type=int, default=67)
+
+    args = parser.parse_intermixed_args()
+
+    path = search_path(args.index)
+    if args.import_dir is not None:
+        try:
+            index = SearchIndex(path, page_lines=args.lines)
+        except sqlite3.Error as e:
+            print('Error: cannot open search index:', path, 'Reason:', e)
+            sys.exit(1)
+        conn = open_index(path, readonly=True)
+        known = set(row[0] for row in conn.execute('SELECT txt_path FROM jobs'))
+        conn.close()
+        count = 0
+        for txt_path, fields in spool_files(args.import_dir):
+            if txt_path not in known:
+                index.index_file(txt_path)
+                count += 1
+        index.close()
+        print('INFO: indexed', count, 'spool files from', args.import_dir, file=sys.stderr)
+    elif not os.access(path, os.F_OK):
+        print('Error: no search index:', path)
+        sys.exit(1)
+
+    if args.query is None:
+        return
+    try:
+        hits = search(path, args.query, limit=args.limit, user=args.user)
+    except sqlite3.Error as e:
+        print('Error:', e)
+        sys.exit(1)
+    if args.files:
+        seen = set()
+        for hit in hits:
+            if hit['txt_path'] not in seen:
+                seen.add(hit['txt_path'])
+                print(hit['txt_path'])
+        return
+    for hit in hit_lines(hits):
+        print('%s:%d:%d: %s'%(hit['txt_path'], hit['page'], hit['line'], hit['text'] or ''))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#! /usr/bin/env python3
+"""
+Spool directory layout.
+
+By default all text files go into the output directory and all PDF files
+into its PDF subdirectory. A layout spreads them over subdirectories made
+from the banner page fields instead, e.g. "{date}/{user}" puts a job in
+outdir/YY_MM_DD/USER/ and its PDF in outdir/PDF/YY_MM_DD/USER/.
+
+Text files may be compressed (USER.UJN.JSN.DATE.TIME.txt.gz or .txt.xz).
+
+Run as a program, this migrates an existing spool to a layout.
+"""
+import os
+import sys
+import glob
+import argparse
+import gzip
+import lzma
+
+# Fields available to layouts.
+LAYOUT_FIELDS = ('user', 'ujn', 'jsn', 'date', 'time', 'yy', 'mm', 'dd')
+
+# Spool text compression methods and their file name suffixes.
+COMPRESSORS = {'gzip': '.gz', 'xz': '.xz'}
+
+def spool_stem(file_name):
+    """
+    Return a spool file name without its .txt (and any compression) suffix.
+    """
+    for suffix in COMPRESSORS.values():
+        if file_name.endswith(suffix):
+            file_name = file_name[:-len(suffix)]
+            break
+    return os.path.splitext(file_name)[0]
+
+def open_spool(path, compress=None, level=None, append=False):
+    """
+    Open a spool text file for writing (or appending), compressed with
+    method compress (a key of COMPRESSORS) at the given level if wanted.
+    path should already have the suffix for the method. Appending to a
+    compressed file adds another gzip member or xz stream to it.
+    """
+    mode = 'at' if append else 'wt'
+    if compress == 'gzip':
+        return gzip.open(path, mode, compresslevel=9 if level is None else level)
+    if compress == 'xz':
+        return lzma.open(path, mode, preset=level)
+    return open(path, mode[0])
+
+def read_spool(path):
+    """
+    Open a spool text file, compressed or not, for reading as bytes.
+    """
+    if path.endswith(COMPRESSORS['gzip']):
+        return gzip.open(path, 'rb')
+    if path.endswith(COMPRESSORS['xz']):
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+def parse_spool_name(file_name):
+    """
+    Split a spool file name, USER.UJN.JSN.DATE.TIME.txt (or .txt.gz or
+    .txt.xz), into its fields. Return a dict, or None if the name is not of
+    that form.
+    """
+    parts = file_name.split('.')
+    if len(parts) == 7 and '.'+parts[6] in COMPRESSORS.values():
+        parts = parts[:6]
+    if len(parts) != 6 or parts[5] != 'txt':
+        return None
+    return dict(zip(('user', 'ujn', 'jsn', 'date', 'time'), parts[:5]))
+
+def check_layout(layout):
+    """
+    Check that a layout can be used. Raise ValueError if not.
+    """
+    if layout.startswith('/') or os.path.isabs(layout):
+        raise ValueError('layout must be relative: '+layout)
+    try:
+        subdir = layout.format(**dict.fromkeys(LAYOUT_FIELDS, 'X'))
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError('bad layout: '+layout+' ('+str(e)+')')
+    if '..' in subdir.split('/'):
+        raise ValueError('layout must not contain "..": '+layout)
+
+def shard_dir(layout, user, ujn, jsn, date, time):
+    """
+    Return the subdirectory (relative to the output directory) for a job.
+    Empty for the flat layout.
+    """
+    if not layout:
+        return ''
+    dateparts = (date.split('_') + ['', '', ''])[:3]
+    fields = dict(user=user or '_', ujn=ujn or '_', jsn=jsn or '_', date=date or '_', time=time or '_',
+                  yy=dateparts[0] or '_', mm=dateparts[1] or '_', dd=dateparts[2] or '_')
+    return os.path.normpath(layout.format(**fields))
+
+class DirCache(object):
+    """
+    Directories known to exist. Each is created (if need be) the first time
+    it is used, after which it costs a set lookup rather than file system calls.
+    """
+
+    def __init__(self):
+        super(DirCache,self).__init__()
+        self.known = set()
+
+    def ensure(self, path):
+        """
+        Make sure directory path exists. Raises OSError if it cannot be created.
+        """
+        if path in self.known:
+            return
+        os.makedirs(path, exist_ok=True)
+        self.known.add(path)
+
+    def forget(self, path=None):
+        """
+        Forget path (or everything), e.g. if it may have been removed.
+        """
+        if path is None:
+            self.known.clear()
+        else:
+            self.known.discard(path)
+
+def spool_files(outdir):
+    """
+    Yield (text file path, fields) for every spool text file under outdir,
+    whatever layout it is in. The PDF subdirectory is skipped.
+    """
+    pdfdir = os.path.join(outdir, 'PDF')
+    for dirpath, dirnames, filenames in os.walk(outdir):
+        if dirpath == outdir and 'PDF' in dirnames:
+            dirnames.remove('PDF')
+        for name in filenames:
+            fields = parse_spool_name(name)
+            if fields is not None:
+                yield os.path.join(dirpath, name), fields
+
+def pdf_for(outdir, txt_path):
+    """
+    Return where the PDF for a text file under outdir is (or would be):
+    the same relative place under outdir/PDF.
+    """
+    reldir = os.path.relpath(os.path.dirname(txt_path), outdir)
+    stem = spool_stem(os.path.basename(txt_path))
+    return os.path.normpath(os.path.join(outdir, 'PDF', reldir, stem+'.pdf'))
+
+def move_indexed(search, old_txt, new_txt, new_pdf):
+    """
+    Record a moved job in search index file search.
+    """
+    try:
+        from psuprinter.search import move
+    except ImportError:
+        from search import move
+    move(search, old_txt, new_txt, new_pdf)
+
+def pdf_volumes(pdf_path):
+    """
+    Return the volume files (NAME.partNN.pdf) of a PDF that was split, if any.
+    """
+    return sorted(glob.glob(glob.escape(os.path.splitext(pdf_path)[0]) + '.part[0-9]*.pdf'))
+
+def remove_empty_dirs(top):
+    """
+    Remove empty directories below (not including) top.
+    """
+    for dirpath, dirnames, filenames in os.walk(top, topdown=False):
+        if dirpath != top and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+def migrate(outdir, layout, catalog=None, search=None, dry_run=False, verbose=False):
+    """
+    Move every spool text file under outdir, and its PDF, to where layout
+    puts it. Update the paths in catalog (a JobCatalog) if given, and in
+    the search index file search if given. Return the number of jobs moved.
+    """
+    check_layout(layout)
+    dirs = DirCache()
+    moved = 0
+    for txt_path, fields in list(spool_files(outdir)):
+        subdir = shard_dir(layout, **fields)
+        new_txt = os.path.join(outdir, subdir, os.path.basename(txt_path))
+        old_pdf = pdf_for(outdir, txt_path)
+        new_pdf = pdf_for(outdir, new_txt)
+        if os.path.normpath(new_txt) == os.path.normpath(txt_path):
+            continue
+        if verbose or dry_run:
+            print(txt_path, '->', new_txt)
+        if dry_run:
+            moved += 1
+            continue
+        dirs.ensure(os.path.dirname(new_txt))
+        os.rename(txt_path, new_txt)
+        if os.access(old_pdf, os.F_OK):
+            dirs.ensure(os.path.dirname(new_pdf))
+            for volume in pdf_volumes(old_pdf):
+                os.rename(volume, os.path.join(os.path.dirname(new_pdf), os.path.basename(volume)))
+            os.rename(old_pdf, new_pdf)
+        else:
+            new_pdf = None
+        if catalog is not None:
+            catalog.move(txt_path, new_txt, new_pdf)
+        if search is not None:
+            move_indexed(search, txt_path, new_txt, new_pdf)
+        moved += 1
+    if not dry_run:
+        remove_empty_dirs(outdir)
+    return moved
+
+def main():
+    try:
+        from psuprinter.catalog import JobCatalog, CATALOG_NAME
+        from psuprinter.search import SEARCH_NAME
+    except ImportError:
+        from catalog import JobCatalog, CATALOG_NAME
+        from search import SEARCH_NAME
+
+    parser = argparse.ArgumentParser(description='Move an existing psuprinter spool to a directory layout.')
+    parser.add_argument("outdir", help="Output (spool) directory.")
+    parser.add_argument("layout", help='Layout, e.g. "{date}/{user}". Use "" to flatten. '
+                        'Fields: '+', '.join(LAYOUT_FIELDS)+'.')
+    parser.add_argument("--catalog", help="Also update paths in this catalog (def: outdir/"+CATALOG_NAME+" if present).")
+    parser.add_argument("--search", help="Also update paths in this search index (def: outdir/"+SEARCH_NAME+" if present).")
+    parser.add_argument("--dry-run", "-n", help="Only show what would be moved.", action='store_true')
+    parser.add_argument("--verbose", "-v", help="Show each file moved.", action='store_true')
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.outdir):
+        print('Error: not a directory:', args.outdir)
+        sys.exit(1)
+
+    catalog_path = args.catalog or os.path.join(args.outdir, CATALOG_NAME)
+    catalog = None
+    if os.access(catalog_path, os.F_OK):
+        catalog = JobCatalog(catalog_path)
+
+    search = args.search or os.path.join(args.outdir, SEARCH_NAME)
+    if not os.access(search, os.F_OK):
+        search = None
+
+    try:
+        moved = migrate(args.outdir, args.layout, catalog=catalog, search=search, dry_run=args.dry_run, verbose=args.verbose)
+    except ValueError as e:
+        print('Error:', e)
+        sys.exit(1)
+    print('INFO:', moved, 'jobs', 'would be moved.' if args.dry_run else 'moved.')
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,13 @@
  and Python 3 compatibility. Also to get over printing to work (tricky).
  Note: this overstrike does not support ^H. Only "Fortran style" column 1
  format effectors converted to carriage returns without line feeds.
+ With -E, CDC column 1 format effectors (spacing, page eject, skip to
+ format channel, overprint, lines per inch) are interpreted instead.
+ With -X, objects go in compressed object streams with a cross-reference
+ stream. With --linearize, the file is linearized for fast first page display.
+ With -j, large inputs are cut at form feeds and their pages rendered in a
+ process pool. With --ttf, a TrueType font is embedded, subset to the
+ characters used.
     
 """
 
@@ -20,11 +27,97 @@ import string
 import time
 import optparse
 import re
+import shlex
+import zlib
+import tempfile
+import hashlib
+import io
+import gzip
+import lzma
+import contextlib
+import array
+import collections
+
+try:
+    from psuprinter.profiling import Profiler, PROFILE_MODES
+    from psuprinter.ttfont import load_font, winansi
+except ImportError:
+    # Run as a script from the package directory.
+    from profiling import Profiler, PROFILE_MODES
+    from ttfont import load_font, winansi
+import concurrent.futures
 
 LF_EXTRA=0
 LINE_END='\015'
 # form feed character (^L)
 FF=chr(12)
+# Objects per object stream with -X.
+OBJSTM_SIZE=100
+# Kids per node of the page tree.
+PAGE_TREE_FANOUT=32
+# Content streams remembered for pages identical to earlier ones to share.
+DEDUP_PAGES=4096
+# Input is read and laid out in blocks of about this many bytes. With -j,
+# inputs are split into chunks of about this size, and inputs smaller than
+# two chunks are rendered serially.
+CHUNK_SIZE=256*1024
+# Fixed sizes of the linearization dictionary and first page trailer, which
+# are written before the offsets they hold are known.
+LIN_DICT_SIZE=200
+LIN_TRAILER_SIZE=200
+
+# CDC carriage control: column 1 format effectors, for the -E engine.
+# Each entry is (action before printing, argument, action after printing, argument).
+# Actions are 'space' (advance n lines), 'skip' (to format channel n),
+# 'suppress' (the next line advances one line less), 'mode' (set a printer
+# mode; the rest of the line is not printed) or None.
+FE_TABLE = {
+    ' ': ('space', 1, None, 0),         # Single space.
+    '0': ('space', 2, None, 0),         # Double space.
+    '-': ('space', 3, None, 0),         # Triple space.
+    '+': ('space', 0, None, 0),         # No space: overprint previous line.
+    '1': ('skip', 1, None, 0),          # Page eject.
+    '2': ('skip', 12, None, 0),         # Skip to last line of form.
+    '3': ('skip', 6, None, 0),          # Skip to format channel 6 ...
+    '4': ('skip', 5, None, 0),
+    '5': ('skip', 4, None, 0),
+    '6': ('skip', 3, None, 0),
+    '7': ('skip', 2, None, 0),
+    '8': ('skip', 1, None, 0),          # ... to format channel 1.
+    '/': ('space', 1, 'suppress', 1),   # Suppress space after printing.
+    'A': ('space', 1, 'skip', 1),       # Page eject after printing.
+    'B': ('space', 1, 'skip', 12),      # Skip to last line of form after printing.
+    'C': ('space', 1, 'skip', 6),       # Skip to format channel 6 after printing ...
+    'D': ('space', 1, 'skip', 5),
+    'E': ('space', 1, 'skip', 4),
+    'F': ('space', 1, 'skip', 3),
+    'G': ('space', 1, 'skip', 2),
+    'H': ('space', 1, 'skip', 1),       # ... to format channel 1 after printing.
+    'Q': ('mode', 'noeject', None, 0),  # Clear auto page eject.
+    'R': ('mode', 'eject', None, 0),    # Select auto page eject.
+    'S': ('mode', 6, None, 0),          # 6 lines per inch.
+    'T': ('mode', 8, None, 0),          # 8 lines per inch.
+    }
+# Any other effector is treated as a single space.
+FE_DEFAULT = FE_TABLE[' ']
+
+# Translation of text to the body of a PDF string: escape parentheses and
+# backslashes, drop control characters, use octal for 8 bit characters.
+PDF_STRING_TABLE = {ord('('): '\\(', ord(')'): '\\)', ord('\\'): '\\\\'}
+PDF_STRING_TABLE.update((c, None) for c in range(0, 32))
+PDF_STRING_TABLE.update((c, '\\%03o'%c) for c in range(127, 256))
+
+# Characters in input lines other than printable ones (and newline).
+SPECIAL_CHARS = re.compile('[^\n\x20-\x7f]')
+
+# Escapes in the body of a PDF string of ordinary printed text.
+PDF_ESCAPE_TABLE = {ord('('): '\\(', ord(')'): '\\)', ord('\\'): '\\\\'}
+
+# Advance width of a space in each standard font family, in 1/1000 em.
+SPACE_WIDTHS = {'Courier': 600, 'Helvetica': 278, 'Times': 250, 'Symbol': 250, 'ZapfDingbats': 278}
+
+# Runs of spaces long enough to move over (with a TJ array) rather than print.
+SPACE_RUN = re.compile(' {8,}')
 
 ENCODING_STR = """\
 /Encoding <<
@@ -76,12 +169,67 @@ PyText2Pdf  makes a 7-bit clean PDF file from any input file.
 
 It reads from a named file, and writes the PDF file to a file specified by
 the user, otherwise to a file with '.pdf' appended to the input file.
+A filename of - reads standard input, and -o - (the default when reading
+standard input) writes the PDF file to standard output.
+With --also, the same input is also written with other options, e.g.
+--also "-F -L -G -o wide.pdf", reading it only once.
 
 Author: Anand B Pillai.
         Hacked by Nick Glazzard to add a cosmetic green bar paper background
         and Python 3 compatibility.  Also to get over printing to work (tricky).
 """
 
+# Span used when not profiling.
+_NOSPAN = contextlib.nullcontext()
+
+# Leading bytes of compressed input files, and how to open them.
+COMPRESSED_MAGIC = ((b'\x1f\x8b', gzip.open), (b'\xfd7zXZ\x00', lzma.open))
+
+class _Unread(io.RawIOBase):
+    """
+    Raw stream giving bytes already read from stream, then the rest of it.
+    """
+
+    def __init__(self, head, stream):
+        super(_Unread,self).__init__()
+        self.head = head
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.head:
+            data = self.head[:len(b)]
+            self.head = self.head[len(data):]
+        else:
+            data = self.stream.read1(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def open_input(filename):
+    """
+    Open a text file for reading in binary mode, or standard input if
+    filename is '-'. Gzip and xz compressed files are recognised from their
+    first bytes and decompressed as they are read. Return the file and
+    whether it is compressed.
+    """
+    if filename == '-':
+        # Standard input may be a pipe, which may give fewer bytes than
+        # asked for: read its first bytes and put them back in front.
+        head = sys.stdin.buffer.read(6)
+        ifs = io.BufferedReader(_Unread(head, sys.stdin.buffer))
+        for magic, opener in COMPRESSED_MAGIC:
+            if head.startswith(magic):
+                return opener(ifs, 'rb'), True
+        return ifs, False
+    with open(filename, 'rb') as ifs:
+        head = ifs.read(6)
+    for magic, opener in COMPRESSED_MAGIC:
+        if head.startswith(magic):
+            return opener(filename, 'rb'), True
+    return open(filename, 'rb'), False
+
 def _strtobytes( py3string ):
     """
     Convert a Python3 string to UTF-8 bytes to pass as c_char_p to C functions.
@@ -103,6 +251,73 @@ def _bytestostr( ccharpin ):
     else:
         return ccharpin.decode('utf-8')
 
+class _BitWriter(object):
+    """
+    Pack unsigned integers into bytes, most significant bit first, as
+    for linearization hint tables.
+    """
+
+    def __init__(self):
+        super(_BitWriter,self).__init__()
+        self._bytes = bytearray()
+        self._acc = 0
+        self._nbits = 0
+
+    def put(self, value, nbits):
+        """
+        Append value as nbits bits.
+        """
+        self._acc = (self._acc << nbits) | value
+        self._nbits += nbits
+        while self._nbits >= 8:
+            self._nbits -= 8
+            self._bytes.append((self._acc >> self._nbits) & 0xff)
+        self._acc &= (1 << self._nbits) - 1
+
+    def align(self):
+        """
+        Pad with zero bits to a byte boundary.
+        """
+        if self._nbits:
+            self.put(0, 8 - self._nbits)
+
+    def offset(self):
+        """
+        Number of whole bytes written so far.
+        """
+        return len(self._bytes)
+
+    def data(self):
+        """
+        Return the bytes written, padded to a byte boundary.
+        """
+        self.align()
+        return bytes(self._bytes)
+
+class _Template(object):
+    """
+    The parts of a PDF file that are the same in every file (or on every
+    page) made with the same options, formatted once.
+    """
+
+    def __init__(self, converter):
+        super(_Template,self).__init__()
+        self.catalog = "<<\n/Type /Catalog\n/Pages 3 0 R\n>>\n"
+        # An embedded font's dictionary depends on the subset of it used.
+        self.font = converter.fontdict() if converter._ttf is None else None
+        self.resources = converter.resourcesdict(4)
+        # A page object up to its parent, and from there to its contents object number.
+        self.pagehead = "<<\n/Type /Page\n/Parent "
+        self.pagemid = " 0 R\n/Resources 5 0 R\n/Contents "
+        # The start of each page's content stream.
+        self.prologue = "".join(("BT\n/F1 ", str(converter._ptSize), " Tf\n",   # Font size
+                                 "1 0 0 1 50 ", str(converter._pageHt - 40), " Tm\n",   # Text matrix
+                                 str(converter._vertSpace), " TL\n"))   # Text leading (distance vertically between lines).
+        self.greenbar = converter.greenbar() if converter._greenbar else None
+
+# Templates made so far, by option profile (see PyText2Pdf.profile()).
+_templates = {}
+
 class PyText2Pdf(object):
     """
     Text2pdf converter in pure Python.
@@ -119,6 +334,12 @@ class PyText2Pdf(object):
         self._appname = " ".join((self._progname,str(self._version)))
         # default font
         self._font = "/Courier"
+        # TrueType font to embed instead (see ttfont.py), if any, and the
+        # subset of it written.
+        self._ttf = None
+        self._fontSubset = None
+        # Advance width of its space (1/1000 em), if known.
+        self._spaceWidth = SPACE_WIDTHS['Courier']
         # default font size
         self._ptSize = 10
         # default vert space
@@ -138,10 +359,12 @@ class PyText2Pdf(object):
         self._ofile = ""
         # default tab width
         self._tab = 4
-        # input file descriptor
+        # input file descriptor, and whether the input is compressed
         self._ifs = None
-        # output file descriptor
+        self._compressed = False
+        # output file descriptor, and the real output file when linearizing
         self._ofs = None
+        self._outfs = None
         # landscape flag
         self._landscape = False
         # greenbar flag
@@ -154,34 +377,81 @@ class PyText2Pdf(object):
         self._author = ''
         # Keywords
         self._keywords = []
-        
+        # CDC format effector flag and format channel stops (channel: line).
+        self._effectors = False
+        self._channels = {}
+        # Object and cross-reference stream flag, and linearization flag.
+        self._objStreams = False
+        self._linearize = False
+        # Number of processes to render pages with.
+        self._jobs = 1
+        # Profiler (see profiling.py), if any, and whether to write its report.
+        self._profiler = None
+        self._profileReport = False
+        # Maximum pages per volume (0 for no limit), the file being written,
+        # and the (file, first page, last page) of each volume finished.
+        self._volumePages = 0
+        self._outfile = ""
+        self._volumes = []
+        # Pages in the volumes finished.
+        self._pagesDone = 0
+
+        self.resetobjects()
+        # Characters printed, to subset an embedded font to.
+        self._usedChars = set()
+        # Template for the options (see _Template), once they are known.
+        self._template = None
+        # Converters for other output profiles of the same input (--also).
+        self._also = []
+
+    def resetobjects(self):
+        """
+        Forget the objects written, to start a new file.
+        """
         # Marker objects.
         # Attempts to turn off "text knock out" and turn on overprinting
         # do not seem to be necessary to get overprinting to work after all.
+        # Object offsets and page object numbers are kept in compact arrays
+        # as there are millions of them in a big enough listing.
         if False:
             self._curobj = 6
-            self._locations = [0,0,0,0,0,0,0]
         else:
             self._curobj = 5
-            self._locations = [0,0,0,0,0,0]
-        self._pageObs = [0]
+        self._locations = array.array('q', bytes(8 * (self._curobj + 1)))
+        self._pageObs = array.array('q', [0])
         self._pageNo = 0
+        # Leaf nodes of the page tree, one for each PAGE_TREE_FANOUT pages.
+        self._leaves = array.array('q')
+        # Objects waiting for the next object stream, and which stream each
+        # object written to one went to and where in it: stream object << 16
+        # | index, or 0 for an object not in a stream.
+        self._objstmPending = []
+        self._objstmRefs = array.array('q', bytes(8 * (self._curobj + 1)))
+        # Position and length of each page's content stream, in pairs.
+        self._streams = array.array('q')
+        # Content streams written, for identical pages to share: content
+        # hash -> (stream object, position, length), least recently used first.
+        self._pageHashes = collections.OrderedDict()
 
         # file position marker
         self._fpos = 0
 
-    def parse_args(self):   
+    def parse_args(self, argv=None):   
         """
         Callback function called by argument parser.
         Helps to remove duplicate code.
+        argv is the argument list to parse (default: the command line).
         """
-        if len(sys.argv)<2:
-            sys.argv.append('-h')
+        if argv is None:
+            argv = sys.argv[1:]
+        if len(argv)<1:
+            argv = ['-h']
             
         parser = optparse.OptionParser(usage=INTRO)
         parser.add_option('-o','--output',dest='outfile',help='Direct output to file OUTFILE',metavar='OUTFILE')
         parser.add_option('-f','--font',dest='font',help='Use Postscript font FONT (must be in standard 14, default: Courier)',
                           default='Courier')
+        parser.add_option('--ttf',dest='ttf',help='Embed TrueType font file TTF instead of using a standard 14 font (-f).',metavar='TTF')
         parser.add_option('-I','--isolatin',dest='isolatin',help='Use ISO latin-1 encoding',default=False,action='store_true')
         parser.add_option('-s','--size',dest='fontsize',help='Use font at PTSIZE points (default=>10)',metavar='PTSIZE',default=10)
         parser.add_option('-v','--linespace',dest='linespace',help='Use line spacing LINESPACE (default 12)',metavar='LINESPACE',default=12)
@@ -200,8 +470,19 @@ class PyText2Pdf(object):
         parser.add_option('-A','--author',dest='author',help='Optional author for the document',metavar=None)
         parser.add_option('-K','--keywords',dest='keywords',help='Optional list of keywords for the document (separated by commas)',metavar=None)
         parser.add_option('-q','--quiet',dest='quiet',help='Do not print informational messages.',default=False,action='store_true')
+        parser.add_option('-E','--effectors',dest='effectors',help='Interpret CDC column 1 format effectors (one column only).',default=False,action='store_true')
+        parser.add_option('--channels',dest='channels',help='Format channel stops for -E as CHANNEL=LINE,... (default 1=1,12=last line)',metavar='STOPS')
+        parser.add_option('-X','--xrefstream',dest='xrefstream',help='Use compressed object and cross-reference streams (PDF 1.5).',default=False,action='store_true')
+        parser.add_option('-j','--jobs',dest='jobs',help='Render pages in JOBS processes, 0 for one per CPU (default 1). Needs -F.',default=1,metavar='JOBS')
+        parser.add_option('--profile',dest='profile',help='Time the phases of the conversion and write a report next to the output.',default=False,action='store_true')
+        parser.add_option('--profile-mode',dest='profilemode',help='Also profile with MODE ('+' or '.join(PROFILE_MODES)+').',metavar='MODE')
+        parser.add_option('--linearize',dest='linearize',help='Write a linearized ("fast web view") file.',default=False,action='store_true')
+        parser.add_option('--volume',dest='volume',help='Split output over files OUTFILE.partNN.pdf of at most PAGES pages, with an index in OUTFILE (default 0, no split).',
+                          default=0,metavar='PAGES')
+        parser.add_option('--also',dest='also',help='Also write the input with OPTIONS (which must include -o), reading it only once. May be repeated.',
+                          action='append',default=[],metavar='OPTIONS')
         
-        optlist, args = parser.parse_args()
+        optlist, args = parser.parse_args(argv)
         # print optlist.__dict__, args
 
         if len(args) == 0:
@@ -218,8 +499,22 @@ class PyText2Pdf(object):
         if d.get('landscape'): self._landscape = True
         if d.get('greenbar'): self._greenbar = True
         if d.get('quiet'): self._quiet = True
+        if d.get('effectors'): self._effectors = True
+        if d.get('xrefstream'): self._objStreams = True
+        if d.get('linearize'): self._linearize = True
 
         self._font = '/' + d.get('font')
+        ttf = d.get('ttf')
+        if ttf:
+            try:
+                self._ttf = load_font(ttf)
+            except (IOError, ValueError) as e:
+                sys.exit('Error: cannot use TrueType font: '+str(e))
+            self._font = '/' + self._ttf.name
+        if self._ttf is not None:
+            self._spaceWidth = self._ttf.width(' ')
+        else:
+            self._spaceWidth = SPACE_WIDTHS.get(self._font[1:].split('-')[0])
         psize = d.get('papersize')
         if psize == 'A4':
             self._pageWd = 595
@@ -248,6 +543,14 @@ class PyText2Pdf(object):
         if trunc < 4: trunc = 4
         self._trunc = trunc
 
+        jobs = int(d.get('jobs'))
+        if jobs < 1: jobs = os.cpu_count() or 1
+        self._jobs = jobs
+
+        volume = int(d.get('volume'))
+        if volume < 0: volume = 0
+        self._volumePages = volume
+
         tab = int(d.get('tabspace'))
         if tab < 1: tab = 1
         self._tab = tab
@@ -271,8 +574,31 @@ class PyText2Pdf(object):
         if keywords:
             self._keywords = keywords.split(',')
 
+        profilemode = d.get('profilemode')
+        if d.get('profile') or profilemode:
+            if profilemode is not None and profilemode not in PROFILE_MODES:
+                sys.exit('Error: bad profile mode: '+profilemode)
+            self._profiler = Profiler(profilemode)
+            self._profileReport = True
+
+        channels = d.get('channels')
+        if channels:
+            try:
+                for stop in channels.split(','):
+                    chan, line = stop.split('=')
+                    self._channels[int(chan)] = int(line)
+            except ValueError:
+                sys.exit('Error: bad format channel stops: '+channels)
+
         outfile = d.get('outfile')
         if outfile: self._ofile = outfile
+        if self._ifile == '-' and self._ofile == "":
+            self._ofile = '-'
+        if self._ofile == '-':
+            # Messages would be mixed up with the PDF file.
+            self._quiet = True
+            if self._volumePages:
+                sys.exit('Error: --volume needs an output file')
         
         if self._landscape and not self._quiet:
             print('Landscape option on...')
@@ -282,23 +608,85 @@ class PyText2Pdf(object):
             print('Using form feed character...')
         if self._IsoEnc and not self._quiet:
             print('Using ISO Latin Encoding...')
+        if self._effectors and not self._quiet:
+            print('Using CDC format effectors...')
+        if self._linearize and self._objStreams:
+            # Linearized files are written with classic cross-reference tables.
+            self._objStreams = False
+            if not self._quiet:
+                print('Linearizing: not using object streams...')
+        elif self._objStreams and not self._quiet:
+            print('Using object and cross-reference streams...')
+        elif self._linearize and not self._quiet:
+            print('Linearizing...')
 
         if not self._quiet:
             print('Using font',self._font[1:],'size =', self._ptSize)
 
+        for options in d.get('also'):
+            other = PyText2Pdf()
+            other.parse_args([self._ifile] + shlex.split(options) + (['-q'] if self._quiet else []))
+            if other._ofile == "":
+                sys.exit('Error: --also needs -o OUTFILE: '+options)
+            if other._also:
+                sys.exit('Error: --also cannot be used within --also')
+            self._also.append(other)
+
+    def span(self, name):
+        """
+        Return a context manager timing span name if profiling.
+        """
+        if self._profiler is None:
+            return _NOSPAN
+        return self._profiler.span(name)
+
+    def profile(self):
+        """
+        Return the options that the template depends on.
+        """
+        return (self._font, self._IsoEnc, self._ttf is not None, self._ptSize, self._vertSpace,
+                self._pageWd, self._pageHt, self._lines, self._landscape, self._greenbar)
+
+    def template(self):
+        """
+        Return the template for the options, made the first time a profile
+        is used in this process.
+        """
+        if self._template is None:
+            profile = self.profile()
+            self._template = _templates.get(profile)
+            if self._template is None:
+                self._template = _Template(self)
+                _templates[profile] = self._template
+        return self._template
+
     def writestr(self, str):
         """
         Write string to output file descriptor.
         All output operations go through this function.
         We keep the current file position also here.
         """
+        data = _strtobytes(str)
+
         # Update current file position
-        self._fpos += len(str)
-        for x in range(0, len(str)):
-            if str[x] == '\n':
-                self._fpos += LF_EXTRA
+        self._fpos += len(data)
+        if LF_EXTRA:
+            self._fpos += LF_EXTRA * str.count('\n')
         try:
-            self._ofs.write( _strtobytes(str))
+            self._ofs.write(data)
+        except IOError as e:
+            print(e)
+            return -1
+
+        return 0
+
+    def writebytes(self, data):
+        """
+        Write bytes (e.g. compressed stream data) to the output file.
+        """
+        self._fpos += len(data)
+        try:
+            self._ofs.write(data)
         except IOError as e:
             print(e)
             return -1
@@ -309,7 +697,76 @@ class PyText2Pdf(object):
         """
         Perform the actual conversion.
         """
-    
+        if self._also:
+            return self.convert_profiles()
+
+        self.layout()
+        self.openinput()
+        self.startoutput()
+        with self.span('pdf pages'):
+            if self._effectors:
+                self.writepages_fe()
+            elif not self.writepages_parallel():
+                self.writepages()
+        self.finishoutput()
+
+        # Close files.
+        self._ifs.close()
+        return 0
+
+    def convert_profiles(self):
+        """
+        Perform the conversion for these options and each --also profile,
+        reading the input only once: it is read, decoded and split into
+        lines once (see input_lines()), and each block of lines is laid out
+        by every profile in turn. The paginator and the -E engine keep their
+        state from block to block, so the input can be cut after any line.
+        -j is not used.
+        """
+        profiles = [self] + self._also
+        for profile in profiles:
+            profile.layout()
+        self.openinput()
+        names = [profile._ofile for profile in profiles]
+        if len(set(names)) < len(names):
+            sys.exit('Error: each --also profile needs an output file of its own')
+        for profile in profiles:
+            profile._compressed = self._compressed
+            profile.startoutput()
+            if profile._effectors:
+                profile._fe_begin()
+            else:
+                profile._pg_begin()
+
+        for lines, partial in input_lines(self._ifs):
+            for profile in profiles:
+                with profile.span('pdf pages'):
+                    profile.feedpages(lines, partial)
+
+        for profile in profiles:
+            with profile.span('pdf pages'):
+                if profile._effectors:
+                    profile._fe_end()
+                else:
+                    profile._pg_end()
+            profile.finishoutput()
+        self._ifs.close()
+        return 0
+
+    def feedpages(self, lines, partial):
+        """
+        Lay out a block of lines from input_lines() for convert_profiles().
+        """
+        if self._effectors:
+            for text, plain in lines:
+                self._fe_input(text)
+        else:
+            self._pg_input(lines, partial)
+
+    def layout(self):
+        """
+        Work out the page layout from the options.
+        """
         if self._landscape:
             # swap page width & height
             tmp = self._pageHt
@@ -321,217 +778,484 @@ class PyText2Pdf(object):
         if self._lines < 1:
             self._lines = 1
 
+    def openinput(self):
+        """
+        Open the input file, and choose the output file if not given.
+        """
         # Open the input file in binary mode so we get to see carriage returns.
+        # It is only ever read forwards, so may be a pipe.
         try:
-            self._ifs=open(self._ifile, 'rb')
+            self._ifs, self._compressed = open_input(self._ifile)
         except IOError as e:
             print('Error: Could not open file to read --->', self._ifile)
             print('Reason:', e)
             sys.exit(3)
 
         if self._ofile == "":
-            self._ofile = os.path.splitext(self._ifile)[0] + '.pdf'
+            stem = self._ifile
+            if self._compressed:
+                stem = os.path.splitext(stem)[0]
+            self._ofile = os.path.splitext(stem)[0] + '.pdf'
 
-        # Open output file in binary mode.
-        try:
-            self._ofs = open(self._ofile, 'wb')
-        except IOError as e:
-            print('Error: Could not open file to write --->', self._ofile)
-            print('Reason:', e)
-            sys.exit(3)
+    def startoutput(self):
+        """
+        Open the output file and write the start of it.
+        """
+        self.openoutput(self._ofile)
 
         if not self._quiet:
             print('Input file =>',self._ifile)
             print('Writing pdf file',self._ofile, '...')
 
         # Write header, then all pages, then trailer.
-        self.writeheader()
-        self.writepages()
-        self.writerest()
+        if self._profileReport:
+            self._profiler.begin_job()
+        with self.span('pdf header'):
+            self.writeheader()
+
+    def finishoutput(self):
+        """
+        Write the end of the output file, and the volume index if any.
+        """
+        self.closeoutput()
+        if self._volumes:
+            self.endvolume()
+            with self.span('pdf index'):
+                self.writeindex()
 
         if not self._quiet:
             print('Wrote file', self._ofile)
+            if self._volumes:
+                print('Wrote', len(self._volumes), 'volumes', self._volumes[0][0], '...')
+        if self._profileReport:
+            stem = self._ofile if self._ofile != '-' else self._ifile if self._ifile != '-' else 'text2pdf'
+            report = self._profiler.end_job(os.path.splitext(stem)[0])
+            if not self._quiet:
+                print('Wrote profile', report)
+
+    def openoutput(self, filename):
+        """
+        Open output file filename, or standard output if filename is '-'.
+        Output is only ever written forwards, so that may be a pipe. When
+        linearizing, the file is first written as usual to a temporary
+        file, then rearranged.
+        """
+        # Open output file in binary mode.
+        try:
+            self._outfs = open(filename, 'wb') if filename != '-' else sys.stdout.buffer
+        except IOError as e:
+            print('Error: Could not open file to write --->', filename)
+            print('Reason:', e)
+            sys.exit(3)
+        self._outfile = filename
+        if self._linearize:
+            self._ofs = tempfile.TemporaryFile()
+        else:
+            self._ofs = self._outfs
 
-        # Close files.
-        self._ifs.close()
-        self._ofs.close()
-        return 0
+    def closeoutput(self):
+        """
+        Finish the output file: write the trailer, linearize if wanted, and
+        close it.
+        """
+        with self.span('pdf trailer'):
+            self.writerest()
+
+        if self._linearize:
+            tmpfs = self._ofs
+            self._ofs = self._outfs
+            with self.span('pdf linearize'):
+                self.writelinearized(tmpfs)
+            tmpfs.close()
+        if self._ofs is sys.stdout.buffer:
+            self._ofs.flush()
+        else:
+            self._ofs.close()
 
-    def writeheader(self):
+    def volumename(self, num):
         """
-        Write the PDF header
+        Return the file name of volume num.
         """
-        ws = self.writestr
+        return "%s.part%02d.pdf"%(os.path.splitext(self._ofile)[0], num)
 
-        title = self._ifile
+    def endvolume(self):
+        """
+        Record the volume just closed. The first is renamed from the output
+        file name when the second is started.
+        """
+        num = len(self._volumes) + 1
+        if num == 1:
+            os.replace(self._ofile, self.volumename(1))
+        self._volumes.append((self.volumename(num), self._pagesDone + 1, self._pagesDone + self._pageNo))
+        self._pagesDone += self._pageNo
+
+    def newvolume(self):
+        """
+        Close the full volume being written and start the next. Only the
+        objects of one volume are ever kept track of.
+        """
+        self.closeoutput()
+        self.endvolume()
+        self.resetobjects()
+        self.openoutput(self.volumename(len(self._volumes) + 1))
+        self.writeheader()
+
+    def writeindex(self):
+        """
+        Write the output file as an index of the volumes: a line for each,
+        linked to it.
+        """
+        # The index is small, so is never linearized or split.
+        self._linearize = False
+        self._volumePages = 0
+        self.resetobjects()
+        self.openoutput(self._ofile)
+        self.writeheader()
+
+        title = os.path.basename(os.path.splitext(self._ofile)[0])
+        lines = ["%s: %d pages in %d volumes"%(title, self._pagesDone, len(self._volumes)), ""]
+        links = {}
+        for filename, first, last in self._volumes:
+            links[len(lines)] = os.path.basename(filename)
+            lines.append("Volume %d  pages %d - %d  %s"%(len(links), first, last, os.path.basename(filename)))
+        per = max(1, int(self._lines))
+        for start in range(0, len(lines), per):
+            self.writeindexpage(lines[start:start + per], dict((i - start, links[i]) for i in links
+                                                              if start <= i < start + per))
+        self.closeoutput()
+
+    def writeindexpage(self, lines, links):
+        """
+        Write a page of the index. links maps line numbers on the page to
+        the volume files they link to.
+        """
+        parent = self.pageparent()
+        self._pageNo += 1
+        pageobj = self.newobj()
+        self._pageObs.append(pageobj)
+        contentsobj = self.newobj()
+        annots = []
+        for i in sorted(links):
+            annots.append((self.newobj(), i, links[i]))
+        self.writeobj(pageobj, self.pagedict(parent, contentsobj, annots=[num for num, i, link in annots]))
+
+        top = self._pageHt - 40
+        buf = [self.template().prologue]
+        for line in lines:
+            self._usedChars.update(line)
+            buf.extend(("(", line.translate(PDF_STRING_TABLE), ")'\n"))
+        buf.append("ET\n")
+        data = _strtobytes("".join(buf))
+        self._locations[contentsobj] = self._fpos
+        self.writestr("".join((str(contentsobj), " 0 obj\n<<\n/Length ", str(len(data)), "\n>>\nstream\n")))
+        self.writebytes(data)
+        self.writestr("endstream\nendobj\n")
+
+        # Line i is drawn (i + 1) line spaces below the top.
+        for num, i, link in annots:
+            base = top - (i + 1) * self._vertSpace
+            self.writeobj(num, "".join(("<<\n/Type /Annot\n/Subtype /Link\n/Rect [ 50 ", str(base - 2), " ",
+                                        str(self._pageWd - 50), " ", str(base + self._ptSize), " ]\n/Border [ 0 0 0 ]\n",
+                                        "/A << /S /GoToR /F (", link.translate(PDF_STRING_TABLE),
+                                        ") /D [ 0 /Fit ] /NewWindow true >>\n>>\n")))
+
+    def infodict(self):
+        """
+        Return the body of the document information dictionary.
+        """
+        # Standard input has no name to use.
+        title = self._ifile if self._ifile != '-' else ''
 
-        # Use PDF 1.4
         t = time.localtime()
         utc_offset = time.strftime("%z", t)
         utc_offset_pdf = utc_offset[:3] + "'" + utc_offset[3:] + "'"
         timestr = time.strftime("D:%Y%m%d%H%M%S", t) + utc_offset_pdf
         # print('timestr =', timestr)
-        ws("%PDF-1.4\n")
-
-        # Output required dictionaries.
-        self._locations[1] = self._fpos
-        ws("1 0 obj\n")
-        ws("<<\n")
 
-        buf = "".join(("/Creator (", self._appname, " By Anand B Pillai and others)\n"))
-        ws(buf)
-        buf = "".join(("/CreationDate (", timestr, ")\n"))
-        ws(buf)
-        buf = "".join(("/Producer (", self._appname, "(\\251 Anand B Pillai and others))\n"))
-        ws(buf)
+        buf = ["<<\n"]
+        buf.append("".join(("/Creator (", self._appname, " By Anand B Pillai and others)\n")))
+        buf.append("".join(("/CreationDate (", timestr, ")\n")))
+        buf.append("".join(("/Producer (", self._appname, "(\\251 Anand B Pillai and others))\n")))
         if self._subject:
             title = self._subject
-            buf = "".join(("/Subject (",self._subject,")\n"))
-            ws(buf)
+            buf.append("".join(("/Subject (",self._subject,")\n")))
         if self._author:
-            buf = "".join(("/Author (",self._author,")\n"))
-            ws(buf)
+            buf.append("".join(("/Author (",self._author,")\n")))
         if self._keywords:
-            buf = "".join(("/Keywords (",' '.join(self._keywords),")\n"))
-            ws(buf)
+            buf.append("".join(("/Keywords (",' '.join(self._keywords),")\n")))
 
         if title:
-            buf = "".join(("/Title (", title, ")\n"))
-            ws(buf)
+            buf.append("".join(("/Title (", title, ")\n")))
 
-        ws(">>\n")
-        ws("endobj\n")
-    
-        self._locations[2] = self._fpos
+        buf.append(">>\n")
+        return "".join(buf)
 
-        ws("2 0 obj\n")
-        ws("<<\n")
-        ws("/Type /Catalog\n")
-        ws("/Pages 3 0 R\n")
-        ws(">>\n")
-        ws("endobj\n")
-        
-        self._locations[4] = self._fpos
-        ws("4 0 obj\n")
-        ws("<<\n")
-        buf = "".join(("/BaseFont ", str(self._font), " /Encoding /WinAnsiEncoding /Name /F1 /Subtype /Type1 /Type /Font >>\n"))
-        ws(buf)
-    
+    def fontdict(self, descriptor=None):
+        """
+        Return the body of the font dictionary. An embedded TrueType font
+        has its font descriptor in object descriptor.
+        """
         if self._IsoEnc:
-            ws(ENCODING_STR)
-            
-        ws(">>\n")
-        ws("endobj\n")
+            encoding = ENCODING_STR
+        else:
+            encoding = "/Encoding /WinAnsiEncoding\n"
+        if self._ttf is None:
+            return "".join(("<<\n/BaseFont ", str(self._font), "\n", encoding, "/Name /F1 /Subtype /Type1 /Type /Font\n>>\n"))
+
+        buf = ["<<\n/BaseFont /", self._fontSubset[0], "+", self._ttf.name, "\n", encoding,
+               "/FirstChar 32 /LastChar 255\n/Widths ["]
+        for code in range(32, 256):
+            if code % 16 == 0:
+                buf.append("\n")
+            buf.append("".join((" ", str(self._ttf.width(winansi(code))))))
+        buf.append("".join((" ]\n/FontDescriptor ", str(descriptor), " 0 R\n/Name /F1 /Subtype /TrueType /Type /Font\n>>\n")))
+        return "".join(buf)
+
+    def fontdescriptor(self, fontfile):
+        """
+        Return the body of the font descriptor of an embedded TrueType font,
+        whose font file is object fontfile.
+        """
+        ttf = self._ttf
+        flags = 32 + (1 if ttf.fixedPitch else 0)    # Nonsymbolic, fixed pitch.
+        bbox = " ".join(str(ttf.scale(v)) for v in ttf.bbox)
+        return "".join(("<<\n/Type /FontDescriptor\n/FontName /", self._fontSubset[0], "+", ttf.name,
+                        "\n/Flags ", str(flags), "\n/FontBBox [ ", bbox, " ]\n/ItalicAngle ", "%g"%ttf.italicAngle,
+                        "\n/Ascent ", str(ttf.scale(ttf.ascent)), "\n/Descent ", str(ttf.scale(ttf.descent)),
+                        "\n/CapHeight ", str(ttf.scale(ttf.capHeight)), "\n/StemV 80\n/FontFile2 ", str(fontfile),
+                        " 0 R\n>>\n"))
+
+    def fontfile(self, num):
+        """
+        Return the font file stream of an embedded TrueType font as
+        object num.
+        """
+        tag, data, compressed = self._fontSubset
+        return b"".join((_strtobytes("%d 0 obj\n<<\n/Length %d\n/Length1 %d\n/Filter /FlateDecode\n>>\nstream\n"%(
+                             num, len(compressed), len(data))),
+                         compressed, b"\nendstream\nendobj\n"))
 
-        # Resources object.
-        self._locations[5] = self._fpos
-        
-        ws("5 0 obj\n")
-        ws("<<\n")
-        ws("  /Font << /F1 4 0 R >>\n")
-        ws("  /ProcSet [ /PDF /Text ]\n")
-        ws(">>\n")
-        ws("endobj\n")
+    def subsetfont(self):
+        """
+        Subset the embedded TrueType font to the characters printed.
+        """
+        self._fontSubset = self._ttf.subset(winansi(ord(ch)) for ch in self._usedChars if ord(ch) < 256)
 
-        # Attempts to turn off "text knock out" and turn on overprinting
-        # do not seem to be necessary to get overprinting to work after all.
-        if False:
-            self._locations[6] = self._fpos
-
-            ws("6 0 obj\n")
-            ws("<<\n")
-            ws("  /Type /ExtGState\n")
-            ws("  /TK false\n")
-            ws("  /OP true\n")
-            ws(">>\n")
-            ws("endobj\n")
-    
-    def startpage(self):
+    def writettfont(self):
         """
-        Start a page of data.
+        Write the embedded TrueType font (object 4), its descriptor and its
+        font file. This is done at the end, once the characters printed are
+        known.
         """
-        ws = self.writestr
+        self.subsetfont()
+        descobj = self.newobj()
+        fileobj = self.newobj()
+        self.writeobj(4, self.fontdict(descobj))
+        self.writeobj(descobj, self.fontdescriptor(fileobj))
+        self._locations[fileobj] = self._fpos
+        self.writebytes(self.fontfile(fileobj))
+
+    def resourcesdict(self, fontobj):
+        """
+        Return the body of the resources dictionary.
+        """
+        return "".join(("<<\n  /Font << /F1 ", str(fontobj), " 0 R >>\n  /ProcSet [ /PDF /Text ]\n>>\n"))
 
-        # Maintain page and object counts. Get current output file offset.
-        self._pageNo += 1
+    def pagedict(self, parent, contents, resources=5, mediabox=False, annots=None):
+        """
+        Return the body of a page dictionary. The media box is normally
+        inherited from the page tree.
+        """
+        buf = ["<<\n/Type /Page\n/Parent ", str(parent), " 0 R\n"]
+        if mediabox:
+            buf.extend(("/MediaBox [ 0 0 ", str(self._pageWd), " ", str(self._pageHt), " ]\n"))
+        if annots:
+            buf.append("".join(("/Annots [ ", " ".join("%d 0 R"%num for num in annots), " ]\n")))
+        buf.extend(("/Resources ", str(resources), " 0 R\n/Contents ", str(contents), " 0 R\n>>\n"))
+        return "".join(buf)
+
+    def pagesdict(self, kids, count=None, parent=None):
+        """
+        Return the body of a page tree node for the list of kids, which
+        have count pages between them (default: kids are pages). The root
+        has no parent and holds the media box for all pages.
+        """
+        if count is None:
+            count = len(kids)
+        buf = ["<<\n/Type /Pages\n"]
+        if parent is not None:
+            buf.append("".join(("/Parent ", str(parent), " 0 R\n")))
+        buf.append("".join(("/Count ", str(count), "\n")))
+        if parent is None:
+            buf.append("".join(("/MediaBox [ 0 0 ", str(self._pageWd), " ", str(self._pageHt), " ]\n")))
+        buf.append("/Kids [ ")
+        for kid in kids:
+            buf.append("".join((str(kid), " 0 R ")))
+        buf.append("]\n>>\n")
+        return "".join(buf)
+
+    def newobj(self):
+        """
+        Allocate the next object number.
+        """
         self._curobj += 1
+        self._locations.append(0)
+        self._objstmRefs.append(0)
+        return self._curobj
 
-        self._locations.append(self._fpos)
-        self._locations[self._curobj]=self._fpos
-    
-        self._pageObs.append(self._curobj)
-        self._pageObs[self._pageNo] = self._curobj
+    def writeobj(self, num, body):
+        """
+        Write a (non-stream) object, or add it to the pending object
+        stream if using object streams.
+        """
+        if self._objStreams:
+            self._objstmPending.append((num, body))
+            return
+        self._locations[num] = self._fpos
+        self.writestr("".join((str(num), " 0 obj\n", body, "endobj\n")))
 
-        # Output page object.
-        buf = "".join((str(self._curobj), " 0 obj\n"))
+    def flushobjstm(self):
+        """
+        Write pending objects as a compressed object stream.
+        """
+        if not self._objstmPending:
+            return
+        stm = self.newobj()
+        offsets = []
+        bodies = []
+        pos = 0
+        for i in range(len(self._objstmPending)):
+            num, body = self._objstmPending[i]
+            self._objstmRefs[num] = (stm << 16) | i
+            offsets.append("%d %d"%(num, pos))
+            body = _strtobytes(body)
+            bodies.append(body)
+            pos += len(body)
+        head = _strtobytes(" ".join(offsets) + "\n")
+        data = zlib.compress(head + b"".join(bodies))
+
+        self._locations[stm] = self._fpos
+        self.writestr("%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode /Length %d >>\nstream\n"%(
+            stm, len(bodies), len(head), len(data)))
+        self.writebytes(data)
+        self.writestr("\nendstream\nendobj\n")
+        self._objstmPending = []
 
-        ws(buf)
-        ws("<<\n")
-        ws("/Type /Page\n")
-        ws("/Parent 3 0 R\n")
-        ws("/Resources 5 0 R\n")
+    def writeheader(self):
+        """
+        Write the PDF header
+        """
+        ws = self.writestr
 
-        self._curobj += 1
-        buf = "".join(("/Contents ", str(self._curobj), " 0 R\n"))
-        ws(buf)
-        ws(">>\n")
-        ws("endobj\n")
+        # Use PDF 1.4, or PDF 1.5 for object and cross-reference streams.
+        if self._objStreams:
+            ws("%PDF-1.5\n")
+            self.writebytes(b"%\xe2\xe3\xcf\xd3\n")   # Binary file marker.
+        else:
+            ws("%PDF-1.4\n")
 
-        # Output stream object.
-        self._locations.append(self._fpos)
-        self._locations[self._curobj] = self._fpos
+        # Output required dictionaries.
+        template = self.template()
+        self._infoBody = self.infodict()
+        self.writeobj(1, self._infoBody)
+        self.writeobj(2, template.catalog)
+        # An embedded TrueType font is written by writerest().
+        if self._ttf is None:
+            self.writeobj(4, template.font)
 
-        buf = "".join((str(self._curobj), " 0 obj\n"))
-        ws(buf)
-        ws("<<\n")
-        
-        buf = "".join(("/Length ", str(self._curobj + 1), " 0 R\n"))
-        ws(buf)
-        ws(">>\n")
-        ws("stream\n")
-        strmPos = self._fpos
+        # Resources object.
+        self.writeobj(5, template.resources)
+
+        # Attempts to turn off "text knock out" and turn on overprinting
+        # do not seem to be necessary to get overprinting to work after all.
+        if False:
+            self.writeobj(6, "<<\n  /Type /ExtGState\n  /TK false\n  /OP true\n>>\n")
+    
+    def startpage(self):
+        """
+        Start a page of data.
+        """
+        strmPos = self.beginstream()
 
         # Transformation matrix, etc. This is for text drawing.
-        ws("BT\n");
-        buf = "".join(("/F1 ", str(self._ptSize), " Tf\n")) # Font size
-        ws(buf)
-        buf = "".join(("1 0 0 1 50 ", str(self._pageHt - 40), " Tm\n")) # Text matrix
-        #buf = "".join(("1 0 0 1 50 ", str(self._pageHt - 112), " Tm\n")) # Text matrix 
-        ws(buf)
-        buf = "".join((str(self._vertSpace), " TL\n")) # Text leading (distance vertically between lines).
-        ws(buf)
+        self.writestr(self.template().prologue)
     
         return strmPos
 
+    def beginstream(self):
+        """
+        Start a new page. Its content stream is gathered in memory, and
+        its objects written by finishstream(). Return the position of the
+        stream data.
+        """
+        # Start another volume if this one is full.
+        if self._volumePages and self._pageNo >= self._volumePages:
+            self.newvolume()
+
+        # Maintain page and object counts.
+        self._pageParent = self.pageparent()
+        self._pageNo += 1
+        self._pageObs.append(self.newobj())
+
+        # Divert output to the page's buffer.
+        self._pageOfs, self._ofs = self._ofs, io.BytesIO()
+        self._pageFpos, self._fpos = self._fpos, 0
+        return self._fpos
+
     def endpage(self, streamStart):
         """
         End a page of data.
         """
-        ws = self.writestr
+        self.writestr("ET\n")
+        self.finishstream(streamStart)
 
-        # End stream.
-        ws("ET\n")
-        streamEnd = self._fpos
-        ws("endstream\n")
-        ws("endobj\n")
-
-        # Track output file offsets for objects.
-        self._curobj += 1
-        self._locations.append(self._fpos)
-        self._locations[self._curobj] = self._fpos
+    def finishstream(self, streamStart):
+        """
+        End the content stream of a page started at streamStart and write
+        the page object, then its content stream and length. A page the same
+        as one written recently (blank pages, repeated banner pages) shares
+        that one's content stream instead.
+        """
+        ws = self.writestr
+        data = self._ofs.getvalue()[streamStart:]
+        self._ofs, self._fpos = self._pageOfs, self._pageFpos
+        pageobj = self._pageObs[-1]
+        template = self.template()
+
+        key = hashlib.sha256(data).digest()
+        known = self._pageHashes.get(key)
+        if known is not None:
+            self._pageHashes.move_to_end(key)
+            contentsobj, start, length = known
+            self.writeobj(pageobj, "".join((template.pagehead, str(self._pageParent), template.pagemid,
+                                            str(contentsobj), " 0 R\n>>\n")))
+        else:
+            # Output page object, then the stream object. Its length follows
+            # it as the next object.
+            contentsobj = self.newobj()
+            self.writeobj(pageobj, "".join((template.pagehead, str(self._pageParent), template.pagemid,
+                                            str(contentsobj), " 0 R\n>>\n")))
+            self._locations[contentsobj] = self._fpos
+            ws("".join((str(contentsobj), " 0 obj\n<<\n/Length ", str(contentsobj + 1), " 0 R\n>>\nstream\n")))
+            start = self._fpos
+            length = len(data)
+            self.writebytes(data)
+            ws("endstream\n")
+            ws("endobj\n")
+            self.writeobj(self.newobj(), "".join((str(length), '\n')))
+            self._pageHashes[key] = (contentsobj, start, length)
+            if len(self._pageHashes) > DEDUP_PAGES:
+                self._pageHashes.popitem(last=False)
+        self._streams.append(start)
+        self._streams.append(length)
 
-        # End page object.
-        buf = "".join((str(self._curobj), " 0 obj\n"))
-        ws(buf)
-        buf = "".join((str(streamEnd - streamStart), '\n'))
-        ws(buf)
-        ws('endobj\n')
+        if self._objStreams and len(self._objstmPending) >= OBJSTM_SIZE:
+            self.flushobjstm()
 
     def pdfellipse(self,x,y,xr,yr):
         """
-        Draw an ellipse for greenbar tractor hole ornamentation.
+        Return the drawing of an ellipse for greenbar tractor hole ornamentation.
         """
-        ws = self.writestr
         bezmagic = 0.551784
         xtang = xr * bezmagic
         ytang = yr * bezmagic
@@ -551,248 +1275,495 @@ class PyText2Pdf(object):
                                                                  x-xtang, y-yr,
                                                                  x-xr, y-ytang,
                                                                  x-xr, y )
-        ws(gbuf)         
+        return gbuf
     
+    def drawgreenbar(self):
+        """
+        Draw the "green bar" paper ornamentation on the current page.
+        """
+        self.writestr(self.template().greenbar)
+
+    def greenbar(self):
+        """
+        Return the drawing of the "green bar" paper ornamentation of a page.
+        """
+        buf = []
+        ws = buf.append
+
+        # Bars.
+        barMargin = 30
+        barLines = 3
+        gbuf = '%d w 0.8 1.0 0.8 RG\n'%(barLines * self._vertSpace) # Line with width = bar height.
+        ws(gbuf)
+        ypos = 4 * self._vertSpace
+        if self._landscape:
+            ypos -= (self._vertSpace/4-1)
+        else:
+            ypos += (self._vertSpace/3)
+            if self._vertSpace == 6:
+                ypos += 2
+        #print('ypos =', ypos, self._vertSpace)
+        for gline in range(barLines,self._lines+8):
+            if((gline%(barLines * 2))==0): # Draw a bar (i.e. a line).
+                gbuf = '%d %d m %d %d l S\n'%(barMargin,ypos,self._pageWd-barMargin,ypos)
+                ws(gbuf)
+            ypos += self._vertSpace
+
+        # HCCC text.
+        if False:
+            ypos += (barLines-1) * self._vertSpace
+            xpos = 30
+            gbuf='3 w %d %d m %d %d l S\n'%(xpos,ypos,xpos,ypos+27)
+            ws(gbuf)
+            gbuf='%d %d m %d %d l S\n'%(xpos,ypos+13,xpos+18,ypos+13)
+            ws(gbuf)
+            gbuf='%d %d m %d %d l S\n'%(xpos+18,ypos,xpos+18,ypos+27)
+            ws(gbuf)
+            for hchar in range(1,4):
+                xpos += 26
+                gbuf='%d %d m %d %d l S\n'%(xpos,ypos,xpos,ypos+27)
+                ws(gbuf)
+                gbuf='%d %d m %d %d l S\n'%(xpos,ypos+1,xpos+18,ypos+1)
+                ws(gbuf)
+                gbuf='%d %d m %d %d l S\n'%(xpos,ypos+26,xpos+18,ypos+26)
+                ws(gbuf)
+
+        # Tractor holes.
+        tractMargin = 15
+        gbuf = '%d w 0.3 0.3 0.3 RG\n'%(self._vertSpace)
+        ws(gbuf)
+        ypos = 4 * self._vertSpace
+        if self._landscape:
+            ypos -= (self._vertSpace/4-1)
+        else:
+            ypos += (self._vertSpace/3)                    
+        for gline in range(0,self._lines+2):
+            if((gline%4)==0):
+                ws(self.pdfellipse(tractMargin,ypos,1,1))
+                ws(self.pdfellipse(self._pageWd-tractMargin,ypos,1,1))
+            ypos += self._vertSpace
+        return "".join(buf)
+
+    def showtext(self, text, op):
+        """
+        Return the operator showing string body text: op is "'" (on the next
+        line) or " Tj". Long runs of spaces are moved over with a TJ array
+        instead of printed, when the width of a space is known and that is
+        shorter. Trailing spaces are then left out.
+        """
+        plain = "".join(("(", text, ")", op, "\n"))
+        if self._spaceWidth is None or SPACE_RUN.search(text) is None:
+            return plain
+        text = text.rstrip(' ')
+        buf = ["T* [" if op == "'" else "["]
+        start = 0
+        for run in SPACE_RUN.finditer(text):
+            if run.start() > start:
+                buf.append("".join(("(", text[start:run.start()], ")")))
+            buf.append(str(-self._spaceWidth * (run.end() - run.start())))
+            start = run.end()
+        buf.append("".join(("(", text[start:], ")] TJ\n")))
+        shown = "".join(buf)
+        return shown if len(shown) < len(plain) else plain
+
     def writepages(self):
         """
         Write pages as PDF
         """
+        self._pg_begin()
+        for lines, partial in input_lines(self._ifs):
+            self._pg_input(lines, partial)
+        self._pg_end()
+
+    def _pg_begin(self):
+        """
+        Set up the paginator. It is given the input a block of lines at a
+        time (see input_lines()) and keeps its place from block to block.
+        """
+        # Content stream of the page being written, if any, and whether
+        # any page has been.
+        self._pgStream = None
+        self._pgStarted = False
+        # Print column (1 or 2) and line in it, and whether the column is
+        # full (or ended by a form feed).
+        self._pgColumn = 1
+        self._pgLine = 0
+        self._pgDone = False
+        # Whether a form feed starting the next line is to be skipped, as
+        # the page it would end has just been filled.
+        self._pgSkipFF = False
+
+    def _pg_input(self, lines, partial):
+        """
+        Lay out a block of input lines, (text, plain) pairs from
+        input_lines(). The last has no newline if partial.
+        """
+        cols = self._cols
+        width = min(cols, self._trunc)
+        last = len(lines) - 1
+        for i in range(len(lines)):
+            text, plain = lines[i]
+            if not plain:
+                self._pg_text(text, not (partial and i == last))
+                continue
+            # Printable characters only: cut into lines of cols characters,
+            # each truncated. A line filled exactly is followed by an empty
+            # one, for its newline.
+            n = len(text)
+            for start in range(0, n, cols):
+                self._pgSkipFF = False
+                self._pg_line(text[start:start+width].translate(PDF_ESCAPE_TABLE), False)
+            if n % cols == 0 and not (partial and i == last):
+                self._pgSkipFF = False
+                self._pg_line('', False)
+
+    def _pg_text(self, text, newline):
+        """
+        Lay out an input line with tabs, carriage returns, form feeds or
+        other special characters in it, one character at a time. newline
+        is False if the line is the last of the input and has no newline.
+        """
+        cols, trunc, tab = self._cols, self._trunc, self._tab
+        n = len(text)
+        pos = 0
+        while True:
+            if self._pgSkipFF:
+                self._pgSkipFF = False
+                if pos < n and text[pos] == FF:
+                    pos += 1
+            start = pos
+            buf = []
+            charNo = 0
+            end = None
+            # Loop over characters of line allowed before possibly wrapping to the next line.
+            while charNo < cols:
+                charNo += 1
+                if pos == n:
+                    end = 'newline' if newline else 'eof'
+                    break
+                ch = text[pos]
+                pos += 1
+                if ch == FF and self._doFFs:
+                    end = 'ff'
+                    break
+                code = ord(ch)
+                if 32 <= code <= 127:
+                    # Output printing character. Escape parentheses and backslashes.
+                    if charNo <= trunc:
+                        buf.append(ch.translate(PDF_ESCAPE_TABLE))
+                elif code == 9:  # tab
+                    padding = tab - ((charNo - 1) % tab)
+                    buf.append(' ' * padding)
+                    charNo += (padding - 1)
+                elif code == 13:  # CR
+                    charNo = 0
+                    buf.append(ch)
+                elif ch == FF:
+                    # dont print anything for a FF
+                    charNo -= 1
+                elif code < 128:
+                    # write \xxx form for dodgy character
+                    buf.append('\\' + ch)
+                else:
+                    buf.append('\\%03o'%code)
+            if end == 'eof' and pos == start:
+                break
+            self._pg_line(''.join(buf), end == 'ff')
+            if end == 'newline' or end == 'eof':
+                break
+
+    def _pg_line(self, linebuf, ff):
+        """
+        Print an output line, escaped, starting a column or page if need
+        be. ff is True if it was ended by a form feed.
+        """
         ws = self.writestr
+        if self._pgStream is None:
+            # Start a page.
+            self._pgStream = self.startpage()
+            self._pgStarted = True
+            self._pgColumn = 1
+            self._pgLine = 0
+            # Handle "green bar" ornamentation.
+            if self._greenbar:
+                with self.span('greenbar'):
+                    self.drawgreenbar()
+        elif self._pgDone:
+            # Move to second column of print.
+            self._pgColumn += 1
+            self._pgLine = 0
+        self._pgDone = False
+        self._pgLine += 1
+
+        self._usedChars.update(linebuf)
+        # Write the accumulated output string as one or more lines.
+        # This would be trivial, apart from getting overstrike to work.
+        # A CR at the end of the line is ignored. The text before the
+        # first other CR goes on a new line; the text after each CR
+        # goes back to the start of that line and overprints it.
+        if linebuf.endswith('\r'):
+            linebuf = linebuf[:-1]
+        segments = linebuf.split('\r')
+        ws(self.showtext(segments[0], "'"))
+        for segment in segments[1:]:
+            ws("0 0 Td ")
+            ws(self.showtext(segment, " Tj"))
+
+        # Check end of column conditions. After a column filled by its line
+        # count, a form feed starting the next line is skipped.
+        if self._pgLine == self._lines:
+            self._pgDone = True
+            self._pgSkipFF = True
+        elif ff:
+            self._pgDone = True
+        if self._pgDone and self._pgColumn >= self._columns:
+            # End a page.
+            self.endpage(self._pgStream)
+            self._pgStream = None
 
-        beginstream = 0
-        lineNo, charNo = 0,0
-        ch, column = 0,0
-        padding,i = 0,0
-        atEOF = 0
-        linebuf = ''
+    def _pg_end(self):
+        """
+        Finish the paginator's last page. Lines after the end of the input
+        are empty, until the column is full, and there is always a page.
+        """
+        if self._pgStarted and (self._pgStream is None or self._pgDone):
+            if self._pgStream is not None:
+                self.endpage(self._pgStream)
+                self._pgStream = None
+            return
+        while True:
+            self._pg_line('', False)
+            if self._pgDone:
+                break
+        if self._pgStream is not None:
+            self.endpage(self._pgStream)
+            self._pgStream = None
+
+    def pagechunks(self):
+        """
+        Return (start, end) byte ranges of the input that can be paginated
+        independently, or None if it cannot be split. A range ends just
+        after a form feed that is followed by something other than another
+        form feed, where the serial renderer always starts a new page.
+        (After a page filled by its line count, one form feed is skipped,
+        so a second one in a row might not start a page.)
+        """
+        if not self._doFFs or self._columns != 1 or self._compressed or self._ifile == '-':
+            return None
+        size = os.fstat(self._ifs.fileno()).st_size
+        if size < 2 * CHUNK_SIZE:
+            return None
+
+        # Look for a cut from CHUNK_SIZE bytes after the last one on.
+        # Blocks overlap by a byte so that the byte after a form feed is seen.
+        cuts = [0]
+        ff = FF.encode('latin-1')
+        pos = CHUNK_SIZE
+        while pos < size:
+            self._ifs.seek(pos)
+            data = self._ifs.read(CHUNK_SIZE + 1)
+            i = data.find(ff)
+            while i >= 0 and i + 1 < len(data) and data[i+1:i+2] == ff:
+                i = data.find(ff, i + 1)
+            if i >= 0 and i + 1 < len(data):
+                cuts.append(pos + i + 1)
+                pos += i + 1 + CHUNK_SIZE
+            else:
+                pos += CHUNK_SIZE
+        self._ifs.seek(0)
+
+        cuts.append(size)
+        ranges = [(cuts[i], cuts[i+1]) for i in range(len(cuts) - 1)]
+        if len(ranges) < 2:
+            return None
+        return ranges
+
+    def writepages_parallel(self):
+        """
+        Write pages as PDF, rendering chunks of the input in a pool of
+        self._jobs processes and writing the pages in order, as writepages()
+        would have. Return False, having written nothing, if the input is
+        not worth or not able to be split.
+        """
+        if self._jobs < 2:
+            return False
+        ranges = self.pagechunks()
+        if ranges is None:
+            return False
+
+        state = {}
+        for name in _RENDER_STATE:
+            state[name] = getattr(self, name)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self._jobs) as pool:
+            results = pool.map(_render_chunk, [(state, self._ifile, start, end) for start, end in ranges])
+            for pages, used in results:
+                self._usedChars.update(used)
+                for content in pages:
+                    strmPos = self.beginstream()
+                    self.writebytes(content)
+                    self.finishstream(strmPos)
+        return True
+
+    def writepages_fe(self):
+        """
+        Write pages as PDF, interpreting CDC column 1 format effectors.
+        Each whole input line drives a small state machine through FE_TABLE:
+        the state is the vertical position on the page, whether a page is
+        open, the line spacing and any suppressed spacing.
+        Form feeds are honoured as page ejects.
+        """
+        self._fe_begin()
+        for lines, partial in input_lines(self._ifs):
+            for text, plain in lines:
+                self._fe_input(text)
+        self._fe_end()
+
+    def _fe_begin(self):
+        """
+        Set up the format effector engine.
+        """
+        # Vertical position: points below the top text position. Line n of
+        # a page is at n * self._vertSpace. Nothing is printed at 0.
+        self._feDepth = 0
+        self._feLeading = self._vertSpace
+        self._feSuppress = 0
+        # Auto page eject (R, the default) or continuous paper (Q).
+        self._feAutoEject = True
+        self._feStream = None
+
+    def _fe_input(self, line):
+        """
+        Process one input line: form feeds in it eject pages.
+        """
+        line = line.rstrip('\r')
+        pieces = line.split(FF)
+        for i in range(len(pieces)):
+            if i > 0:
+                self._fe_newpage()
+            if pieces[i] != '' or len(pieces) == 1:
+                self._fe_line(pieces[i])
+
+    def _fe_end(self):
+        """
+        Finish the format effector engine's last page.
+        """
+        # Always produce at least one page.
+        if self._feStream is None and self._pageNo == 0:
+            self._fe_openpage()
+        self._fe_newpage()
 
-        # Loop until at EOF.
-        while not atEOF:
+    def _fe_line(self, line):
+        """
+        Process one line: column 1 is the format effector.
+        """
+        before, barg, after, aarg = FE_TABLE.get(line[:1], FE_DEFAULT)
+
+        # Mode setting lines are not printed.
+        if before == 'mode':
+            if barg == 'eject' or barg == 'noeject':
+                self._feAutoEject = (barg == 'eject')
+            else:
+                self._feLeading = self._vertSpace * 6.0 / barg
+            return
+
+        # Act before printing.
+        if before == 'space':
+            nlines = max(0, barg - self._feSuppress)
+            self._feSuppress = 0
+            self._fe_space(nlines)
+        else:
+            self._feSuppress = 0
+            self._fe_skip(barg)
 
-            # Start a page.
-            beginstream = self.startpage()
-            column = 1
+        # Print.
+        self._fe_print(line[1:])
 
-            # Handle "green bar" ornamentation.
-            if(self._greenbar):
+        # Act after printing.
+        if after == 'suppress':
+            self._feSuppress = aarg
+        elif after == 'skip':
+            self._fe_skip(aarg)
 
-                # Bars.
-                barMargin = 30
-                barLines = 3
-                gbuf = '%d w 0.8 1.0 0.8 RG\n'%(barLines * self._vertSpace) # Line with width = bar height.
-                ws(gbuf)
-                ypos = 4 * self._vertSpace
-                if self._landscape:
-                    ypos -= (self._vertSpace/4-1)
-                else:
-                    ypos += (self._vertSpace/3)
-                    if self._vertSpace == 6:
-                        ypos += 2
-                #print('ypos =', ypos, self._vertSpace)
-                for gline in range(barLines,self._lines+8):
-                    if((gline%(barLines * 2))==0): # Draw a bar (i.e. a line).
-                        gbuf = '%d %d m %d %d l S\n'%(barMargin,ypos,self._pageWd-barMargin,ypos)
-                        ws(gbuf)
-                    ypos += self._vertSpace
-
-                # HCCC text.
-                if False:
-                    ypos += (barLines-1) * self._vertSpace
-                    xpos = 30
-                    gbuf='3 w %d %d m %d %d l S\n'%(xpos,ypos,xpos,ypos+27)
-                    ws(gbuf)
-                    gbuf='%d %d m %d %d l S\n'%(xpos,ypos+13,xpos+18,ypos+13)
-                    ws(gbuf)
-                    gbuf='%d %d m %d %d l S\n'%(xpos+18,ypos,xpos+18,ypos+27)
-                    ws(gbuf)
-                    for hchar in range(1,4):
-                        xpos += 26
-                        gbuf='%d %d m %d %d l S\n'%(xpos,ypos,xpos,ypos+27)
-                        ws(gbuf)
-                        gbuf='%d %d m %d %d l S\n'%(xpos,ypos+1,xpos+18,ypos+1)
-                        ws(gbuf)
-                        gbuf='%d %d m %d %d l S\n'%(xpos,ypos+26,xpos+18,ypos+26)
-                        ws(gbuf)
-
-                # Tractor holes.
-                tractMargin = 15
-                gbuf = '%d w 0.3 0.3 0.3 RG\n'%(self._vertSpace)
-                ws(gbuf)
-                ypos = 4 * self._vertSpace
-                if self._landscape:
-                    ypos -= (self._vertSpace/4-1)
-                else:
-                    ypos += (self._vertSpace/3)                    
-                for gline in range(0,self._lines+2):
-                    if((gline%4)==0):
-                        self.pdfellipse(tractMargin,ypos,1,1)
-                        self.pdfellipse(self._pageWd-tractMargin,ypos,1,1)
-                    ypos += self._vertSpace
-
-            # Loop over print columns of page (1 or 2).
-            while column <= self._columns:
-                column += 1
-                atFF = 0
-                atBOP = 0
-                lineNo = 0
-                # Special flag for regexp page break
-                pagebreak = False
-
-                # Loop over lines of page for print column.
-                while lineNo < self._lines and not atFF and not atEOF and not pagebreak:
-                    
-                    # Start new output line.
-                    linebuf = ''
-                    lineNo += 1
-                    charNo = 0
-                    ch = ''
-
-                    # Loop over characters of line allowed before possibly wrapping to the next line..
-                    while charNo < self._cols:
-                        charNo += 1
-                        ch = _bytestostr(self._ifs.read(1))
-
-                        # Break while loop if \n or (FF and doFFs) or ch is empty (EOF)
-                        breakcond = (ch == '\n') or (ch==FF and self._doFFs) or (ch == '')
-                        if breakcond:
-                            break
-
-                        # Output printing character. Escape parentheses and backslashes.
-                        if ord(ch) >= 32 and ord(ch) <= 127:
-                            if charNo <= self._trunc:
-                                if ch == '(' or ch == ')' or ch == '\\':
-                                    linebuf += "\\"
-                                linebuf += ch
-                            
-                        else:
-                            # Deal with some format effectors and non-printing characters.
-                            if ord(ch) == 9:  # tab
-                                padding = self._tab - ((charNo - 1) % self._tab)
-                                for i in range(padding):
-                                    linebuf += " "
-                                charNo += (padding -1)
-                            elif ord(ch) == 13: # CR
-                                charNo = 0
-                                linebuf += ch
-                            else:
-                                if ch != FF:
-                                    # write \xxx form for dodgy character
-                                    buf = "".join(('\\', ch))
-                                    linebuf += buf
-                                else:
-                                    # dont print anything for a FF
-                                    charNo -= 1
-
-                    # End of line. 
-                    # Write the accumulated output string as one or more lines.
-                    # This would be trivial, apart from getting overstrike to work.
-                    cr_pending = False
-                    ws("(")
-                    len_linebuf = len(linebuf)
-                    for i in range(len_linebuf):
-                        ach = linebuf[i]
-                        # If CR, check if it is at the end of the line or not.
-                        # If it is at the end, ignore it.
-                        if ach == '\r':
-                            if i < (len_linebuf-1):
-                                # CR not at end of line.
-                                # If cr_pending already, output line without moving to next line.
-                                if cr_pending:
-                                    ws(") Tj\n")
-                                # Otherwise, move to next line and output line that ends in CR.
-                                else:
-                                    ws(")'\n")
-                                # Go to start of this line, open a new output string. Set cr_pending.
-                                ws("0 0 Td (")
-                                cr_pending = True
-                                
-                        # Any other character, write to the output string.
-                        else:
-                            ws(ach)
-
-                    # End of the accumulated line.
-                    # If CR pending, write without going to a new line. Reset cr_pending.
-                    if cr_pending:
-                        ws(") Tj\n")
-                        cr_pending = False
-
-                    # Otherwise, go to a new line and write the string.
-                    else:
-                        ws(")'\n")
-
-                    # Reset the character accumulation buffer.
-                    linebuf = ''
-
-                    # Check end of page conditions.
-                    if ch == FF:
-                        atFF = 1   # Because of FF
-                        
-                    if lineNo == self._lines:
-                        atBOP = 1  # Because line count reached.
-
-                    # Start of new page because line count was reached.
-                    # Read another character and check for end of file of FF.
-                    # Not sure about Pillai's logic here. But it seems to work.
-                    if atBOP:
-                        pos = 0
-                        ch = _bytestostr(self._ifs.read(1))
-                        pos = self._ifs.tell()
-                        if ch == FF:
-                            ch = _bytestostr(self._ifs.read(1))
-                            pos = self._ifs.tell()
-
-                        if ch == '':
-                            atEOF = 1
-                        else:
-                            # push position back by one char
-                            self._ifs.seek(pos-1)
-
-                    # Start of new page because of FF.
-                    elif atFF:
-                        ch = _bytestostr(self._ifs.read(1))
-                        pos = self._ifs.tell()
-                        
-                        if ch == '':
-                            atEOF = 1
-                        else:
-                            self._ifs.seek(pos-1)
-
-                # Move to second column of print. Or not.
-                if column < self._columns:
-                    buf = "".join(("1 0 0 1 ",
-                                   str((self._pageWd/2 + 25)),
-                                   " ",
-                                   str(self._pageHt - 40),
-                                   " Tm\n"))
-                    ws(buf)
+    def _fe_space(self, nlines):
+        """
+        Advance nlines lines, starting a new page if this one is full: at
+        its first line with auto page eject, otherwise as far down it as
+        the spacing went past the end of this one.
+        """
+        depth = self._feDepth + nlines * self._feLeading
+        bottom = self._lines * self._vertSpace
+        if depth > bottom + 0.01:
+            self._fe_newpage()
+            if self._feAutoEject:
+                depth = self._feLeading
+            else:
+                depth -= bottom
+        self._feDepth = depth
+
+    def _fe_skip(self, channel):
+        """
+        Skip to a format channel: to its line on this page if that is still
+        below the current position, otherwise on a new page.
+        """
+        if channel == 12:
+            line = self._channels.get(12, self._lines)
+        else:
+            line = self._channels.get(channel, self._channels.get(1, 1))
+        depth = line * self._vertSpace
+        if depth <= self._feDepth:
+            self._fe_newpage()
+        self._feDepth = depth
 
-            # End a page.
-            self.endpage(beginstream)
+    def _fe_openpage(self):
+        """
+        Start a page for the format effector engine.
+        """
+        self._feStream = self.startpage()
+        if(self._greenbar):
+            with self.span('greenbar'):
+                self.drawgreenbar()
+
+    def _fe_newpage(self):
+        """
+        End the current page, if any. The next line printed starts a new one.
+        """
+        if self._feStream is not None:
+            self.endpage(self._feStream)
+            self._feStream = None
+        self._feDepth = 0
+
+    def _fe_print(self, text):
+        """
+        Print text at the current position. Carriage returns in it overprint.
+        """
+        ws = self.writestr
+        if self._feStream is None:
+            self._fe_openpage()
+        if self._feDepth < self._feLeading:
+            self._feDepth = self._feLeading
+        tm = "1 0 0 1 50 %g Tm\n"%round(self._pageHt - 40 - self._feDepth, 2)
+        for segment in text.split('\r'):
+            segment = segment.expandtabs(self._tab)[:self._trunc-1]
+            self._usedChars.update(segment)
+            ws(tm)
+            ws(self.showtext(segment.translate(PDF_STRING_TABLE), " Tj"))
 
     def writerest(self):
         """
         Finish the file
         """
         ws = self.writestr
-        self._locations[3] = self._fpos
 
-        # Page location dictionary.
-        ws("3 0 obj\n")
-        ws("<<\n")
-        ws("/Type /Pages\n")
-        buf = "".join(("/Count ", str(self._pageNo), "\n"))
-        ws(buf)
-        buf = "".join(("/MediaBox [ 0 0 ", str(self._pageWd), " ", str(self._pageHt), " ]\n"))
-        ws(buf)
-        ws("/Kids [ ")
-    
-        for i in range(1, self._pageNo+1):
-            buf = "".join((str(self._pageObs[i]), " 0 R "))
-            ws(buf)
+        if self._ttf is not None:
+            self.writettfont()
 
-        ws("]\n")
-        ws(">>\n")
-        ws("endobj\n")
+        # Page location dictionaries.
+        self.writepagetree()
+
+        if self._objStreams:
+            self.flushobjstm()
+            self.writexrefstream()
+            return
 
         # Cross references.
         xref = self._fpos
@@ -820,7 +1791,381 @@ class PyText2Pdf(object):
         buf = "".join((str(xref), "\n"))
         ws(buf)
         ws("%%EOF\n")
-        
+
+    def pageparent(self):
+        """
+        Return the page tree leaf node for the next page, starting a new
+        one every PAGE_TREE_FANOUT pages.
+        """
+        if self._pageNo % PAGE_TREE_FANOUT == 0:
+            self._leaves.append(self.newobj())
+        return self._leaves[-1]
+
+    def writepagetree(self):
+        """
+        Write the page tree: the leaf nodes holding the pages, as many
+        levels of nodes above them as needed for none to have more than
+        PAGE_TREE_FANOUT kids, and the root, object 3. Viewers find a
+        page by walking down the tree rather than through one huge array.
+        """
+        for num, kids, count, parent in self.pagetree(self._leaves, self._pageObs[1:], 3, self.newobj):
+            self.writeobj(num, self.pagesdict(kids, count, parent))
+
+    def pagetree(self, leaves, pages, root, newobj):
+        """
+        Return the nodes of the page tree over the page objects pages as
+        (object, kids, pages, parent), leaves first and the root (with no
+        parent) last. Leaf i holds pages i*PAGE_TREE_FANOUT onwards; nodes
+        between the leaves and the root get object numbers from newobj().
+        """
+        fanout = PAGE_TREE_FANOUT
+        # Each level of nodes as (object, kids, pages), leaves first.
+        level = []
+        for i in range(len(leaves)):
+            kids = pages[i * fanout:(i + 1) * fanout]
+            level.append((leaves[i], kids, len(kids)))
+        parents = {}
+        nodes = []
+        while len(level) > fanout:
+            upper = []
+            for j in range(0, len(level), fanout):
+                group = level[j:j + fanout]
+                num = newobj()
+                upper.append((num, [node[0] for node in group], sum(node[2] for node in group)))
+                for node in group:
+                    parents[node[0]] = num
+            nodes.extend(level)
+            level = upper
+        for node in level:
+            parents[node[0]] = root
+        nodes.extend(level)
+        tree = [(num, kids, count, parents[num]) for num, kids, count in nodes]
+        tree.append((root, [node[0] for node in level], len(pages), None))
+        return tree
+
+    def writexrefstream(self):
+        """
+        Finish the file with a cross-reference stream (PDF 1.5).
+        Objects in object streams get type 2 entries.
+        """
+        ws = self.writestr
+        xrefobj = self.newobj()
+        xref = self._fpos
+        self._locations[xrefobj] = xref
+        size = self._curobj + 1
+
+        # Field 2 holds offsets and object stream numbers.
+        width = max(1, (max(xref, size).bit_length() + 7) // 8)
+        rows = [b"\x00" + bytes(width) + b"\xff\xff"]
+        for i in range(1, size):
+            ref = self._objstmRefs[i]
+            if ref == 0:
+                rows.append(b"\x01" + self._locations[i].to_bytes(width, 'big') + b"\x00\x00")
+            else:
+                rows.append(b"\x02" + (ref >> 16).to_bytes(width, 'big') + (ref & 0xffff).to_bytes(2, 'big'))
+        data = zlib.compress(b"".join(rows))
+
+        ws("%d 0 obj\n<< /Type /XRef /Size %d /W [ 1 %d 2 ] /Root 2 0 R /Info 1 0 R /Filter /FlateDecode /Length %d >>\nstream\n"%(
+            xrefobj, size, width, len(data)))
+        self.writebytes(data)
+        ws("\nendstream\nendobj\n")
+        ws("startxref\n")
+        ws("".join((str(xref), "\n")))
+        ws("%%EOF\n")
+
+    def writelinearized(self, src):
+        """
+        Write the document, already written in the usual way to file src,
+        as a linearized PDF file (PDF 1.4 Annex F / ISO 32000-1 Annex F).
+        The first page and everything needed to show it come first, with a
+        hint stream giving where each other page is, so a viewer can show
+        page 1 of a very large listing before the rest has arrived.
+
+        Objects are renumbered: pages 2..N (page, contents), the page tree
+        (its root, the leaves, then any nodes between them, shaped as by
+        writepagetree), the information dictionary and then the first page section
+        (linearization dictionary, catalog, page 1, its contents, the
+        resources, the font, an embedded font's descriptor and font file,
+        and the hint stream). Content streams get
+        direct lengths, and each page its own media box so that pages do
+        not depend on the page tree.
+        """
+        npages = self._pageNo
+        # Main section object numbers.
+        pagesobj = 2 * (npages - 1) + 1
+        leaves = list(range(pagesobj + 1, pagesobj + 1 + (npages + PAGE_TREE_FANOUT - 1) // PAGE_TREE_FANOUT))
+        nextobj = [leaves[-1]]
+
+        def newobj():
+            nextobj[0] += 1
+            return nextobj[0]
+
+        # Leaves hold page numbers here; page 1's object number depends on
+        # how many nodes the tree has.
+        tree = self.pagetree(leaves, range(1, npages + 1), pagesobj, newobj)
+        infoobj = nextobj[0] + 1
+        # First page section object numbers.
+        linobj = infoobj + 1
+        catobj = linobj + 1
+        page1obj = linobj + 2
+        cont1obj = linobj + 3
+        resobj = linobj + 4
+        fontobj = linobj + 5
+        # An embedded font's descriptor and font file follow the font.
+        if self._ttf is None:
+            hintobj = fontobj + 1
+        else:
+            hintobj = fontobj + 3
+        size = hintobj + 1
+
+        def pageobjs(i):
+            if i == 1:
+                return page1obj, cont1obj
+            return 2 * (i - 2) + 1, 2 * (i - 2) + 2
+
+        def parent(i):
+            return leaves[(i - 1) // PAGE_TREE_FANOUT]
+
+        def obj(num, body):
+            return _strtobytes("".join((str(num), " 0 obj\n", body, "endobj\n")))
+
+        def streamobj(num, data):
+            return b"".join((_strtobytes("".join((str(num), " 0 obj\n<<\n/Length ", str(len(data)), "\n>>\nstream\n"))),
+                             data, b"endstream\nendobj\n"))
+
+        def contents(i):
+            start, length = self._streams[2 * i - 2], self._streams[2 * i - 1]
+            src.seek(start)
+            return src.read(length)
+
+        # Objects of the first page section and the main section, in file order.
+        catalog = obj(catobj, "".join(("<<\n/Type /Catalog\n/Pages ", str(pagesobj), " 0 R\n>>\n")))
+        first = [(page1obj, obj(page1obj, self.pagedict(parent(1), cont1obj, resobj, True))),
+                 (cont1obj, streamobj(cont1obj, contents(1))),
+                 (resobj, obj(resobj, self.resourcesdict(fontobj))),
+                 (fontobj, obj(fontobj, self.fontdict(fontobj + 1)))]
+        if self._ttf is not None:
+            first.append((fontobj + 1, obj(fontobj + 1, self.fontdescriptor(fontobj + 2))))
+            first.append((fontobj + 2, self.fontfile(fontobj + 2)))
+        main = []
+        for i in range(2, npages + 1):
+            pobj, cobj = pageobjs(i)
+            main.append((pobj, obj(pobj, self.pagedict(parent(i), cobj, resobj, True))))
+            main.append((cobj, streamobj(cobj, contents(i))))
+        # The root first, so that the nodes follow in object number order.
+        main.append((pagesobj, obj(pagesobj, self.pagesdict(tree[-1][1], npages))))
+        for num, kids, count, up in tree[:-1]:
+            if num <= leaves[-1]:
+                kids = [pageobjs(i)[0] for i in kids]
+            main.append((num, obj(num, self.pagesdict(kids, count, up))))
+        main.append((infoobj, obj(infoobj, self._infoBody)))
+
+        # Lay the file out without the hint stream. Offsets in the hint
+        # tables are as if it were not there.
+        header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+        firstxref = len(header) + LIN_DICT_SIZE
+        firstxrefsize = len("".join(("xref\n", str(linobj), " ", str(size - linobj), "\n")))
+        firstxrefsize += 20 * (size - linobj) + LIN_TRAILER_SIZE
+        locations = {}
+        pos = firstxref + firstxrefsize
+        locations[catobj] = pos
+        pos += len(catalog)
+        hintpos = pos
+        for num, data in first + main:
+            locations[num] = pos
+            pos += len(data)
+            if num == first[-1][0]:
+                endfirst = pos
+        mainxref = pos
+
+        hints = self.hinttables(npages, first, main, locations, endfirst)
+        hint = b"".join((_strtobytes("".join((str(hintobj), " 0 obj\n<<\n/S ", str(hints[1]), "\n/Length ",
+                                              str(len(hints[0])), "\n>>\nstream\n"))),
+                         hints[0], b"\nendstream\nendobj\n"))
+        hintlen = len(hint)
+        for num in locations:
+            if locations[num] >= hintpos:
+                locations[num] += hintlen
+        locations[hintobj] = hintpos
+        locations[linobj] = len(header)
+        endfirst += hintlen
+        mainxref += hintlen
+
+        # Main cross-reference table and trailer.
+        xref = ["xref\n0 ", str(linobj), "\n"]
+        # T: offset of the end of line before the first entry.
+        mainfirst = mainxref + len("".join(xref)) - 1
+        xref.append("".join(("0000000000 65535 f ", str(LINE_END))))
+        for i in range(1, linobj):
+            xref.append("".join((str(locations[i]).zfill(10), " 00000 n ", str(LINE_END))))
+        xref.append("".join(("trailer\n<<\n/Size ", str(linobj), "\n>>\nstartxref\n", str(firstxref), "\n%%EOF\n")))
+        xref = _strtobytes("".join(xref))
+        filelen = mainxref + len(xref)
+
+        # Linearization dictionary.
+        lindict = "".join((str(linobj), " 0 obj\n<< /Linearized 1 /L ", str(filelen),
+                           " /H [ ", str(hintpos), " ", str(hintlen), " ] /O ", str(page1obj),
+                           " /E ", str(endfirst), " /N ", str(npages), " /T ", str(mainfirst), " >>\nendobj\n"))
+        lindict = lindict.ljust(LIN_DICT_SIZE - 1) + "\n"
+
+        # First page cross-reference table and trailer.
+        docid = hashlib.md5(_strtobytes("".join((self._outfile, self._infoBody)))).hexdigest()
+        first_xref = ["xref\n", str(linobj), " ", str(size - linobj), "\n"]
+        for i in range(linobj, size):
+            first_xref.append("".join((str(locations[i]).zfill(10), " 00000 n ", str(LINE_END))))
+        trailer = "".join(("trailer\n<< /Size ", str(size), " /Prev ", str(mainxref),
+                           " /Root ", str(catobj), " 0 R /Info ", str(infoobj), " 0 R /ID [ <",
+                           docid, "> <", docid, "> ] >>\n"))
+        trailer = trailer.ljust(LIN_TRAILER_SIZE - len("startxref\n0\n%%EOF\n") - 1) + "\nstartxref\n0\n%%EOF\n"
+        first_xref.append(trailer)
+
+        self.writebytes(header)
+        self.writestr(lindict)
+        self.writestr("".join(first_xref))
+        self.writebytes(catalog)
+        self.writebytes(hint)
+        for num, data in first + main:
+            self.writebytes(data)
+        self.writebytes(xref)
+
+    def hinttables(self, npages, first, main, locations, endfirst):
+        """
+        Return the data of the hint stream for writelinearized: the page
+        offset hint table followed by the shared object hint table, and the
+        offset of the latter. Page 1 is the objects of the first page
+        section: its page and contents, the resources and the font (and
+        an embedded font's descriptor and font file). Every other page is
+        its page and contents objects and refers to the rest as shared
+        objects 2 onwards.
+        """
+        # Object counts and lengths of each page.
+        nobjects = [len(first)] + [2] * (npages - 1)
+        pagestart = [locations[first[0][0]]]
+        lengths = [endfirst - pagestart[0]]
+        for i in range(npages - 1):
+            pagestart.append(locations[main[2*i][0]])
+            lengths.append(len(main[2*i][1]) + len(main[2*i+1][1]))
+        nshared = [0] + [len(first) - 2] * (npages - 1)
+
+        def nbits(n):
+            return n.bit_length()
+
+        bits = _BitWriter()
+
+        # Page offset hint table header.
+        minobjects = min(nobjects)
+        minlength = min(lengths)
+        bits.put(minobjects, 32)
+        bits.put(pagestart[0], 32)
+        bits.put(nbits(max(nobjects) - minobjects), 16)
+        bits.put(minlength, 32)
+        bits.put(nbits(max(lengths) - minlength), 16)
+        # Content streams: offset 0 and the length of the whole page.
+        bits.put(0, 32)
+        bits.put(0, 16)
+        bits.put(minlength, 32)
+        bits.put(nbits(max(lengths) - minlength), 16)
+        bits.put(nbits(max(nshared)), 16)
+        idbits = nbits(len(first) - 1)
+        bits.put(idbits, 16)    # Shared object identifiers are 0..len(first)-1.
+        bits.put(0, 16)
+        bits.put(0, 16)
+
+        # Page offset hint table entries, item by item.
+        for n in nobjects:
+            bits.put(n - minobjects, nbits(max(nobjects) - minobjects))
+        bits.align()
+        for n in lengths:
+            bits.put(n - minlength, nbits(max(lengths) - minlength))
+        bits.align()
+        for n in nshared:
+            bits.put(n, nbits(max(nshared)))
+        bits.align()
+        for n in nshared:
+            for ident in range(2, 2 + n):
+                bits.put(ident, idbits)
+        bits.align()
+        bits.align()
+        bits.align()
+        for n in lengths:
+            bits.put(n - minlength, nbits(max(lengths) - minlength))
+        bits.align()
+
+        # Shared object hint table: the objects of the first page section.
+        shared = bits.offset()
+        grouplengths = [len(data) for num, data in first]
+        mingroup = min(grouplengths)
+        bits.put(0, 32)
+        bits.put(0, 32)
+        bits.put(len(first), 32)
+        bits.put(len(first), 32)
+        bits.put(0, 16)
+        bits.put(mingroup, 32)
+        bits.put(nbits(max(grouplengths) - mingroup), 16)
+        for n in grouplengths:
+            bits.put(n - mingroup, nbits(max(grouplengths) - mingroup))
+        bits.align()
+        for n in grouplengths:
+            bits.put(0, 1)
+        bits.align()
+
+        return bits.data(), shared
+
+# Attributes of a PyText2Pdf that affect page content, for _render_chunk().
+_RENDER_STATE = ('_font', '_spaceWidth', '_ptSize', '_vertSpace', '_lines', '_cols', '_trunc', '_columns',
+                 '_pageHt', '_pageWd', '_landscape', '_tab', '_doFFs', '_greenbar', '_IsoEnc')
+
+def input_lines(ifs):
+    """
+    Yield the input read from ifs as blocks of lines, in pieces of about
+    CHUNK_SIZE bytes cut after a newline (a longer line is kept whole).
+    Each block is (lines, partial): lines is a list of (text, plain), text
+    a line without its newline and plain True if it has only printable
+    characters, and partial is True if the last line is the end of the
+    input with no newline. This is the only place the input is read and
+    decoded, however many profiles it is then laid out for.
+    """
+    buf = b''
+    while True:
+        data = ifs.read(CHUNK_SIZE)
+        if data:
+            buf += data
+            cut = buf.rfind(b'\n') + 1
+            if cut == 0:
+                continue
+            block, buf = buf[:cut], buf[cut:]
+        elif buf:
+            block, buf = buf, b''
+        else:
+            break
+        text = block.decode('latin-1')
+        lines = text.split('\n')
+        partial = lines[-1] != ''
+        if not partial:
+            lines.pop()
+        if SPECIAL_CHARS.search(text) is None:
+            yield [(line, True) for line in lines], partial
+        else:
+            yield [(line, SPECIAL_CHARS.search(line) is None) for line in lines], partial
+
+def _render_chunk(args):
+    """
+    Process pool worker for PyText2Pdf.writepages_parallel(). Paginate
+    bytes start to end of file ifile with the given settings and return
+    the content stream of each page and the characters printed.
+    """
+    state, ifile, start, end = args
+    converter = PyText2Pdf()
+    for name in state:
+        setattr(converter, name, state[name])
+    with open(ifile, 'rb') as ifs:
+        ifs.seek(start)
+        converter._ifs = io.BufferedReader(io.BytesIO(ifs.read(end - start)))
+    converter._ofs = io.BytesIO()
+    converter.writepages()
+    data = converter._ofs.getvalue()
+    streams = converter._streams
+    return [data[streams[i]:streams[i]+streams[i+1]] for i in range(0, len(streams), 2)], converter._usedChars
 
 def main():
     pdfclass = PyText2Pdf()
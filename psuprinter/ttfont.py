@@ -0,0 +1,340 @@
+"""
+TrueType fonts for PyText2Pdf.
+
+Just enough of a TrueType file is parsed to embed the font in a PDF file:
+metrics for the font descriptor, advance widths, the Unicode character map
+and the glyph outlines. Embedded fonts are subset: outlines of glyphs that
+are not used are left out (glyph numbers are kept, so the character map and
+hinting programs still work).
+
+Parsed fonts and subsets are kept in a process-wide cache, so a long running
+psuprinter parses each font file once, and jobs using the same characters
+share one subset.
+"""
+import os
+import zlib
+import struct
+import hashlib
+import threading
+import collections
+
+# Tables copied into subset fonts (if present), as well as glyf and loca.
+SUBSET_TABLES = (b'cmap', b'cvt ', b'fpgm', b'head', b'hhea', b'hmtx', b'maxp', b'prep')
+
+# Number of subsets kept per font.
+SUBSET_CACHE_SIZE = 32
+
+# Composite glyph flags.
+ARG_1_AND_2_ARE_WORDS = 0x0001
+WE_HAVE_A_SCALE = 0x0008
+MORE_COMPONENTS = 0x0020
+WE_HAVE_AN_X_AND_Y_SCALE = 0x0040
+WE_HAVE_A_TWO_BY_TWO = 0x0080
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def load_font(path):
+    """
+    Return the TrueTypeFont for file path, parsing it only if it is not
+    in the cache (or the file has changed since). Raises ValueError if
+    it cannot be used.
+    """
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] == (st.st_mtime, st.st_size):
+            return entry[1]
+    try:
+        font = TrueTypeFont(path)
+    except (struct.error, IndexError) as e:
+        raise ValueError('damaged TrueType font: %s (%s)'%(path, e))
+    with _cache_lock:
+        _cache[key] = ((st.st_mtime, st.st_size), font)
+    return font
+
+def winansi(code):
+    """
+    Character for byte code in WinAnsiEncoding (Latin-1 where it has none).
+    """
+    try:
+        return bytes([code]).decode('cp1252')
+    except UnicodeDecodeError:
+        return chr(code)
+
+def _checksum(data):
+    """
+    TrueType table checksum.
+    """
+    data += b'\0' * (-len(data) % 4)
+    return sum(struct.unpack('>%dI'%(len(data) // 4), data)) & 0xffffffff
+
+class TrueTypeFont(object):
+    """
+    A parsed TrueType font file.
+    """
+
+    def __init__(self, path):
+        """
+        Parse the font in file path. Raises ValueError if it is not a
+        TrueType font that can be embedded.
+        """
+        super(TrueTypeFont,self).__init__()
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        data = self.data
+
+        version, numTables = struct.unpack('>IH', data[:6])
+        if version not in (0x00010000, 0x74727565):
+            raise ValueError('not a TrueType font (OpenType CFF and collections are not supported): '+path)
+        self.tables = {}
+        for i in range(numTables):
+            tag, checksum, offset, length = struct.unpack('>4sIII', data[12+16*i:28+16*i])
+            self.tables[tag] = data[offset:offset+length]
+        for tag in (b'head', b'hhea', b'hmtx', b'maxp', b'cmap', b'loca', b'glyf'):
+            if tag not in self.tables:
+                raise ValueError('font has no %s table: %s'%(tag.decode('latin-1'), path))
+
+        if b'OS/2' in self.tables and len(self.tables[b'OS/2']) >= 10:
+            fsType = struct.unpack('>H', self.tables[b'OS/2'][8:10])[0]
+            if fsType & 0x000f == 0x0002:
+                raise ValueError('font licence does not allow embedding: '+path)
+
+        head = self.tables[b'head']
+        self.unitsPerEm = struct.unpack('>H', head[18:20])[0]
+        self.bbox = struct.unpack('>4h', head[36:44])
+        indexToLocFormat = struct.unpack('>h', head[50:52])[0]
+
+        hhea = self.tables[b'hhea']
+        self.ascent, self.descent = struct.unpack('>hh', hhea[4:8])
+        numberOfHMetrics = struct.unpack('>H', hhea[34:36])[0]
+        self.numGlyphs = struct.unpack('>H', self.tables[b'maxp'][4:6])[0]
+
+        # Advance widths of each glyph.
+        hmtx = self.tables[b'hmtx']
+        self.advances = [struct.unpack('>H', hmtx[4*i:4*i+2])[0] for i in range(numberOfHMetrics)]
+        self.advances.extend([self.advances[-1]] * (self.numGlyphs - numberOfHMetrics))
+
+        # Glyph offsets.
+        loca = self.tables[b'loca']
+        if indexToLocFormat == 0:
+            self.offsets = [2*x for x in struct.unpack('>%dH'%(self.numGlyphs+1), loca[:2*(self.numGlyphs+1)])]
+        else:
+            self.offsets = list(struct.unpack('>%dI'%(self.numGlyphs+1), loca[:4*(self.numGlyphs+1)]))
+
+        self.italicAngle = 0
+        self.fixedPitch = False
+        if b'post' in self.tables:
+            post = self.tables[b'post']
+            self.italicAngle = struct.unpack('>i', post[4:8])[0] / 65536.0
+            self.fixedPitch = struct.unpack('>I', post[12:16])[0] != 0
+        self.capHeight = self.ascent
+        if b'OS/2' in self.tables:
+            os2 = self.tables[b'OS/2']
+            if struct.unpack('>H', os2[0:2])[0] >= 2 and len(os2) >= 90:
+                self.capHeight = struct.unpack('>h', os2[88:90])[0]
+
+        self.name = self.postscript_name()
+        self.cmap = self.parse_cmap()
+        # Some monospaced fonts do not set isFixedPitch.
+        if not self.fixedPitch:
+            self.fixedPitch = len(set(self.advances[self.cmap.get(c, 0)] for c in range(33, 127))) == 1
+        self.lock = threading.Lock()
+        self.subsets = collections.OrderedDict()
+
+    def postscript_name(self):
+        """
+        The font's PostScript name, or the file name if it has none.
+        """
+        name = self.tables.get(b'name', b'')
+        if len(name) >= 6:
+            count, strings = struct.unpack('>HH', name[2:6])
+            for i in range(count):
+                platform, encoding, language, nameID, length, offset = struct.unpack('>6H', name[6+12*i:18+12*i])
+                if nameID != 6:
+                    continue
+                raw = name[strings+offset:strings+offset+length]
+                if platform == 3:
+                    text = raw.decode('utf-16-be', 'replace')
+                else:
+                    text = raw.decode('latin-1')
+                text = ''.join(ch for ch in text if ch.isalnum() or ch in '-_')
+                if text:
+                    return text
+        return ''.join(ch for ch in os.path.splitext(os.path.basename(self.path))[0] if ch.isalnum() or ch in '-_')
+
+    def parse_cmap(self):
+        """
+        Return a dict mapping Unicode code points to glyph numbers, from
+        the Windows Unicode (format 4 or 12) character map.
+        """
+        cmap = self.tables[b'cmap']
+        numTables = struct.unpack('>H', cmap[2:4])[0]
+        best = None
+        for i in range(numTables):
+            platform, encoding, offset = struct.unpack('>HHI', cmap[4+8*i:12+8*i])
+            fmt = struct.unpack('>H', cmap[offset:offset+2])[0]
+            if (platform, encoding) in ((3, 10), (0, 4), (0, 6)) and fmt == 12:
+                best = (offset, fmt)
+                break
+            if (platform, encoding) in ((3, 1), (0, 3)) and fmt == 4 and best is None:
+                best = (offset, fmt)
+        if best is None:
+            raise ValueError('font has no Unicode character map: '+self.path)
+
+        mapping = {}
+        offset, fmt = best
+        if fmt == 4:
+            segCount = struct.unpack('>H', cmap[offset+6:offset+8])[0] // 2
+            ends = struct.unpack('>%dH'%segCount, cmap[offset+14:offset+14+2*segCount])
+            pos = offset + 16 + 2*segCount
+            starts = struct.unpack('>%dH'%segCount, cmap[pos:pos+2*segCount])
+            deltas = struct.unpack('>%dh'%segCount, cmap[pos+2*segCount:pos+4*segCount])
+            rangeOffsetPos = pos + 4*segCount
+            rangeOffsets = struct.unpack('>%dH'%segCount, cmap[rangeOffsetPos:rangeOffsetPos+2*segCount])
+            for seg in range(segCount):
+                for code in range(starts[seg], ends[seg] + 1):
+                    if code == 0xffff:
+                        continue
+                    if rangeOffsets[seg] == 0:
+                        glyph = (code + deltas[seg]) & 0xffff
+                    else:
+                        at = rangeOffsetPos + 2*seg + rangeOffsets[seg] + 2*(code - starts[seg])
+                        glyph = struct.unpack('>H', cmap[at:at+2])[0]
+                        if glyph:
+                            glyph = (glyph + deltas[seg]) & 0xffff
+                    if glyph:
+                        mapping[code] = glyph
+        else:
+            nGroups = struct.unpack('>I', cmap[offset+12:offset+16])[0]
+            for i in range(nGroups):
+                start, end, glyph = struct.unpack('>III', cmap[offset+16+12*i:offset+28+12*i])
+                for code in range(start, end + 1):
+                    mapping[code] = glyph + code - start
+        return mapping
+
+    def glyph(self, ch):
+        """
+        Glyph number for character ch (0, .notdef, if none).
+        """
+        return self.cmap.get(ord(ch), 0)
+
+    def width(self, ch):
+        """
+        Advance width of character ch in PDF text space units (1/1000 em).
+        """
+        return int(round(self.advances[self.glyph(ch)] * 1000.0 / self.unitsPerEm))
+
+    def scale(self, value):
+        """
+        Convert font units to PDF text space units.
+        """
+        return int(round(value * 1000.0 / self.unitsPerEm))
+
+    def components(self, glyph):
+        """
+        Glyphs used by composite glyph glyph.
+        """
+        glyf = self.tables[b'glyf']
+        start, end = self.offsets[glyph], self.offsets[glyph+1]
+        if end - start < 10 or struct.unpack('>h', glyf[start:start+2])[0] >= 0:
+            return []
+        found = []
+        pos = start + 10
+        while True:
+            flags, component = struct.unpack('>HH', glyf[pos:pos+4])
+            found.append(component)
+            pos += 4 + (4 if flags & ARG_1_AND_2_ARE_WORDS else 2)
+            if flags & WE_HAVE_A_SCALE:
+                pos += 2
+            elif flags & WE_HAVE_AN_X_AND_Y_SCALE:
+                pos += 4
+            elif flags & WE_HAVE_A_TWO_BY_TWO:
+                pos += 8
+            if not flags & MORE_COMPONENTS:
+                return found
+
+    def subset(self, chars):
+        """
+        Return (tag, font file data, compressed font file data) for a
+        subset of the font with the glyphs for the characters in chars.
+        tag is the six letter subset tag for the PDF font name. Subsets
+        are cached.
+        """
+        glyphs = set([0])
+        for ch in chars:
+            glyphs.add(self.glyph(ch))
+        todo = list(glyphs)
+        while todo:
+            for component in self.components(todo.pop()):
+                if component not in glyphs:
+                    glyphs.add(component)
+                    todo.append(component)
+        key = frozenset(glyphs)
+
+        with self.lock:
+            cached = self.subsets.get(key)
+            if cached is not None:
+                self.subsets.move_to_end(key)
+                return cached
+
+        digest = hashlib.md5(repr(sorted(glyphs)).encode('ascii')).digest()
+        tag = ''.join(chr(ord('A') + b % 26) for b in digest[:6])
+        data = self.build(glyphs)
+        result = (tag, data, zlib.compress(data))
+
+        with self.lock:
+            self.subsets[key] = result
+            while len(self.subsets) > SUBSET_CACHE_SIZE:
+                self.subsets.popitem(last=False)
+        return result
+
+    def build(self, glyphs):
+        """
+        Return a font file with the outlines of only the given glyphs.
+        """
+        glyf = self.tables[b'glyf']
+        newglyf = []
+        offsets = [0]
+        pos = 0
+        for glyph in range(self.numGlyphs):
+            if glyph in glyphs:
+                outline = glyf[self.offsets[glyph]:self.offsets[glyph+1]]
+                outline += b'\0' * (-len(outline) % 4)
+                newglyf.append(outline)
+                pos += len(outline)
+            offsets.append(pos)
+
+        tables = {}
+        for tag in SUBSET_TABLES:
+            if tag in self.tables:
+                tables[tag] = self.tables[tag]
+        tables[b'glyf'] = b''.join(newglyf)
+        tables[b'loca'] = struct.pack('>%dI'%len(offsets), *offsets)
+        # Long loca offsets, checksum adjustment to be filled in.
+        head = tables[b'head']
+        tables[b'head'] = head[:8] + b'\0\0\0\0' + head[12:50] + struct.pack('>h', 1) + head[52:]
+
+        tags = sorted(tables)
+        numTables = len(tags)
+        entrySelector = numTables.bit_length() - 1
+        searchRange = 16 * (1 << entrySelector)
+        header = [struct.pack('>IHHHH', 0x00010000, numTables, searchRange, entrySelector,
+                              numTables * 16 - searchRange)]
+        body = []
+        offset = 12 + 16 * numTables
+        for tag in tags:
+            data = tables[tag]
+            header.append(struct.pack('>4sIII', tag, _checksum(data), offset, len(data)))
+            data += b'\0' * (-len(data) % 4)
+            body.append(data)
+            offset += len(data)
+        font = bytearray(b''.join(header + body))
+
+        # Whole font checksum adjustment, in the head table.
+        headpos = 12 + 16 * numTables + sum(len(body[i]) for i in range(tags.index(b'head')))
+        adjust = (0xb1b0afba - _checksum(bytes(font))) & 0xffffffff
+        font[headpos+8:headpos+12] = struct.pack('>I', adjust)
+        return bytes(font)
@@ -0,0 +1,323 @@
+"""
+Regression tests for text2pdf's PDF structure and page layout.
+
+Run from the top of the repository with:
+
+    $ python -m unittest discover tests
+"""
+import os
+import re
+import time
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from psuprinter import text2pdf
+
+# Lines per page for ParallelTest.
+PAGE_LINES = 50
+
+def convert(txt_path, pdf_path, *args, **settings):
+    """
+    Convert txt_path to pdf_path with text2pdf options args, then any
+    PyText2Pdf attributes in settings. Return the PDF file's contents.
+    """
+    converter = text2pdf.PyText2Pdf()
+    converter.parse_args([txt_path, '-q', '-o', pdf_path] + list(args))
+    for name in settings:
+        setattr(converter, name, settings[name])
+    converter.convert()
+    with open(pdf_path, 'rb') as f:
+        return f.read()
+
+def objects(data):
+    """
+    Return the body of each object in PDF data, by object number.
+    """
+    return dict((int(m.group(1)), m.group(2))
+                for m in re.finditer(rb'(?m)^(\d+) 0 obj\n(.*?)endobj\n', data, re.S))
+
+def xref_entries(data, pos):
+    """
+    Return the cross-reference table at pos in data as {object: offset}
+    for objects in use, and where its trailer starts.
+    """
+    m = re.compile(rb'xref\n(\d+) (\d+)\n').match(data, pos)
+    first, count = int(m.group(1)), int(m.group(2))
+    entries = {}
+    pos = m.end()
+    for num in range(first, first + count):
+        row = data[pos:pos + 20]
+        if row[17:18] == b'n':
+            entries[num] = int(row[:10])
+        pos += 20
+    return entries, pos
+
+# Tokens of a content stream: strings, array brackets, numbers, names and
+# operators.
+CONTENT_TOKEN = re.compile(rb'\((?:\\.|[^\\)])*\)|\[|\]|-?\d+(?:\.\d+)?|/\w+|[A-Za-z*\']+')
+
+def unescape(token):
+    """
+    Return the text of a PDF string token.
+    """
+    return re.sub(rb'\\([0-7]{3}|.)', lambda m: bytes([int(m.group(1), 8)]) if len(m.group(1)) == 3 else m.group(1),
+                  token[1:-1]).decode('latin-1')
+
+def glyphs(data, width):
+    """
+    Return where each character other than a space is shown in the content
+    streams of PDF data, as (stream, x, y, character), for a font whose
+    characters are all width thousandths of its size wide. Pages with the
+    same contents share a stream.
+    """
+    shown = []
+    streams = re.findall(rb'stream\n(BT\n.*?)endstream', data, re.S)
+    for index, stream in enumerate(streams):
+        size = leading = x = y = start = 0.0
+        operands = []
+
+        def show(text):
+            nonlocal x
+            for ch in text:
+                if ch != ' ':
+                    shown.append((index, round(x, 3), round(y, 3), ch))
+                x += width * size / 1000.0
+
+        for token in CONTENT_TOKEN.findall(stream):
+            if token[:1] in b'(/[]' or token[:1].isdigit() or token[:1] == b'-':
+                operands.append(token)
+                continue
+            op = token.decode('latin-1')
+            if op == 'Tf':
+                size = float(operands[-1])
+            elif op == 'TL':
+                leading = float(operands[-1])
+            elif op == 'Tm':
+                x = start = float(operands[-2])
+                y = float(operands[-1])
+            elif op in ('T*', "'"):
+                x = start
+                y -= leading
+            if op in ("'", 'Tj'):
+                show(unescape(operands[-1]))
+            elif op == 'TJ':
+                for item in operands:
+                    if item[:1] == b'(':
+                        show(unescape(item))
+                    elif item not in (b'[', b']'):
+                        x -= float(item) * size / 1000.0
+            operands = []
+    return shown
+
+class TempDirTest(unittest.TestCase):
+    """
+    Test with a temporary directory for its files.
+    """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+class LinearizedTest(TempDirTest):
+    """
+    --linearize: the linearization dictionary, both cross-reference tables,
+    the hint stream and the page tree.
+    """
+
+    def linearized(self, npages, *args):
+        """
+        Return a linearized PDF of npages one line pages, and its
+        linearization dictionary entries.
+        """
+        with open(self.path('in.txt'), 'w') as f:
+            f.write(''.join('LINE %d\n'%i for i in range(npages)))
+        data = convert(self.path('in.txt'), self.path('out.pdf'), '-l', '1', '--linearize', *args)
+        m = re.search(rb'<< /Linearized 1 /L (\d+) /H \[ (\d+) (\d+) \] /O (\d+) /E (\d+) /N (\d+) /T (\d+) >>', data)
+        self.assertIsNotNone(m)
+        self.assertLess(m.start(), 100)
+        return data, dict(zip(('L', 'H0', 'H1', 'O', 'E', 'N', 'T'), map(int, m.groups())))
+
+    def test_dictionary(self):
+        for npages in (1, 2, 33):
+            data, lin = self.linearized(npages)
+            self.assertEqual(lin['L'], len(data))
+            self.assertEqual(lin['N'], npages)
+            self.assertEqual(data.count(b'/Type /Page\n'), npages)
+            self.assertIn(b'/Type /Page\n', objects(data)[lin['O']])
+
+    def test_first_page_xref(self):
+        data, lin = self.linearized(40)
+        # The first page cross-reference table follows the dictionary.
+        first = data.index(b'xref\n')
+        self.assertLess(first, lin['H0'])
+        entries, trailer = xref_entries(data, first)
+        self.assertIn(lin['O'], entries)
+        for num, offset in entries.items():
+            self.assertTrue(data.startswith(b'%d 0 obj\n'%num, offset), num)
+        # Its trailer points back to the main table, and the file's last
+        # startxref to it.
+        prev = int(re.compile(rb'trailer\n<< /Size \d+ /Prev (\d+)').match(data, trailer).group(1))
+        self.assertTrue(data.endswith(b'startxref\n%d\n%%%%EOF\n'%first))
+        main, trailer = xref_entries(data, prev)
+        self.assertEqual(min(main), 1)
+        self.assertEqual(set(main) | set(entries), set(range(1, max(entries) + 1)))
+        for num, offset in main.items():
+            self.assertTrue(data.startswith(b'%d 0 obj\n'%num, offset), num)
+        # T: the end of line before the main table's first entry.
+        self.assertEqual(data[lin['T']:lin['T'] + 19], b'\n0000000000 65535 f')
+        self.assertEqual(lin['T'], data.index(b'\n', prev + len(b'xref\n')))
+
+    def test_hint_stream(self):
+        data, lin = self.linearized(40)
+        hint = data[lin['H0']:lin['H0'] + lin['H1']]
+        self.assertTrue(re.match(rb'\d+ 0 obj\n<<\n/S \d+\n/Length \d+\n>>\nstream\n', hint))
+        self.assertTrue(hint.endswith(b'endstream\nendobj\n'))
+        # The page offset hint table header: the least number of objects in
+        # a page, then where page 1's object is, as if there were no hint
+        # stream.
+        stream = hint[hint.index(b'stream\n') + 7:]
+        self.assertEqual(int.from_bytes(stream[0:4], 'big'), 2)
+        page1 = int.from_bytes(stream[4:8], 'big') + lin['H1']
+        self.assertTrue(data.startswith(b'%d 0 obj\n<<\n/Type /Page\n'%lin['O'], page1))
+        # The first page section ends where page 2 starts.
+        self.assertTrue(data.startswith(b'1 0 obj\n<<\n/Type /Page\n', lin['E']))
+
+    def test_page_tree(self):
+        data, lin = self.linearized(1100)
+        objs = objects(data)
+        catalog = [body for body in objs.values() if b'/Type /Catalog' in body][0]
+        root = int(re.search(rb'/Pages (\d+) 0 R', catalog).group(1))
+        pages = []
+
+        def walk(num, parent, depth):
+            body = objs[num]
+            self.assertIn(('/Parent %d 0 R'%parent).encode() if parent else b'/Type /Pages', body)
+            if b'/Type /Page\n' in body:
+                pages.append(num)
+                return 1
+            kids = [int(kid) for kid in re.findall(rb'(\d+) 0 R', body.split(b'/Kids')[1])]
+            self.assertLessEqual(len(kids), text2pdf.PAGE_TREE_FANOUT)
+            count = sum(walk(kid, num, depth + 1) for kid in kids)
+            self.assertIn(b'/Count %d\n'%count, body)
+            return count
+
+        self.assertEqual(walk(root, None, 0), 1100)
+        self.assertEqual(pages[0], lin['O'])
+        self.assertEqual(pages[1:], [2 * i + 1 for i in range(1099)])
+
+    def test_embedded_font(self):
+        ttf = '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf'
+        if not os.access(ttf, os.R_OK):
+            self.skipTest('no TrueType font')
+        data, lin = self.linearized(3, '--ttf', ttf)
+        entries, trailer = xref_entries(data, data.index(b'xref\n'))
+        self.assertTrue(any(b'/FontFile2' in objects(data)[num] for num in entries))
+
+class ParallelTest(TempDirTest):
+    """
+    -j: pages rendered in several processes are the same as when rendered
+    in one.
+    """
+
+    def setUp(self):
+        super(ParallelTest,self).setUp()
+        # Small chunks, so that a small input is split; a fixed creation
+        # date, so that runs can be compared byte for byte.
+        for patch in (mock.patch.object(text2pdf, 'CHUNK_SIZE', 2048),
+                      mock.patch.object(text2pdf.time, 'localtime', return_value=time.localtime(0))):
+            patch.start()
+            self.addCleanup(patch.stop)
+        # Pages ended by form feeds, some of them just after the page has
+        # been filled (PAGE_LINES lines), when the next form feed is skipped.
+        rand = random.Random(30)
+        lines = []
+        for page in range(120):
+            for i in range(PAGE_LINES if rand.random() < 0.3 else rand.randint(0, PAGE_LINES - 1)):
+                lines.append('%5d %s(%s)\\\n'%(i, ' ' * rand.randint(0, 20), 'X' * rand.randint(0, 50)))
+            lines.append('\f' * rand.randint(1, 3))
+        with open(self.path('in.txt'), 'w') as f:
+            f.write(''.join(lines))
+
+    def assertSameAsSerial(self, *args):
+        """
+        Check that -j gives the same file as rendering serially, with
+        text2pdf options args, and that the pages were rendered in parallel.
+        """
+        used = []
+        parallel = text2pdf.PyText2Pdf.writepages_parallel
+
+        def writepages_parallel(converter):
+            used.append(parallel(converter))
+            return used[-1]
+
+        args = ('-F', '-l', str(PAGE_LINES)) + args
+        serial = convert(self.path('in.txt'), self.path('out.pdf'), *args)
+        with mock.patch.object(text2pdf.PyText2Pdf, 'writepages_parallel', writepages_parallel):
+            data = convert(self.path('in.txt'), self.path('out.pdf'), '-j', '3', *args)
+        self.assertEqual(used, [True])
+        self.assertEqual(data, serial)
+
+    def test_plain(self):
+        self.assertSameAsSerial()
+
+    def test_options(self):
+        for args in (['-l', '37'], ['-T', '60', '-G'], ['-X'], ['--linearize'], ['-L', '-I', '-f', 'Helvetica']):
+            with self.subTest(args=args):
+                self.assertSameAsSerial(*args)
+
+class SpaceRunTest(TempDirTest):
+    """
+    Long runs of spaces moved over with TJ arrays: the text is placed just
+    as when the spaces are printed.
+    """
+
+    def setUp(self):
+        super(SpaceRunTest,self).setUp()
+        lines = ['PROGRAM X' + ' ' * 30 + 'COMMENT\n',
+                 ' ' * 8 + 'A = B' + ' ' * 7 + '(C)' + ' ' * 12 + 'D\\E' + ' ' * 40 + '\n',
+                 '\tTAB' + ' ' * 9 + 'X\x85Y\n',
+                 ' ' * 70 + '\n',
+                 '1' + ' ' * 20 + 'EJECT\n',
+                 '+' + ' ' * 25 + 'OVERPRINT\n',
+                 '0SHORT RUN       X\n']
+        with open(self.path('in.txt'), 'w', encoding='latin-1') as f:
+            f.write(''.join(lines) * 30)
+
+    def assertSamePlaces(self, *args, width=600):
+        """
+        Check that the text is placed the same with and without TJ arrays,
+        with text2pdf options args.
+        """
+        data = convert(self.path('in.txt'), self.path('tj.pdf'), *args)
+        plain = convert(self.path('in.txt'), self.path('plain.pdf'), *args, _spaceWidth=None)
+        self.assertIn(b'] TJ\n', data)
+        self.assertNotIn(b'] TJ\n', plain)
+        self.assertLess(len(data), len(plain))
+        shown = glyphs(data, width)
+        self.assertGreater(len(shown), 100)
+        self.assertEqual(shown, glyphs(plain, width))
+
+    def test_courier(self):
+        self.assertSamePlaces()
+
+    def test_layouts(self):
+        for args in (['-2'], ['-L', '-s', '8'], ['-T', '50', '-t', '4'], ['-E'], ['-F', '-G']):
+            with self.subTest(args=args):
+                self.assertSamePlaces(*args)
+
+    def test_proportional(self):
+        # Text with spaces in Helvetica, whose spaces are 278 wide: only the
+        # start of each piece of text after a run can be checked.
+        data = convert(self.path('in.txt'), self.path('tj.pdf'), '-f', 'Helvetica')
+        plain = convert(self.path('in.txt'), self.path('plain.pdf'), '-f', 'Helvetica', _spaceWidth=None)
+        self.assertIn(b'T* [(PROGRAM X)-8340(COMMENT)] TJ\n', data)
+        self.assertIn(b'(PROGRAM X' + b' ' * 30 + b'COMMENT)', plain)
+
+if __name__ == '__main__':
+    unittest.main()